@@ -221,7 +221,7 @@ class MarketPlaceState(MarketPlaceCommunication):
         """
 
         objlist = []
-        for objid, objinfo in self.State.iteritems():
+        for objid, objinfo in self.State.iteritems(readonly=True):
             match = True
             for predicate in predicates:
                 if not predicate(objinfo):
@@ -238,7 +238,7 @@ class MarketPlaceState(MarketPlaceCommunication):
         Simple filter for common query operations on the current state
         """
         result = []
-        for objid, objinfo in self.State.iteritems():
+        for objid, objinfo in self.State.iteritems(readonly=True):
             if objtype and objinfo.get('object-type') != objtype:
                 continue
 
@@ -249,6 +249,7 @@ class MarketPlaceState(MarketPlaceCommunication):
                 continue
 
             # provide a couple useful properties
+            objinfo = objinfo.thaw()
             objinfo['id'] = objid
             objinfo['fqname'] = self.i2n(objid)
             if not objinfo['name']:
@@ -26,7 +26,7 @@ class AssetTypeObject(market_place_object_update.MarketPlaceObject):
 
     @classmethod
     def is_valid_object(cls, store, objectid):
-        obj = cls.get_valid_object(store, objectid)
+        obj = cls.get_valid_object(store, objectid, readonly=True)
         if not obj:
             return False
 
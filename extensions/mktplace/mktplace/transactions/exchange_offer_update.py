@@ -30,14 +30,16 @@ class ExchangeOfferObject(market_place_object_update.MarketPlaceObject):
     ExecutionStyle = ['Any', 'ExecuteOnce', 'ExecuteOncePerParticipant']
 
     @classmethod
-    def get_valid_object(cls, store, objectid, objecttypes=None):
+    def get_valid_object(cls, store, objectid, objecttypes=None,
+                         readonly=False):
         types = [cls.ObjectTypeName,
                  sell_offer_update.SellOfferObject.ObjectTypeName]
-        return super(cls, cls).get_valid_object(store, objectid, types)
+        return super(cls, cls).get_valid_object(store, objectid, types,
+                                                readonly)
 
     @classmethod
     def is_valid_object(cls, store, objectid):
-        obj = cls.get_valid_object(store, objectid)
+        obj = cls.get_valid_object(store, objectid, readonly=True)
         if not obj:
             return False
 
@@ -29,7 +29,7 @@ class HoldingObject(market_place_object_update.MarketPlaceObject):
     @classmethod
     def is_valid_object(cls, store, objectid):
         types = [cls.ObjectTypeName]
-        obj = cls.get_valid_object(store, objectid, types)
+        obj = cls.get_valid_object(store, objectid, types, readonly=True)
         if not obj:
             return False
 
@@ -28,14 +28,16 @@ class LiabilityObject(market_place_object_update.MarketPlaceObject):
     ObjectTypeName = 'Liability'
 
     @classmethod
-    def get_valid_object(cls, store, objectid, objecttypes=None):
+    def get_valid_object(cls, store, objectid, objecttypes=None,
+                         readonly=False):
         types = [cls.ObjectTypeName,
                  holding_update.HoldingObject.ObjectTypeName]
-        return super(cls, cls).get_valid_object(store, objectid, types)
+        return super(cls, cls).get_valid_object(store, objectid, types,
+                                                readonly)
 
     @classmethod
     def is_valid_object(cls, store, objectid):
-        obj = cls.get_valid_object(store, objectid)
+        obj = cls.get_valid_object(store, objectid, readonly=True)
         if not obj:
             return False
 
@@ -273,9 +273,15 @@ def _prepare_genesis_transactions(journal):
 
 
 class MarketPlaceGlobalStore(object_store.ObjectStore):
-    def __init__(self, prevstore=None, storeinfo=None, readonly=False):
-        super(MarketPlaceGlobalStore, self).__init__(prevstore, storeinfo,
-                                                     readonly)
+    # participant names are resolved for nearly every name lookup, the
+    # index is shared between checkpoints but as before its uniqueness is
+    # only enforced in a checkpoint once it is used by lookup
+    Indexes = ['Participant:full-name']
+
+    def __init__(self, prevstore=None, storeinfo=None, readonly=False,
+                 indexes=None, clone_indexes=None):
+        super(MarketPlaceGlobalStore, self).__init__(
+            prevstore, storeinfo, readonly, indexes, clone_indexes)
 
     def clone_store(self, storeinfo=None, readonly=False):
         """
@@ -284,7 +290,8 @@ class MarketPlaceGlobalStore(object_store.ObjectStore):
         :return: a new checkpoint that extends the current store
         :rtype: KeyValueStore
         """
-        return MarketPlaceGlobalStore(self, storeinfo, readonly)
+        return MarketPlaceGlobalStore(self, storeinfo, readonly,
+                                      clone_indexes=self._indexes)
 
     def i2n(self, objectid, objinfo=None):
         """
@@ -293,7 +300,7 @@ class MarketPlaceGlobalStore(object_store.ObjectStore):
 
         try:
             if objinfo is None:
-                objinfo = self.get(objectid)
+                objinfo = self.get(objectid, readonly=True)
         except KeyError:
             return None
 
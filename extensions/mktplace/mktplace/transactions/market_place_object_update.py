@@ -21,7 +21,8 @@ logger = logging.getLogger(__name__)
 
 class MarketPlaceObject(object):
     @classmethod
-    def get_valid_object(cls, store, objectid, objecttypes=None):
+    def get_valid_object(cls, store, objectid, objecttypes=None,
+                         readonly=False):
         if not objecttypes:
             objecttypes = [cls.ObjectTypeName]
 
@@ -30,7 +31,7 @@ class MarketPlaceObject(object):
                         objecttypes)
             return None
 
-        mpobj = store[objectid]
+        mpobj = store.get(objectid, readonly=readonly)
         mptype = mpobj.get('object-type', '**UNKNOWN**')
 
         if mptype not in objecttypes:
@@ -42,7 +43,7 @@ class MarketPlaceObject(object):
 
     @classmethod
     def is_valid_object(cls, store, objectid):
-        obj = cls.get_valid_object(store, objectid)
+        obj = cls.get_valid_object(store, objectid, readonly=True)
         if not obj:
             return False
 
@@ -82,3 +82,25 @@ class TestParticipantUpdateName(unittest.TestCase):
                 'Name': 'participant'
             })
         self.assertFalse(update.is_valid_name(store))
+
+
+class TestParticipantNameIndex(unittest.TestCase):
+    def test_replay_duplicate_names(self):
+        # A chain registered before the name index was shared can hold
+        # participants with the same name, replaying it must not fail
+        store = MarketPlaceGlobalStore()
+        first = participant_update.ParticipantObject(
+            participantid='0000000000000001', minfo={'name': 'participant'})
+        store[first.ObjectID] = first.dump()
+        store.commit()
+
+        # each block is applied to a new checkpoint
+        store = store.clone_store()
+        second = participant_update.ParticipantObject(
+            participantid='0000000000000002', minfo={'name': 'participant'})
+        store[second.ObjectID] = second.dump()
+        store.commit()
+
+        store = store.clone_store()
+        self.assertIn(second.ObjectID, store)
+        self.assertIsNotNone(store.n2i('//participant', 'Participant'))
@@ -0,0 +1,134 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the DuplicateFilter class, a rotating Bloom filter
+that remembers the digests of recently received messages.
+
+The filter holds two generations. New keys are added to the current
+generation and both generations are searched. When the current
+generation is older than the window, or holds as many keys as it was
+sized for, the older generation is dropped and a new one is started, so
+a key is remembered for at least one window. A key that was never added
+is reported as present with at most the configured error rate.
+"""
+
+import math
+import struct
+import time
+
+from threading import Lock
+
+
+class DuplicateFilter(object):
+    """Remembers keys for a time window, with a small chance of reporting
+    a key that was never added.
+
+    Keys must be digests of at least 16 bytes, whose bits are used
+    directly as the hashes of the filter.
+
+    Attributes:
+        Capacity (int): The number of keys each generation is sized for.
+        ErrorRate (float): The chance that a key that was not added is
+            reported as present.
+        Window (float): The number of seconds a generation is filled for.
+        BitCount (int): The number of bits in each generation.
+        HashCount (int): The number of bits set for each key.
+    """
+
+    def __init__(self, capacity=100000, error_rate=1e-6, window=300.0):
+        """Constructor for the DuplicateFilter class.
+
+        Args:
+            capacity (int): The number of keys each generation is sized
+                for.
+            error_rate (float): The chance that a key that was not added
+                is reported as present.
+            window (float): The number of seconds a generation is filled
+                for.
+        """
+        self.Capacity = capacity
+        self.ErrorRate = error_rate
+        self.Window = window
+
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.BitCount = int(math.ceil(bits / 8.0)) * 8
+        self.HashCount = max(1, int(round(
+            float(self.BitCount) / capacity * math.log(2))))
+
+        self._lock = Lock()
+        self._generations = [self._newgeneration()]
+        self._forgotten = [set()]
+        self._count = 0
+        self._started = time.time()
+
+    def __contains__(self, key):
+        indexes = self._indexes(key)
+        with self._lock:
+            for forgotten in self._forgotten:
+                if key in forgotten:
+                    return False
+
+            for bits in self._generations:
+                if all(bits[i >> 3] & (1 << (i & 7)) for i in indexes):
+                    return True
+
+        return False
+
+    def add(self, key):
+        """Adds a key to the current generation.
+
+        Args:
+            key (bytes): The digest to remember.
+        """
+        indexes = self._indexes(key)
+        with self._lock:
+            self._rotate(time.time())
+
+            bits = self._generations[-1]
+            for i in indexes:
+                bits[i >> 3] |= 1 << (i & 7)
+            self._count += 1
+
+            for forgotten in self._forgotten:
+                forgotten.discard(key)
+
+    def discard(self, key):
+        """Forgets a key that was added. Bits cannot be cleared, so the key
+        is kept in an exact set until its generation is dropped.
+
+        Args:
+            key (bytes): The digest to forget.
+        """
+        with self._lock:
+            self._forgotten[-1].add(key)
+
+    def _newgeneration(self):
+        return bytearray(self.BitCount // 8)
+
+    def _rotate(self, now):
+        if self._count < self.Capacity and \
+                now - self._started < self.Window:
+            return
+
+        self._generations = [self._generations[-1], self._newgeneration()]
+        self._forgotten = [self._forgotten[-1], set()]
+        self._count = 0
+        self._started = now
+
+    def _indexes(self, key):
+        # double hashing from two 64 bit halves of the digest
+        (first, second) = struct.unpack('!QQ', key[:16])
+        return [(first + i * second) % self.BitCount
+                for i in xrange(self.HashCount)]
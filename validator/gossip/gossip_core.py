@@ -17,12 +17,14 @@ This module defines the core gossip class for communication between nodes.
 """
 
 import errno
+import hashlib
 import logging
 import socket
 import time
 import copy
 
 from collections import deque
+from collections import OrderedDict
 from threading import Condition
 
 from twisted.internet import reactor, task
@@ -31,6 +33,13 @@ from twisted.internet.protocol import DatagramProtocol
 from gossip import event_handler
 from gossip import message
 from gossip import stats
+from gossip import wire_codec
+from gossip.duplicate_filter import DuplicateFilter
+from gossip.signature_verifier import SignatureVerifier
+from gossip.signed_object import SignedObject
+from gossip.stream_transport import StreamTransport
+from gossip.timer_wheel import TimerWheel
+from gossip.messages import busy_message
 from gossip.messages import connect_message
 from gossip.messages import gossip_debug
 from gossip.messages import random_walk_message
@@ -48,34 +57,194 @@ class GossipException(Exception):
         super(GossipException, self).__init__(msg)
 
 
+class MessageLane(object):
+    """A queue for messages of related types.
+
+    Attributes:
+        Name (str): The name of the lane.
+        Capacity (int): The number of messages received from peers that
+            the lane holds, 0 for no limit.
+        Policy (str): What happens to a message received for a full lane,
+            'reject' drops the new message and 'shed' drops the oldest
+            queued message to make room for it.
+        Metrics (list): The depth, wait time, handling time and count of
+            handled and dropped messages for the lane.
+    """
+
+    # fraction of the capacity above which the lane is saturated
+    HighWater = 0.75
+
+    def __init__(self, name, capacity=0, policy='reject'):
+        self.Name = name
+        self.Capacity = capacity
+        self.Policy = policy
+        self.Queue = deque()
+
+        self.Latency = stats.Average(name + 'Latency')
+        self.HandleTime = stats.Average(name + 'HandleTime')
+        self.Handled = stats.Counter(name + 'Handled')
+        self.Dropped = stats.Counter(name + 'Dropped')
+        self.Metrics = [
+            stats.Sample(name + 'Depth', lambda: len(self.Queue)),
+            self.Latency, self.HandleTime, self.Handled, self.Dropped]
+
+    def __len__(self):
+        return len(self.Queue)
+
+    @property
+    def Full(self):
+        return self.Capacity > 0 and len(self.Queue) >= self.Capacity
+
+    @property
+    def Saturated(self):
+        return self.Capacity > 0 and \
+            len(self.Queue) >= self.Capacity * self.HighWater
+
+
 class MessageQueue(object):
-    """The message queue used internally by Gossip."""
+    """The message queue used internally by Gossip.
+
+    Messages are kept in lanes chosen by the DispatchLane of the message
+    type, or by whether it is a system message. The dispatch thread takes
+    the oldest message of the first lane, in priority order, that is not
+    empty, so a backlog of one type does not delay the others. Handlers
+    are not thread safe, messages are handled one at a time.
+
+    Messages received from peers are admitted to a lane only while it has
+    room, so a flood of one type cannot exhaust memory or starve the
+    others. Messages submitted locally are always queued.
+
+    Attributes:
+        DefaultLanes (list): The names of the lanes in priority order, the
+            capacity of each lane and the policy for a full lane.
+    """
+
+    # blocks that are shed can be requested again from the peers, the
+    # newest transactions are the ones least likely to be in a block yet
+    DefaultLanes = [('System', 0, 'reject'),
+                    ('Transfer', 256, 'reject'),
+                    ('Transaction', 4096, 'reject'),
+                    ('Block', 1024, 'shed'),
+                    ('Default', 1024, 'reject')]
 
-    def __init__(self):
-        self._queue = deque()
+    def __init__(self, limits=None):
+        """Constructor for the MessageQueue class.
+
+        Args:
+            limits (dict): Overrides the capacity of some of the lanes.
+        """
+        limits = limits or {}
+        self._lanes = OrderedDict(
+            (name, MessageLane(name, limits.get(name, capacity), policy))
+            for (name, capacity, policy) in self.DefaultLanes)
         self._condition = Condition()
 
+    @property
+    def Lanes(self):
+        return self._lanes.values()
+
+    @property
+    def Saturated(self):
+        """Returns True when any lane is close to its capacity.
+        """
+        return any(l.Saturated for l in self._lanes.itervalues())
+
+    def _lane(self, msg):
+        name = getattr(msg, 'DispatchLane', None)
+        if name is None:
+            if msg is not None and not msg.IsSystemMessage:
+                name = 'Default'
+            else:
+                name = 'System'
+        return self._lanes.get(name, self._lanes['Default'])
+
+    def admit(self, msg):
+        """Makes room for a message received from a peer. The message is
+        not queued, that is left to the caller.
+
+        Args:
+            msg (message.Message): The received message.
+
+        Returns:
+            tuple: (admitted, shed) where admitted is False if the message
+                must be dropped and shed is a queued message that was
+                dropped to make room for it, or None.
+        """
+        self._condition.acquire()
+        try:
+            lane = self._lane(msg)
+            if not lane.Full:
+                return (True, None)
+
+            lane.Dropped.increment()
+            if lane.Policy == 'shed':
+                return (True, lane.Queue.pop()[0])
+            return (False, None)
+        finally:
+            self._condition.release()
+
     def pop(self):
+        """Returns the next message of the highest priority lane,
+        without accounting for the limits on the lanes.
+        """
+        self._condition.acquire()
+        try:
+            while len(self) < 1:
+                self._condition.wait()
+            for lane in self._lanes.itervalues():
+                if lane.Queue:
+                    return lane.Queue.pop()[0]
+        finally:
+            self._condition.release()
+
+    def take(self):
+        """Waits for a message and returns the next message of the
+        highest priority lane. The caller must call done once the message
+        is handled.
+
+        Returns:
+            tuple: (lane, msg)
+        """
         self._condition.acquire()
         try:
-            while len(self._queue) < 1:
+            while True:
+                for lane in self._lanes.itervalues():
+                    if lane.Queue:
+                        (msg, queued) = lane.Queue.pop()
+                        lane.Latency.add_value(time.time() - queued)
+                        return (lane, msg)
                 self._condition.wait()
-            return self._queue.pop()
+        finally:
+            self._condition.release()
+
+    def done(self, lane, elapsed):
+        """Records that a message taken from a lane has been handled.
+
+        Args:
+            lane (MessageLane): The lane returned by take.
+            elapsed (float): The number of seconds spent handling it.
+        """
+        self._condition.acquire()
+        try:
+            lane.HandleTime.add_value(elapsed)
+            lane.Handled.increment()
         finally:
             self._condition.release()
 
     def __len__(self):
-        return len(self._queue)
+        return sum(len(l) for l in self._lanes.itervalues())
 
     def __deepcopy__(self, memo):
-        newmq = MessageQueue()
-        newmq._queue = copy.deepcopy(self._queue, memo)
+        newmq = MessageQueue(
+            dict((l.Name, l.Capacity) for l in self._lanes.itervalues()))
+        for lane in self._lanes.itervalues():
+            newmq._lanes[lane.Name].Queue = copy.deepcopy(lane.Queue, memo)
         return newmq
 
     def appendleft(self, msg):
         self._condition.acquire()
         try:
-            self._queue.appendleft(msg)
+            self._lane(msg).Queue.appendleft((msg, time.time()))
             self._condition.notify()
         finally:
             self._condition.release()
@@ -91,6 +260,24 @@ class Gossip(object, DatagramProtocol):
         CleanupInterval (float): The number of seconds between cleanups.
         KeepAliveInterval (float): The number of seconds between keep
             alives.
+        MaximumBusyHoldTime (float): The longest time in seconds a peer
+            can ask the local node to hold back its traffic.
+        MaximumFragments (int): The largest number of fragments a packet
+            is split into.
+        MaximumFragmentRetries (int): The number of times a fragment is
+            sent again before the whole message is treated as dropped.
+        ReassemblyTimeout (float): The number of seconds to wait for the
+            missing fragments of a packet.
+        MaximumReassemblyBuffers (int): The largest number of packets
+            from one peer that can be reassembled at the same time.
+        BusyHoldTime (float): The number of seconds peers are asked to
+            hold back their traffic while the message queue is saturated.
+        CoalescePackets (bool): Whether packets and acknowledgements for
+            the same peer are packed together into one datagram.
+        StreamLanes (list): The dispatch lanes of the messages that are
+            sent over stream connections.
+        CompactEncoding (bool): Whether messages are sent with the compact
+            wire encoding.
         MinimumRetries (int): The minimum number of retries on message
             retransmission.
         RetryInterval (float): The time between retries, in seconds.
@@ -99,22 +286,37 @@ class Gossip(object, DatagramProtocol):
             with.
         PendingAckMap (dict): A map of incoming messages that require
             acknowledgement.
-        MessageHandledMap (dict): A map of handled messages where keys are
-            message identifiers and values are message expiration times.
+        MessageHandledMap (TimerWheel): A map of handled messages where
+            keys are message identifiers and values are message expiration
+            times.
+        RetransmitResolution (float): The precision in seconds of the
+            times when unacknowledged packets are treated as dropped.
         MessageHandlerMap (dict): A map of message types to handler
             functions.
         SequenceNumber (int): The next sequence number to be used for
             messages from the local node.
         NextCleanup (float): The time of the next cleanup event.
         NextKeepAlive (float): The time of the next keepalive event.
+        HeartbeatInterval (float): The number of seconds between heartbeat
+            timer events. Messages are not sent from the heartbeat, each
+            peer has a transmit timer armed for its next sendable message.
         onNodeDisconnect (EventHandler): An EventHandler for functions
             to call when a node becomes disconnected.
         onHeartbeatTimer (EventHandler): An EventHandler for functions
             to call when the heartbeat timer fires.
-        MessageQueue (MessageQueue): The queue of incoming messages.
+        MessageQueue (MessageQueue): The queue of incoming messages,
+            split into lanes that are dispatched independently.
+        SignatureVerifier (SignatureVerifier): Verifies the signatures on
+            incoming messages before they are handled.
         ProcessIncomingMessages (bool): Whether or not to process incoming
             messages.
         Listener (Reactor.listenUDP): The UDP listener.
+        StreamTransport (StreamTransport): The stream connections to peers
+            used for bulk traffic, None if only datagrams are used.
+        DuplicateFilter (DuplicateFilter): The digests of the packet data
+            of recently handled messages, used in front of the exact map
+            of digests to drop duplicates before they are decoded, None
+            if every packet is decoded.
     """
 
     # time in seconds to hold message to test for duplicates
@@ -122,6 +324,13 @@ class Gossip(object, DatagramProtocol):
     MaximumPacketSize = 8192 * 6 - 128
     CleanupInterval = 1.00
     KeepAliveInterval = 10.0
+    MaximumBusyHoldTime = 5.0
+    MaximumFragments = 256
+    MaximumFragmentRetries = 8
+    ReassemblyTimeout = 30.0
+    MaximumReassemblyBuffers = 16
+    HeartbeatInterval = 0.05
+    RetransmitResolution = 0.025
 
     def __init__(self, node, **kwargs):
         """Constructor for the Gossip class.
@@ -131,6 +340,33 @@ class Gossip(object, DatagramProtocol):
             MinimumRetries (int): The minimum number of retries on message
                 transmission.
             RetryInterval (float): The time between retries, in seconds.
+            SignatureWorkers (int): The number of processes that recover
+                the signers of incoming messages, 0 to recover them on
+                the reactor thread.
+            SignatureBatchSize (int): The number of signatures sent to
+                the worker processes at once.
+            SignatureCacheSize (int): The number of recovered signers
+                kept in the signature cache shared by all signed objects.
+            DispatchQueueLimits (dict): The number of messages received
+                from peers that each dispatch lane holds, by lane name.
+            BusyHoldTime (float): The number of seconds peers are asked
+                to hold back their traffic when the queue is saturated.
+            CoalescePackets (bool): Whether to pack several packets and
+                acknowledgements for a peer into one datagram. Bundles
+                are always accepted from peers.
+            StreamTransport (bool): Whether to send bulk traffic over TCP
+                connections to the peers, using the same port number.
+            StreamLanes (list): The dispatch lanes of the messages that
+                are sent over stream connections.
+            CompactEncoding (bool): Whether to send messages with the
+                compact wire encoding. Both encodings are always accepted
+                from peers.
+            DuplicateFilterRate (float): The chance that the duplicate
+                filter matches a message never received before, which is
+                then checked against the exact digests of the handled
+                messages, 0 (the default) to decode every packet.
+            DuplicateFilterCapacity (int): The number of messages the
+                duplicate filter is sized for in each expiration period.
         """
 
         super(Gossip, self).__init__()
@@ -146,40 +382,89 @@ class Gossip(object, DatagramProtocol):
         self.NodeMap = {}
 
         self.PendingAckMap = {}
-        self.MessageHandledMap = {}
+        self.MessageHandledMap = TimerWheel(self.CleanupInterval)
         self.MessageHandlerMap = {}
 
         self.SequenceNumber = 0
         self.NextCleanup = time.time() + self.CleanupInterval
         self.NextKeepAlive = time.time() + self.KeepAliveInterval
+        self.BusyHoldTime = kwargs.get('BusyHoldTime', 1.0)
+        self.NextBusySignal = 0
+
+        self.CoalescePackets = kwargs.get('CoalescePackets', False)
+        self._pendingacks = {}
+        self._ackflush = None
+        self._reassembly = {}
+        self._reassemblycounts = {}
+        self._transmittimers = {}
+        self._ackexpiry = TimerWheel(self.RetransmitResolution)
+        self._retransmittimer = None
+
+        self.StreamLanes = kwargs.get('StreamLanes', ['Block', 'Transfer'])
+        self.CompactEncoding = kwargs.get('CompactEncoding', False)
+        self.StreamTransport = None
+
+        self.DuplicateFilter = None
+        self._handleddigests = TimerWheel(self.CleanupInterval)
+        if kwargs.get('DuplicateFilterRate', 0) > 0:
+            self.DuplicateFilter = DuplicateFilter(
+                kwargs.get('DuplicateFilterCapacity', 100000),
+                kwargs.get('DuplicateFilterRate'),
+                self.ExpireMessageTime)
 
         self._initgossipstats()
 
+        if 'SignatureCacheSize' in kwargs:
+            SignedObject.signature_cache.resize(kwargs['SignatureCacheSize'])
+
+        # start the worker processes before any threads
+        self.SignatureVerifier = SignatureVerifier(
+            self.LocalNode.Name,
+            workers=kwargs.get('SignatureWorkers', 0),
+            batchsize=kwargs.get('SignatureBatchSize', 64))
+        self.StatDomains['signature'] = self.SignatureVerifier.VerifierStats
+        self._verifying = set()
+
+        self.MessageQueue = MessageQueue(kwargs.get('DispatchQueueLimits'))
+        self.DispatchStats = stats.Stats(self.LocalNode.Name, 'dispatch')
+        self.DispatchStats.add_metric(stats.Counter('BusySignals'))
+        for lane in self.MessageQueue.Lanes:
+            for metric in lane.Metrics:
+                self.DispatchStats.add_metric(metric)
+        self.StatDomains['dispatch'] = self.DispatchStats
+
         connect_message.register_message_handlers(self)
 
         gossip_debug.register_message_handlers(self)
         shutdown_message.register_message_handlers(self)
         topology_message.register_message_handlers(self)
         random_walk_message.register_message_handlers(self)
+        busy_message.register_message_handlers(self)
 
         # setup connectivity events
         self.onNodeDisconnect = event_handler.EventHandler('onNodeDisconnect')
 
         # setup the timer events
         self.onHeartbeatTimer = event_handler.EventHandler('onHeartbeatTimer')
-        self.onHeartbeatTimer += self._timertransmit
         self.onHeartbeatTimer += self._timercleanup
         self.onHeartbeatTimer += self._keepalive
+        self.onHeartbeatTimer += self._busysignal
 
         self._HeartbeatTimer = task.LoopingCall(self._heartbeat)
-        self._HeartbeatTimer.start(0.05)
-
-        self.MessageQueue = MessageQueue()
+        self._HeartbeatTimer.start(self.HeartbeatInterval)
 
         try:
             self.ProcessIncomingMessages = True
             self.Listener = reactor.listenUDP(self.LocalNode.NetPort,
                                               self)
+            if kwargs.get('StreamTransport', False):
+                self.StreamTransport = StreamTransport(
+                    self.LocalNode.Name, self.LocalNode.NetPort,
+                    self._streamreceived)
+                self.StatDomains['stream'] = self.StreamTransport.StreamStats
+
+            # a single dispatch thread, the handlers share the journal,
+            # the node map and the stores without locking
             reactor.callInThread(self._dispatcher)
 
         except:
@@ -196,9 +481,18 @@ class Gossip(object, DatagramProtocol):
         self.PacketStats.add_metric(stats.Average('BytesReceived'))
         self.PacketStats.add_metric(stats.Counter('MessagesAcked'))
         self.PacketStats.add_metric(stats.Counter('DuplicatePackets'))
+        self.PacketStats.add_metric(stats.Counter('FilteredDuplicates'))
         self.PacketStats.add_metric(stats.Counter('DroppedPackets'))
         self.PacketStats.add_metric(stats.Counter('AcksReceived'))
         self.PacketStats.add_metric(stats.Counter('MessagesHandled'))
+        self.PacketStats.add_metric(stats.Counter('BundlesSent'))
+        self.PacketStats.add_metric(stats.Counter('FragmentsSent'))
+        self.PacketStats.add_metric(stats.Counter('FragmentsResent'))
+        self.PacketStats.add_metric(stats.Counter('PacketsReassembled'))
+        self.PacketStats.add_metric(stats.Counter('ReassemblyTimeouts'))
+        self.PacketStats.add_metric(stats.Counter('RejectedFragments'))
+        self.PacketStats.add_metric(stats.Sample(
+            'ReassemblyBuffers', lambda: len(self._reassembly)))
         self.PacketStats.add_metric(stats.Sample(
             'UnackedPacketCount', lambda: len(self.PendingAckMap)))
 
@@ -288,6 +582,140 @@ class Gossip(object, DatagramProtocol):
 
         self.PacketStats.BytesReceived.add_value(len(data))
 
+        if message.PacketBundle.is_bundle(data):
+            self._bundlereceived(data)
+            return
+
+        if message.PacketFragment.is_fragment(data):
+            self._fragmentreceived(data)
+            return
+
+        self._packetreceived(data)
+
+    def _bundlereceived(self, data):
+        """Handles a datagram that holds several packets.
+
+        Args:
+            data (str): The packed bundle.
+        """
+        try:
+            bundle = message.PacketBundle()
+            bundle.unpack(data)
+        except:
+            logger.exception('failed to unpack packet bundle')
+            return
+
+        srcpeer = self.NodeMap.get(bundle.SenderID)
+        if srcpeer and bundle.Acks:
+            srcpeer.reset_ticks()
+            for seqno in bundle.Acks:
+                ack = message.Packet()
+                ack.IsAcknowledgement = True
+                ack.SenderID = bundle.SenderID
+                ack.SequenceNumber = seqno
+                self._handleack(ack)
+
+        for packed in bundle.Packets:
+            self._packetreceived(packed)
+
+    def _streamreceived(self, data):
+        """Handles a packet received on a stream connection.
+
+        Args:
+            data (str): The packed packet.
+        """
+        if not self.ProcessIncomingMessages:
+            return
+
+        self.PacketStats.BytesReceived.add_value(len(data))
+        self._packetreceived(data)
+
+    def _fragmentreceived(self, data):
+        """Handles a datagram that holds part of a packet, and the packet
+        once all of its fragments have arrived.
+
+        Args:
+            data (str): The packed fragment.
+        """
+        try:
+            fragment = message.PacketFragment()
+            fragment.unpack(data)
+        except:
+            logger.exception('failed to unpack packet fragment')
+            return
+
+        # fragments are only accepted from known nodes, the buffers they
+        # use would otherwise be open to anyone
+        srcpeer = self.NodeMap.get(fragment.SenderID)
+        if not srcpeer:
+            logger.debug('fragment %s received from unknown node', fragment)
+            return
+
+        srcpeer.reset_ticks()
+
+        # rejected fragments are not acknowledged
+        if not 1 <= fragment.Count <= self.MaximumFragments or \
+                not 0 <= fragment.Index < fragment.Count:
+            logger.warn('fragment %s is not valid for a packet with %d '
+                        'fragments', fragment, fragment.Count)
+            self.PacketStats.RejectedFragments.increment()
+            return
+
+        key = (fragment.SenderID, fragment.PacketID)
+        entry = self._reassembly.get(key)
+        if entry is None:
+            # the sender sends the fragment again once a buffer is free
+            pending = self._reassemblycounts.get(fragment.SenderID, 0)
+            if pending >= self.MaximumReassemblyBuffers:
+                logger.debug('too many packets from %s being reassembled',
+                             srcpeer)
+                self.PacketStats.RejectedFragments.increment()
+                return
+
+            entry = [time.time() + self.ReassemblyTimeout, fragment.Count, {}]
+            self._reassembly[key] = entry
+            self._reassemblycounts[fragment.SenderID] = pending + 1
+
+        # the parts of a reassembled packet are dropped, the entry remains
+        # to catch fragments that are sent again because an ack was lost
+        (_, count, parts) = entry
+        if parts is not None and count != fragment.Count:
+            logger.warn('fragment %s does not match earlier fragments',
+                        fragment)
+            self.PacketStats.RejectedFragments.increment()
+            return
+
+        if fragment.IsReliable:
+            self._sendack(fragment, srcpeer)
+
+        if parts is None:
+            return
+
+        parts[fragment.Index] = fragment.Data
+        if len(parts) < count:
+            return
+
+        entry[2] = None
+        self._releasereassembly(fragment.SenderID)
+        self.PacketStats.PacketsReassembled.increment()
+        self._packetreceived(''.join(parts[i] for i in xrange(count)),
+                             acknowledged=True)
+
+    def _releasereassembly(self, senderid):
+        pending = self._reassemblycounts.get(senderid, 0) - 1
+        if pending > 0:
+            self._reassemblycounts[senderid] = pending
+        else:
+            self._reassemblycounts.pop(senderid, None)
+
+    def _packetreceived(self, data, acknowledged=False):
+        """Handles a single received packet.
+
+        Args:
+            data (str): The packed packet.
+            acknowledged (bool): Whether the packet was already
+                acknowledged, as it is when its fragments are.
+        """
         # unpack the header
         try:
             packet = message.Packet()
@@ -309,21 +737,75 @@ class Gossip(object, DatagramProtocol):
                 self._handleack(packet)
             return
 
-        # first thing to do with the message is to send an ACK, all
-        # retransmissions will be handled by the sending node, if the
-        # IsReliable flag is set then this is not a system message & we know
-        # that the peer exists
-        if packet.IsReliable:
-            if srcpeer:
+        msg = self._unpackmessage(packet, srcpeer, len(data))
+
+        # a copy received while the first is verified is not acked, the
+        # sender keeps it until the message is admitted
+        if msg is not None and msg.Identifier in self._verifying:
+            logger.debug('duplicate message %s received from %s', msg,
+                         packet.SenderID[:8])
+            self.PacketStats.DuplicatePackets.increment()
+            return
+
+        # retransmissions are handled by the sending node, so the ack of a
+        # new message is held until the message is admitted to its lane and
+        # the sender keeps a message that is turned away, the others are
+        # acked at once. If the IsReliable flag is set then this is not a
+        # system message & we know that the peer exists
+        ack = None
+        if packet.IsReliable and not acknowledged and srcpeer:
+            if msg is None:
                 self._sendack(packet, srcpeer)
+            else:
+                ack = (packet, srcpeer)
+
+        if msg is None:
+            return
+
+        # system messages need not have verified signatures, the others
+        # are handled once the signers of the message and of the objects it
+        # carries have been recovered, possibly in a batch with other
+        # messages
+        if msg.IsSystemMessage:
+            self._accept(msg, ack)
+            return
+
+        self._verifying.add(msg.Identifier)
+        self.SignatureVerifier.submit(
+            msg.signed_objects(),
+            lambda valid: self._verified(msg, valid, ack))
+
+    def _unpackmessage(self, packet, srcpeer, length):
+        """Decodes the message in a packet.
+
+        Args:
+            packet (Packet): The received packet.
+            srcpeer (Node): The peer that sent the packet, or None.
+            length (int): The size of the packed packet.
+
+        Returns:
+            Message: The message, or None if it cannot be decoded, has no
+                handler or was received before.
+        """
+        # drop the copies of recently handled messages without decoding
+        # them, a match in the filter is confirmed against the exact
+        # digests so that a new message is never dropped
+        digest = None
+        if self.DuplicateFilter is not None:
+            digest = hashlib.sha256(packet.Data).digest()
+            if digest in self.DuplicateFilter and \
+                    digest in self._handleddigests:
+                self.PacketStats.DuplicatePackets.increment()
+                self.PacketStats.FilteredDuplicates.increment()
+                return None
 
         # now unpack the rest of the message
         try:
             minfo = message.unpack_message_data(packet.Data)
         except:
             logger.exception('unable to decode message with length %d',
-                             len(data))
-            return
+                             length)
+            return None
 
         # if we don't have a handler, thats ok we just dont do anything
         # with the message, note the missing handler in the logs however
@@ -333,23 +815,25 @@ class Gossip(object, DatagramProtocol):
         if typename not in self.MessageHandlerMap:
             logger.info('no handler found for message type %s from %s',
                         minfo['__TYPE__'], srcpeer or packet.SenderID[:8])
-            return
+            return None
 
         try:
             msg = self.unpack_message(typename, minfo)
             msg.TimeToLive = packet.TimeToLive - 1
             msg.SenderID = packet.SenderID
+            msg.WireDigest = digest
         except:
             logger.exception(
                 'unable to deserialize message of type %s from %s', typename,
                 packet.SenderID[:8])
-            return
+            return None
 
         # if we have seen this message before then just ignore it
         if msg.Identifier in self.MessageHandledMap:
             logger.debug('duplicate message %s received from %s', msg,
                          packet.SenderID[:8])
             self.PacketStats.DuplicatePackets.increment()
+            self._filter(msg)
 
             # if we have received a particular message from a node then we dont
             # need to send another copy back to the node, just remove it from
@@ -360,32 +844,83 @@ class Gossip(object, DatagramProtocol):
             except:
                 pass
 
-            return
+            return None
+
+        return msg
 
-        # verify the signature, this is a no-op for the gossiper, but
-        # subclasses might override the function, system messages need not have
-        # verified signatures
-        if not msg.IsSystemMessage and not msg.verify_signature():
+    def _verified(self, msg, valid, ack=None):
+        self._verifying.discard(msg.Identifier)
+        if not valid:
             logger.warn('unable to verify message %s received from %s',
-                        msg.Identifier[:8], msg.OriginatorID[:8])
+                        msg.Identifier[:8], msg.SenderID[:8])
+            # there is no point in the sender trying again
+            if ack is not None:
+                self._sendack(*ack)
             return
 
+        self._accept(msg, ack)
+
+    def _accept(self, msg, ack=None):
+        """Queues a received message for its handler if its lane has room.
+
+        Args:
+            msg (Message): The received message.
+            ack (tuple): The packet and peer to acknowledge once the
+                message is admitted, or None.
+        """
         # Handle system messages,these do not require the existence of
         # a peer. If the packet is marked as a system message but the message
         # type does not, then something bad is happening.
         self.PacketStats.MessagesHandled.increment()
 
+        srcpeer = self.NodeMap.get(msg.SenderID)
         if (srcpeer and srcpeer.is_peer) or msg.IsSystemMessage:
+            (admitted, shed) = self.MessageQueue.admit(msg)
+            if shed is not None:
+                # forget the shed message so that it is accepted if it
+                # is received again
+                logger.debug('shed message %s to make room for %s',
+                             shed.Identifier[:8], msg.Identifier[:8])
+                self.MessageHandledMap.pop(shed.Identifier, None)
+                if self.DuplicateFilter is not None and \
+                        shed.WireDigest is not None:
+                    self.DuplicateFilter.discard(shed.WireDigest)
+                    self._handleddigests.pop(shed.WireDigest, None)
+            if not admitted:
+                # without an ack the sender sends the message again, the
+                # peers are already asked to hold back while the queue is
+                # saturated
+                logger.debug('queue full, refused message %s from %s',
+                             msg.Identifier[:8], msg.SenderID[:8])
+                return
+
+            if ack is not None:
+                self._sendack(*ack)
+            self._filter(msg)
             self.handle_message(msg)
             return
 
+        if ack is not None:
+            self._sendack(*ack)
         logger.warn('received message %s from an unknown peer %s', msg,
-                    packet.SenderID[:8])
+                    msg.SenderID[:8])
 
     # --------------------------------- ###
     # Utility functions                 ###
     # --------------------------------- ###
 
+    def _filter(self, msg):
+        """Add a handled message to the duplicate filter, so that later
+        copies of its packet data are dropped without being decoded.
+
+        Args:
+            msg (Message): A message received from a peer.
+        """
+        if self.DuplicateFilter is not None and msg.WireDigest is not None:
+            self.DuplicateFilter.add(msg.WireDigest)
+            self._handleddigests[msg.WireDigest] = \
+                time.time() + self.ExpireMessageTime
+
     def _heartbeat(self):
         """Invoke functions that are connected to the heartbeat timer.
         """
@@ -462,6 +997,59 @@ class Gossip(object, DatagramProtocol):
 
             dstnode.enqueue_message(msg, now)
 
+            # handlers send messages from the dispatch threads
+            reactor.callFromThread(self._scheduletransmit, dstnode)
+
+    def _scheduletransmit(self, dstnode, now=None):
+        """Arm the transmit timer of a peer for the time its next message
+        can be sent, or cancel the timer if nothing is queued.
+
+        Args:
+            dstnode (Node): The peer whose queue changed.
+            now (float): Current time.
+        """
+        if now is None:
+            now = time.time()
+
+        timer = self._transmittimers.get(dstnode.Identifier)
+        if timer is not None and not timer.active():
+            timer = None
+
+        sendtime = dstnode.next_send_time()
+        if sendtime is None:
+            if timer is not None:
+                timer.cancel()
+                del self._transmittimers[dstnode.Identifier]
+            return
+
+        if timer is not None:
+            if timer.getTime() <= sendtime:
+                return
+            timer.cancel()
+
+        self._transmittimers[dstnode.Identifier] = reactor.callLater(
+            max(0.0, sendtime - now), self._transmittimer, dstnode.Identifier)
+
+    def _transmittimer(self, peerid):
+        """Send the messages that are due for a peer when its transmit
+        timer fires, then arm the timer for the next one.
+
+        Args:
+            peerid (str): The identifier of the peer.
+        """
+        self._transmittimers.pop(peerid, None)
+        dstnode = self.NodeMap.get(peerid)
+        if dstnode is None:
+            return
+
+        try:
+            now = time.time()
+            self._transmit(dstnode, now)
+            self._scheduletransmit(dstnode, now)
+        except:
+            logger.exception('unhandled error occured while sending to %s',
+                             dstnode)
+
     def _sendack(self, packet, peer):
         """Send an acknowledgement for a reliable packet.
 
@@ -472,10 +1060,59 @@ class Gossip(object, DatagramProtocol):
 
         logger.debug("sending ack for %s to %s", packet, peer)
 
-        self._dowrite(packet.create_ack(self.LocalNode.Identifier).pack(),
-                      peer)
         self.PacketStats.MessagesAcked.increment()
 
+        if not self.CoalescePackets:
+            self._dowrite(packet.create_ack(self.LocalNode.Identifier).pack(),
+                          peer)
+            return
+
+        # hold the ack until the datagrams already received are processed,
+        # unless it leaves earlier with packets for the peer
+        self._pendingacks.setdefault(peer.Identifier, []).append(
+            packet.SequenceNumber)
+        if self._ackflush is None:
+            self._ackflush = reactor.callLater(0, self._flushacks)
+
+    def _flushacks(self):
+        """Send the acknowledgements that were not sent with packets.
+        """
+        self._ackflush = None
+        for peerid in self._pendingacks.keys():
+            peer = self.NodeMap.get(peerid)
+            while peer and self._pendingacks.get(peerid):
+                self._writebundle(self._newbundle(peer), peer)
+            self._pendingacks.pop(peerid, None)
+
+    def _newbundle(self, peer):
+        """Creates a bundle for a peer with as many of the pending acks for
+        the peer as fit.
+
+        Args:
+            peer (Node): The destination of the bundle.
+        """
+        bundle = message.PacketBundle(self.LocalNode.Identifier)
+        acks = self._pendingacks.get(peer.Identifier)
+        if acks:
+            count = (self.MaximumPacketSize - len(bundle)) // 4
+            for seqno in acks[:count]:
+                bundle.add_ack(seqno)
+            del acks[:count]
+        return bundle
+
+    def _writebundle(self, bundle, peer):
+        """Put a bundle on the wire, as a plain packet if it holds only one.
+
+        Args:
+            bundle (PacketBundle): The bundle to send.
+            peer (Node): The node to send the bundle to.
+        """
+        if len(bundle.Packets) == 1 and not bundle.Acks:
+            self._dowrite(bundle.Packets[0], peer)
+        elif bundle.Packets or bundle.Acks:
+            self.PacketStats.BundlesSent.increment()
+            self._dowrite(bundle.pack(), peer)
+
     def _handleack(self, incomingpkt):
         """Handle an incoming acknowledgement.
 
@@ -514,63 +1151,223 @@ class Gossip(object, DatagramProtocol):
 
         self.PacketStats.AcksReceived.increment()
         del self.PendingAckMap[incomingpkt.SequenceNumber]
+        self._ackexpiry.pop(incomingpkt.SequenceNumber)
 
-    def _timertransmit(self, now):
-        """A periodic handler that iterates through the nodes and sends
-        any packets that are queued for delivery.
+    def _transmit(self, dstnode, now):
+        """Sends the packets that are queued for delivery to a node and
+        can be sent now.
 
         Args:
+            dstnode (Node): The destination node.
             now (float): Current time.
         """
         srcnode = self.LocalNode
+        bundles = {}
 
-        dstnodes = self.peer_list(True)
-        while len(dstnodes) > 0:
-            newnodes = []
-            for dstnode in dstnodes:
-                msg = dstnode.get_next_message(now)
-                if msg:
-                    if dstnode.is_peer or msg.IsSystemMessage:
-                        # basically we are looping through the nodes & as long
-                        # as there are messages pending then come back around &
-                        # try again
-                        newnodes.append(dstnode)
+        while True:
+            msg = dstnode.get_next_message(now)
+            if msg is None:
+                break
+            if not dstnode.is_peer and not msg.IsSystemMessage:
+                continue
 
-                        packet = message.Packet()
-                        packet.add_message(msg, srcnode, dstnode,
-                                           self.next_sequence_number())
-                        packet.TransmitTime = now
+            packet = message.Packet()
+            packet.add_message(msg, srcnode, dstnode,
+                               self.next_sequence_number(),
+                               self.CompactEncoding)
+            packet.TransmitTime = now
+            data = packet.pack()
 
-                        if packet.IsReliable:
-                            self.PendingAckMap[packet.SequenceNumber] = packet
+            if self._sendstream(packet, data, dstnode):
+                continue
 
-                        self._dowrite(packet.pack(), dstnode)
+            if len(data) > self.MaximumPacketSize:
+                self._sendfragments(packet, data, dstnode)
+                continue
 
-            dstnodes = newnodes
+            if packet.IsReliable:
+                self._pendack(packet)
 
-    def _timercleanup(self, now):
-        """A periodic handler that performs a variety of cleanup operations
-        including checks for dropped packets.
+            if self.CoalescePackets:
+                self._bundle(bundles, dstnode, data)
+            else:
+                self._dowrite(data, dstnode)
+
+        for dstnode, bundle in bundles.itervalues():
+            self._writebundle(bundle, dstnode)
+
+    def _sendstream(self, packet, data, dstnode):
+        """Send a packet for a bulk lane, or one that does not fit in a
+        datagram, over the stream connection to a peer. A connection is
+        opened for later packets if there is none.
+
+        Args:
+            packet (Packet): The packet to send.
+            data (bytes): The packed packet.
+            dstnode (Node): The destination of the packet.
+
+        Returns:
+            bool: Whether the packet was sent.
+        """
+        if self.StreamTransport is None or not dstnode.is_peer:
+            return False
+
+        if packet.Message.DispatchLane not in self.StreamLanes and \
+                len(data) <= self.MaximumPacketSize:
+            return False
+
+        if not self.StreamTransport.is_connected(dstnode.Identifier):
+            self.StreamTransport.connect(dstnode)
+            return False
+
+        # the stream is reliable so the packet needs no ack, unless it
+        # falls back to a datagram
+        reliable = packet.IsReliable
+        packet.IsReliable = False
+        if self.StreamTransport.send(packet.pack(), dstnode):
+            return True
+
+        packet.IsReliable = reliable
+        return False
+
+    def _sendfragments(self, packet, data, dstnode):
+        """Send a packet that does not fit in a datagram as fragments,
+        each of which is acknowledged on its own.
 
         Args:
+            packet (Packet): The packet to send.
+            data (bytes): The packed packet.
+            dstnode (Node): The destination of the packet.
+        """
+        fragments = message.PacketFragment.split(packet, data,
+                                                 self.MaximumPacketSize)
+        if len(fragments) > self.MaximumFragments:
+            logger.error('attempt to send a message of %d bytes, beyond '
+                         'the maximum number of fragments', len(data))
+            return
+
+        for fragment in fragments:
+            fragment.SequenceNumber = self.next_sequence_number()
+            fragment.TransmitTime = packet.TransmitTime
+            if fragment.IsReliable:
+                self._pendack(fragment)
+
+            self.PacketStats.FragmentsSent.increment()
+            self._dowrite(fragment.pack(), dstnode)
+
+    def _resendfragment(self, fragment, now):
+        """Send a fragment again after its ack did not arrive in time.
+
+        Args:
+            fragment (PacketFragment): The unacknowledged fragment.
             now (float): Current time.
+
+        Returns:
+            bool: False if the fragment was given up on, together with the
+                other fragments of its packet.
         """
-        if now < self.NextCleanup:
+        dstnode = self.NodeMap.get(fragment.DestinationID)
+        if dstnode is None or fragment.Retries >= self.MaximumFragmentRetries:
+            for (seqno, other) in self.PendingAckMap.items():
+                if other is not fragment and \
+                        isinstance(other, message.PacketFragment) and \
+                        other.PacketID == fragment.PacketID:
+                    del self.PendingAckMap[seqno]
+            return False
+
+        fragment.Retries += 1
+        fragment.TransmitTime = now
+        fragment.RoundTripEstimate = min(dstnode.Estimator.MaximumRTO,
+                                         fragment.RoundTripEstimate * 2)
+
+        self._pendack(fragment)
+
+        self.PacketStats.FragmentsResent.increment()
+        self._dowrite(fragment.pack(), dstnode)
+        return True
+
+    def _bundle(self, bundles, dstnode, data):
+        """Add a packet to the bundle for a node, sending the bundle first
+        if the packet does not fit.
+
+        Args:
+            bundles (dict): The open bundle for each node by identifier.
+            dstnode (Node): The destination of the packet.
+            data (bytes): The packed packet.
+        """
+        (_, bundle) = bundles.get(dstnode.Identifier, (dstnode, None))
+        if bundle is None:
+            bundle = self._newbundle(dstnode)
+
+        if not bundle.fits(data, self.MaximumPacketSize):
+            self._writebundle(bundle, dstnode)
+            bundle = message.PacketBundle(self.LocalNode.Identifier)
+
+        # a packet too large for any bundle goes out on its own
+        if bundle.fits(data, self.MaximumPacketSize):
+            bundle.add_packet(data)
+        else:
+            self._dowrite(data, dstnode)
+
+        bundles[dstnode.Identifier] = (dstnode, bundle)
+
+    def _pendack(self, packet):
+        """Hold a reliable packet until it is acknowledged, or treated as
+        dropped once its round trip estimate has passed.
+
+        Args:
+            packet (Packet): The packet that was sent.
+        """
+        self.PendingAckMap[packet.SequenceNumber] = packet
+        self._ackexpiry[packet.SequenceNumber] = \
+            packet.TransmitTime + packet.RoundTripEstimate
+        self._armretransmit()
+
+    def _armretransmit(self):
+        """Arm the retransmit timer for the time the next unacknowledged
+        packet is due.
+        """
+        exptime = self._ackexpiry.next_expiration()
+        if exptime is None:
             return
 
-        if len(self.PendingAckMap):
-            logger.debug("clean up processing %d unacked packets",
-                         len(self.PendingAckMap))
+        timer = self._retransmittimer
+        if timer is not None and timer.active():
+            if timer.getTime() <= exptime:
+                return
+            timer.cancel()
 
-        self.NextCleanup = now + self.CleanupInterval
+        self._retransmittimer = reactor.callLater(
+            max(0.0, exptime - time.time()), self._retransmitexpired)
+
+    def _retransmitexpired(self):
+        """Handle the unacknowledged packets that are due when the
+        retransmit timer fires.
+        """
+        self._retransmittimer = None
+        try:
+            self._retransmit(time.time())
+        except:
+            logger.exception('unhandled error occured during retransmission')
 
-        # Process packet retransmission
-        deleteq = []
-        for seqno, packet in self.PendingAckMap.iteritems():
-            if (packet.TransmitTime + packet.RoundTripEstimate) < now:
-                deleteq.append((seqno, packet))
+    def _retransmit(self, now):
+        """Resend or treat as dropped the packets whose acknowledgements
+        did not arrive in time.
+
+        Args:
+            now (float): Current time.
+        """
+        for seqno in self._ackexpiry.expire(now):
+            # skip the packets acknowledged or given up on with an earlier
+            # fragment
+            packet = self.PendingAckMap.get(seqno)
+            if packet is None:
+                continue
+
+            if isinstance(packet, message.PacketFragment) and \
+                    self._resendfragment(packet, now):
+                continue
 
-        for (seqno, packet) in deleteq:
             logger.debug('packet %d has been marked as dropped', seqno)
 
             self.PacketStats.DroppedPackets.increment()
@@ -581,22 +1378,42 @@ class Gossip(object, DatagramProtocol):
             if packet.DestinationID in self.NodeMap:
                 dstnode = self.NodeMap[packet.DestinationID]
                 dstnode.message_dropped(packet.Message, now)
+                self._scheduletransmit(dstnode, now)
 
             # and remove it from our saved queue
             del self.PendingAckMap[seqno]
 
-        # Clean up information about old messages handled, this is a hack to
-        # reduce memory utilization and does create an opportunity for spurious
-        # duplicate messages to be processed. Should be fixed for production
-        # use
-        deleteq = []
-        for msgid in self.MessageHandledMap.keys():
-            exptime = self.MessageHandledMap[msgid]
-            if exptime < now:
-                deleteq.append(msgid)
+        self._armretransmit()
+
+    def _timercleanup(self, now):
+        """A periodic handler that performs a variety of cleanup operations
+        including checks for dropped packets.
+
+        Args:
+            now (float): Current time.
+        """
+        if now < self.NextCleanup:
+            return
+
+        self.NextCleanup = now + self.CleanupInterval
 
-        for msgid in deleteq:
-            del self.MessageHandledMap[msgid]
+        self._retransmit(now)
+
+        # forget the handled messages that are old enough not to be
+        # received again
+        self.MessageHandledMap.expire(now)
+        self._handleddigests.expire(now)
+
+        # drop the buffers of packets whose fragments stopped arriving
+        for key in self._reassembly.keys():
+            (exptime, _, parts) = self._reassembly[key]
+            if exptime < now:
+                if parts is not None:
+                    logger.debug('missing fragments of packet %d from %s',
+                                 key[1], key[0][:8])
+                    self.PacketStats.ReassemblyTimeouts.increment()
+                    self._releasereassembly(key[0])
+                del self._reassembly[key]
 
     def _keepalive(self, now):
         """A periodic handler that sends a keep alive message to all peers.
@@ -618,9 +1435,27 @@ class Gossip(object, DatagramProtocol):
                             node, node.MissedTicks)
                 self.drop_node(node.Identifier)
 
+    def _busysignal(self, now):
+        """A periodic handler that asks peers to hold back their traffic
+        while the message queue is saturated.
+
+        Args:
+            now (float): Current time.
+        """
+        if now < self.NextBusySignal or not self.MessageQueue.Saturated:
+            return
+
+        # signal again shortly before the peers resume sending
+        self.NextBusySignal = now + self.BusyHoldTime * 0.8
+        self.DispatchStats.BusySignals.increment()
+        logger.info('message queue is saturated, ask peers to hold traffic')
+        self.forward_message(
+            busy_message.BusyMessage({'HoldTime': self.BusyHoldTime}))
+
     def _dispatcher(self):
         while self.ProcessIncomingMessages:
-            msg = self.MessageQueue.pop()
+            (lane, msg) = self.MessageQueue.take()
+            start = time.time()
             try:
                 if msg and msg.MessageType in self.MessageHandlerMap:
                     self.MessageHandlerMap[msg.MessageType][1](msg, self)
@@ -631,6 +1466,8 @@ class Gossip(object, DatagramProtocol):
                 logger.exception(
                     'unexpected error handling message of type %s',
                     msg.MessageType)
+            finally:
+                self.MessageQueue.done(lane, time.time() - start)
 
     # --------------------------------- ###
     # Locally defined interface methods ###
@@ -652,6 +1489,9 @@ class Gossip(object, DatagramProtocol):
         # that we just queued up
         self.ProcessIncomingMessages = False
         self.MessageQueue.appendleft(None)
+        self.SignatureVerifier.close()
+        if self.StreamTransport is not None:
+            self.StreamTransport.close()
 
     def register_message_handler(self, msg, handler):
         """Register a function to handle incoming messages for the
@@ -663,6 +1503,7 @@ class Gossip(object, DatagramProtocol):
                 that type arrive.
         """
         self.MessageHandlerMap[msg.MessageType] = (msg, handler)
+        wire_codec.register_type(msg)
 
     def clear_message_handler(self, msg):
         """Remove any handlers associated with incoming messages for the
@@ -725,6 +1566,13 @@ class Gossip(object, DatagramProtocol):
         except:
             pass
 
+        timer = self._transmittimers.pop(peerid, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
+        if self.StreamTransport is not None:
+            self.StreamTransport.disconnect(peerid)
+
     def forward_message(self, msg, exceptions=None, initialize=True):
         """Forward a previously received message on to our peers.
 
@@ -14,15 +14,17 @@
 # ------------------------------------------------------------------------------
 
 """
-This module defines the Packet and Message classes, which are responsible
-for representing data transmissions in the gossip protocol.
+This module defines the Packet, PacketBundle, PacketFragment and Message
+classes, which are responsible for representing data transmissions in the
+gossip protocol.
 """
 
 import logging
 import struct
 import time
 
-from gossip.common import cbor2dict, dict2cbor
+from gossip import wire_codec
+from gossip.common import cbor2dict
 from gossip.signed_object import SignedObject
 
 logger = logging.getLogger(__name__)
@@ -99,14 +101,21 @@ class Packet(object):
 
         return packet
 
-    def add_message(self, msg, src, dst, seqno):
+    def add_message(self, msg, src, dst, seqno, compact=False):
         """Resets the Packet with the attributes of the Message.
 
+        The canonical encoding is the one built when the message was last
+        signed, fields changed in place since then are only sent once it
+        is signed again. The compact encoding is built from the fields
+        the first time the message is sent.
+
         Args:
             msg (message.Message): The message to apply to the packet.
             src (Node): The source node of the packet.
             dst (Node): The destination node of the packet.
             seqno (int): The sequence number of the packet.
+            compact (bool): Whether to use the compact wire encoding for
+                the message.
         """
         self.IsAcknowledgement = False
 
@@ -120,7 +129,7 @@ class Packet(object):
         self.RoundTripEstimate = dst.Estimator.RTO
 
         self.Message = msg
-        self.Data = repr(msg)
+        self.Data = msg.compact() if compact else repr(msg)
 
     def unpack(self, databuf):
         """Resets the Packet with the contents of a packed object.
@@ -157,16 +166,271 @@ class Packet(object):
         return header + self.Data
 
 
+class PacketBundle(object):
+    """The PacketBundle class packs several packets for the same peer and
+    acknowledgements for packets received from it into one datagram.
+
+    The bundle header starts with a marker that is larger than any time to
+    live, so a bundle can be told apart from a single packet. The header
+    is followed by the acknowledged sequence numbers and then by each
+    packed packet with its length.
+
+    Attributes:
+        HeaderFormat (str): A struct packed format string for the header
+            of the bundle.
+        Marker (str): The first bytes of every bundle.
+        SenderID (str): The identifier for the node that sent the bundle.
+        Acks (list): The sequence numbers of acknowledged packets.
+        Packets (list): The packed packets in the bundle.
+    """
+
+    HeaderFormat = '!4s36sHH'
+    Marker = '\xffGPB'
+
+    def __init__(self, sender=''):
+        """Constructor for the PacketBundle class.
+
+        Args:
+            sender (str): The identifier for the sending node.
+        """
+        self.SenderID = sender
+        self.Acks = []
+        self.Packets = []
+        self._size = struct.calcsize(self.HeaderFormat)
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def is_bundle(cls, databuf):
+        """Determines whether a datagram holds a bundle.
+
+        Args:
+            databuf (bytes): The contents of the datagram.
+        """
+        return databuf[:len(cls.Marker)] == cls.Marker
+
+    def fits(self, data, limit):
+        """Determines whether a packed packet can be added without the
+        bundle growing beyond a size.
+
+        Args:
+            data (bytes): The packed packet.
+            limit (int): The maximum size of the bundle.
+        """
+        return self._size + 2 + len(data) <= limit
+
+    def add_ack(self, seqno):
+        """Adds an acknowledgement to the bundle.
+
+        Args:
+            seqno (int): The sequence number of the received packet.
+        """
+        self.Acks.append(seqno)
+        self._size += 4
+
+    def add_packet(self, data):
+        """Adds a packed packet to the bundle.
+
+        Args:
+            data (bytes): The packed packet.
+        """
+        self.Packets.append(data)
+        self._size += 2 + len(data)
+
+    def pack(self):
+        """Builds the datagram for the bundle.
+
+        Returns:
+            bytes: The packed bundle.
+        """
+        parts = [struct.pack(self.HeaderFormat, self.Marker,
+                             str(self.SenderID), len(self.Acks),
+                             len(self.Packets))]
+        parts.append(struct.pack('!{0}L'.format(len(self.Acks)), *self.Acks))
+        for data in self.Packets:
+            parts.append(struct.pack('!H', len(data)))
+            parts.append(data)
+        return ''.join(parts)
+
+    def unpack(self, databuf):
+        """Resets the bundle with the contents of a datagram.
+
+        Args:
+            databuf (bytes): A packed bundle.
+        """
+        offset = struct.calcsize(self.HeaderFormat)
+        (_, senderid, nacks, npackets) = struct.unpack(
+            self.HeaderFormat, databuf[:offset])
+        self.SenderID = senderid.rstrip('\0')
+
+        self.Acks = list(struct.unpack(
+            '!{0}L'.format(nacks), databuf[offset:offset + 4 * nacks]))
+        offset += 4 * nacks
+
+        self.Packets = []
+        for _ in xrange(npackets):
+            (size, ) = struct.unpack('!H', databuf[offset:offset + 2])
+            offset += 2
+            if offset + size > len(databuf):
+                raise ValueError('truncated packet bundle')
+            self.Packets.append(databuf[offset:offset + size])
+            offset += size
+
+        self._size = offset
+
+
+class PacketFragment(object):
+    """The PacketFragment class carries a part of a packet that is larger
+    than a datagram. Every fragment has its own sequence number and is
+    acknowledged on its own, so only the missing fragments of a packet
+    are sent again.
+
+    Attributes:
+        HeaderFormat (str): A struct packed format string for the header
+            of the fragment.
+        Marker (str): The first bytes of every fragment.
+        SenderID (str): The identifier for the node that sent the
+            fragment.
+        SequenceNumber (int): The sequence number of the fragment.
+        PacketID (int): The sequence number of the fragmented packet.
+        Index (int): The position of the fragment in the packet.
+        Count (int): The number of fragments in the packet.
+        Data (str): The part of the packed packet in the fragment.
+        IsReliable (bool): Whether the fragment must be acknowledged.
+        TransmitTime (float): The time the fragment was last transmitted.
+        RoundTripEstimate (float): An estimate of the round trip time to
+            the destination.
+        Retries (int): The number of times the fragment was sent again.
+        DestinationID (str): The identifier for the node that is
+            intended to receive this fragment.
+        Message (Message): The message in the fragmented packet.
+    """
+
+    HeaderFormat = '!4s36sLLHH?'
+    Marker = '\xffGPF'
+
+    def __init__(self):
+        """Constructor for the PacketFragment class.
+        """
+        self.SenderID = '========================'
+        self.SequenceNumber = 0
+        self.PacketID = 0
+        self.Index = 0
+        self.Count = 0
+        self.Data = ''
+        self.IsReliable = True
+
+        # bookkeeping properties
+        self.TransmitTime = 0.0
+        self.RoundTripEstimate = 0.0
+        self.Retries = 0
+        self.DestinationID = '========================'
+        self.Message = None
+
+    def __str__(self):
+        return "FRG:{0}:{1}:{2}".format(self.SenderID[:8], self.PacketID,
+                                        self.Index)
+
+    @classmethod
+    def is_fragment(cls, databuf):
+        """Determines whether a datagram holds a fragment.
+
+        Args:
+            databuf (bytes): The contents of the datagram.
+        """
+        return databuf[:len(cls.Marker)] == cls.Marker
+
+    @classmethod
+    def split(cls, packet, data, size):
+        """Splits a packed packet into fragments.
+
+        Args:
+            packet (Packet): The packet, used for its bookkeeping fields.
+            data (bytes): The packed packet.
+            size (int): The maximum size of a packed fragment.
+
+        Returns:
+            list: The fragments, without sequence numbers.
+        """
+        step = size - struct.calcsize(cls.HeaderFormat)
+        count = (len(data) + step - 1) // step
+
+        fragments = []
+        for index in xrange(count):
+            fragment = cls()
+            fragment.SenderID = packet.SenderID
+            fragment.PacketID = packet.SequenceNumber
+            fragment.Index = index
+            fragment.Count = count
+            fragment.Data = data[index * step:(index + 1) * step]
+            fragment.IsReliable = packet.IsReliable
+            fragment.RoundTripEstimate = packet.RoundTripEstimate
+            fragment.DestinationID = packet.DestinationID
+            fragment.Message = packet.Message
+            fragments.append(fragment)
+        return fragments
+
+    def create_ack(self, sender):
+        """Creates an acknowledgement Packet for the fragment.
+
+        Args:
+            sender (str): An identifier for the sending node.
+
+        Returns:
+            Packet: An acknowledgement Packet with the sequence number of
+                this fragment.
+        """
+        packet = Packet()
+        packet.SequenceNumber = self.SequenceNumber
+        return packet.create_ack(sender)
+
+    def unpack(self, databuf):
+        """Resets the fragment with the contents of a datagram.
+
+        Args:
+            databuf (bytes): A packed fragment.
+        """
+        size = struct.calcsize(self.HeaderFormat)
+        (_, senderid, seqno, packetid, index, count, rflag) = \
+            struct.unpack(self.HeaderFormat, databuf[:size])
+        if index >= count:
+            raise ValueError('fragment index out of range')
+
+        self.SenderID = senderid.rstrip('\0')
+        self.SequenceNumber = seqno
+        self.PacketID = packetid
+        self.Index = index
+        self.Count = count
+        self.IsReliable = rflag
+        self.Data = databuf[size:]
+
+    def pack(self):
+        """Builds the datagram for the fragment.
+
+        Returns:
+            bytes: The packed fragment.
+        """
+        header = struct.pack(self.HeaderFormat, self.Marker,
+                             str(self.SenderID), self.SequenceNumber,
+                             self.PacketID, self.Index, self.Count,
+                             self.IsReliable)
+        return header + self.Data
+
+
 def unpack_message_data(data):
     """Unpacks CBOR encoded data into a dict.
 
     Args:
-        data (bytes): CBOR encoded data.
+        data (bytes): CBOR encoded data, canonical or with the compact
+            wire encoding.
 
     Returns:
         dict: A dict reflecting the contents of the CBOR encoded
             representation.
     """
+    if wire_codec.is_compact(data):
+        return wire_codec.decode(data)
     return cbor2dict(data)
 
 
@@ -176,6 +440,8 @@ class Message(SignedObject):
 
     Attributes:
         Message.MessageType (str): The class name of the message.
+        Message.DispatchLane (str): The name of the dispatch lane that
+            handles the message, None to pick one from IsSystemMessage.
         DefaultTimeToLive (int): The default number of hops that the
             message is considered alive.
         Nonce (float): A locally unique value generated by the message
@@ -190,10 +456,16 @@ class Message(SignedObject):
         IsReliable (bool): Whether reliable delivery is required.
         TimeToLive (int): The configured number of hops that the message
             is considered alive.
+        WireDigest (bytes): The digest of the packet data the message was
+            received in, None for a message created locally.
     """
     MessageType = "/gossip.Message/MessageBase"
+    DispatchLane = None
     DefaultTimeToLive = 2 ** 31
 
+    _serialized = SignedObject._serialized + ('_compact', )
+    _transient = frozenset(['SenderID', 'TimeToLive', 'WireDigest'])
+
     def __init__(self, minfo=None):
         """Constructor for the Message class.
 
@@ -214,21 +486,41 @@ class Message(SignedObject):
         self.IsReliable = True
 
         self.TimeToLive = self.DefaultTimeToLive
-
-        self._data = None
+        self.WireDigest = None
 
     def __str__(self):
         return "MSG:{0}:{1}".format(self.OriginatorID[:8], self.Identifier[:8])
 
     def __repr__(self):
-        if not self._data:
-            self._data = self.serialize()
-        return self._data
+        return self.serialize()
+
+    def compact(self):
+        """Returns the message with the compact wire encoding from
+        gossip.wire_codec, or the canonical encoding for a message type
+        that has no schema.
+
+        Returns:
+            bytes: The encoded message.
+        """
+        if self._compact is None:
+            try:
+                self._compact = wire_codec.encode(self.dump())
+            except ValueError:
+                self._compact = repr(self)
+        return self._compact
 
     def __len__(self):
-        if not self._data:
-            self._data = dict2cbor(self.dump())
-        return len(self._data)
+        return len(self.serialize())
+
+    def signed_objects(self):
+        """Returns the signed objects carried by the message, including the
+        message itself, whose signatures are verified before the message
+        is handled.
+
+        Returns:
+            list: A list of SignedObjects.
+        """
+        return [self]
 
     def dump(self):
         """Builds a dict containing base object key/values and message type
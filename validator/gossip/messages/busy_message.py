@@ -0,0 +1,96 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module implements a BusyMessage class derived from Message that a
+node sends to its peers when its inbound message queue is saturated. It
+also defines the handler that holds back traffic to the busy peer.
+"""
+
+import logging
+
+from gossip import message
+
+logger = logging.getLogger(__name__)
+
+
+def register_message_handlers(gossiper):
+    """Registers the busy message handler for a node.
+
+    Args:
+        gossiper (Node): The node to register message handlers on.
+    """
+    gossiper.register_message_handler(BusyMessage, busy_handler)
+
+
+class BusyMessage(message.Message):
+    """Busy messages ask a peer to stop sending anything but system
+    messages for a while.
+
+    Attributes:
+        BusyMessage.MessageType (str): The class name of the message.
+        HoldTime (float): The number of seconds the peer should hold back
+            its traffic.
+        IsSystemMessage (bool): Whether or not this is a system message.
+            System messages have special delivery priority rules.
+        IsForward (bool): Whether the message should be automatically
+            forwarded.
+        IsReliable (bool): Whether reliable delivery is required.
+    """
+    MessageType = "/gossip.messages.BusyMessage/Busy"
+
+    def __init__(self, minfo=None):
+        """Constructor for the BusyMessage class.
+
+        Args:
+            minfo (dict): Dictionary of values for message fields.
+        """
+        if minfo is None:
+            minfo = {}
+        super(BusyMessage, self).__init__(minfo)
+
+        self.HoldTime = minfo.get('HoldTime', 1.0)
+
+        # a lost busy message is repeated while the node stays busy
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = False
+
+    def dump(self):
+        """Dumps a dict containing object attributes.
+
+        Returns:
+            dict: A mapping of object attribute names to values.
+        """
+        result = super(BusyMessage, self).dump()
+        result['HoldTime'] = self.HoldTime
+        return result
+
+
+def busy_handler(msg, gossiper):
+    """Handles busy messages by emptying the token bucket of the peer that
+    sent it, so only system messages go to the peer until the hold time
+    has passed.
+
+    Args:
+        msg (message.Message): The received busy message.
+        gossiper (Node): The local node.
+    """
+    peer = gossiper.NodeMap.get(msg.OriginatorID)
+    if peer is None:
+        return
+
+    logger.debug('peer %s is busy, hold traffic for %s seconds', peer,
+                 msg.HoldTime)
+    peer.TokenBucket.hold(min(msg.HoldTime, gossiper.MaximumBusyHoldTime))
@@ -14,8 +14,8 @@
 # ------------------------------------------------------------------------------
 """
 This module implements classes derived from Message for representing
-connection requests, connection replies, disconnection requests, and
-keep alives. It also defines handler methods to be called when these
+connection requests, connection replies, disconnection requests, prune
+requests and keep alives. It also defines handler methods to be called when these
 message types arrive.
 """
 
@@ -25,6 +25,9 @@ from gossip import common, message, node
 
 logger = logging.getLogger(__name__)
 
+# a node gives up a link on request only while it keeps more peers than this
+MinimumPruneConnectivity = 2
+
 
 def send_connection_request(gossiper, peer):
     """Sends a connection request (syn message) to a candidate peer node.
@@ -60,6 +63,8 @@ def register_message_handlers(gossiper):
                                       connect_syn_ack_handler)
     gossiper.register_message_handler(DisconnectRequestMessage,
                                       disconnect_request_handler)
+    gossiper.register_message_handler(PruneRequestMessage,
+                                      prune_request_handler)
     gossiper.register_message_handler(KeepAliveMessage, keep_alive_handler)
 
 
@@ -349,6 +354,73 @@ def disconnect_request_handler(msg, gossiper):
         gossiper.drop_node(msg.OriginatorID)
 
 
+class PruneRequestMessage(message.Message):
+    """Prune request messages ask a peer to agree to close the connection,
+    so that a node can replace a costly link with a better one.
+
+    Attributes:
+        PruneRequestMessage.MessageType (str): The class name of the
+            message.
+        IsSystemMessage (bool): Whether or not this is a system message.
+            System messages have special delivery priority rules.
+        IsForward (bool): Whether the message should be automatically
+            forwarded.
+        IsReliable (bool): Whether reliable delivery is required.
+    """
+    MessageType = "/gossip.messages.ConnectMessage/PruneRequest"
+
+    def __init__(self, minfo=None):
+        """Constructor for the PruneRequestMessage class.
+
+        Args:
+            minfo (dict): Dictionary of values for message fields.
+        """
+        if minfo is None:
+            minfo = {}
+        super(PruneRequestMessage, self).__init__(minfo)
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        """Dumps a dict containing object attributes.
+
+        Returns:
+            dict: A mapping of object attribute names to values.
+        """
+        return super(PruneRequestMessage, self).dump()
+
+
+def prune_request_handler(msg, gossiper):
+    """Handles prune request events.
+
+    The request is refused while this node has no more than
+    MinimumPruneConnectivity other peers, so a node that all of its
+    neighbors find costly is not cut off from the network. Otherwise the
+    node agrees with a disconnection request, which makes the requester
+    drop it, and stops treating the requester as a peer. The requester is
+    dropped once its keep alives stop.
+
+    Args:
+        msg (message.Message): The received prune request message.
+        gossiper (Node): The local node.
+    """
+    peer = gossiper.NodeMap.get(msg.OriginatorID)
+    if peer is None:
+        return
+
+    others = gossiper.peer_list(exceptions=[msg.OriginatorID])
+    if len(others) <= MinimumPruneConnectivity:
+        logger.info('refuse prune request from %s, %d other peers', peer,
+                    len(others))
+        return
+
+    logger.info('accept prune request from %s', peer)
+    gossiper.send_message(DisconnectRequestMessage(), msg.OriginatorID)
+    peer.is_peer = False
+
+
 class KeepAliveMessage(message.Message):
     """Keep alive messages represent a request from a node to keep the
     connection alive.
@@ -23,8 +23,6 @@ import random
 import time
 from threading import Lock
 
-from heapq import heappop, heappush, heapify
-
 import pybitcointools
 
 from gossip import stats
@@ -46,7 +44,11 @@ class Node(object):
         Estimator (RoundTripEstimator): tracks network timing between nodes.
         MessageQ (TransmissionQueue): a transmission queue ordered by time
             to send.
-        TokenBucket (token_bucket): limits the average rate of data flow.
+        QueueDelay (stats.Histogram): the time in seconds that messages
+            sent to the node spent in the transmission queue.
+        TokenBucket (token_bucket.AdaptiveTokenBucket): limits the
+            average rate of data flow, adapting the rate to the
+            acknowledged traffic and the losses.
         FixedRandomDelay (float): a random delay in the range of DelayRange.
         Delay (float): a random delay for the node using either a uniform
             or an exponential distribution depending on the value of the
@@ -68,6 +70,7 @@ class Node(object):
     UseFixedDelay = True
     DelayRange = [0.1, 0.4]
     DistributionLambda = 10.0
+    QueueDelayBounds = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
 
     def __init__(self,
                  address=(None, None),
@@ -76,7 +79,8 @@ class Node(object):
                  name=None,
                  rate=None,
                  capacity=None,
-                 endpoint_address=(None, None)):
+                 endpoint_address=(None, None),
+                 maximum_rate=None):
         """Constructor for the Node class.
 
         Args:
@@ -86,15 +90,17 @@ class Node(object):
             identifier (str): an identifier for the node.
             signingkey (str): used to create a signing key, in PEM format.
             name (str): a short, human-readable name for the node.
-            rate (int): the number of tokens to be added to the TokenBucket
-                per drip.
-            capacity (int): the total capacity of tokens in the node's
+            rate (int): the initial number of tokens to be added to the
+                TokenBucket per second.
+            capacity (int): the initial capacity of tokens in the node's
                 TokenBucket.
             endpoint_address (ordered pair of str, int): the publicly-
                 reachable address of the node in the form of (host, port).
                 If the node is publicly-reachable, this should be the same as
                 address.  If not, this is the address at the NAT used to route
                 to address.
+            maximum_rate (int): the limit of the number of tokens added to
+                the TokenBucket per second as the rate adapts.
         """
 
         self.NetHost = address[0]
@@ -110,7 +116,10 @@ class Node(object):
 
         self.Estimator = RoundTripEstimator()
         self.MessageQ = TransmissionQueue()
-        self.TokenBucket = token_bucket.TokenBucket(rate, capacity)
+        self.QueueDelay = stats.Histogram('MessageQueueDelay',
+                                          self.QueueDelayBounds)
+        self.TokenBucket = token_bucket.AdaptiveTokenBucket(rate, capacity,
+                                                            maximum_rate)
 
         self.FixedRandomDelay = random.uniform(*self.DelayRange)
         if self.UseFixedDelay:
@@ -168,6 +177,9 @@ class Node(object):
     def _fixeddelay(self):
         return self.FixedRandomDelay
 
+    def _timetosend(self, msg, now):
+        return 0 if msg.IsSystemMessage else now + self.Delay()
+
     def initialize_stats(self, localnode):
         """Initializes statistics collection for the node.
 
@@ -183,8 +195,11 @@ class Node(object):
                                            lambda: str(self.MessageQ)))
         self.Stats.add_metric(stats.Sample('MessageQueueLength',
                                            lambda: self.MessageQ.Count))
+        self.Stats.add_metric(self.QueueDelay)
         self.Stats.add_metric(stats.Sample('RoundTripEstimate',
                                            lambda: self.Estimator.RTO))
+        self.Stats.add_metric(stats.Sample('SendRate',
+                                           lambda: self.TokenBucket.DripRate))
 
     def enqueue_message(self, msg, now):
         """Enqueue a message for future delivery.
@@ -198,8 +213,7 @@ class Node(object):
             now (float): the current time.
 
         """
-        timetosend = 0 if msg.IsSystemMessage else now + self.Delay()
-        self.MessageQ.enqueue_message(msg, timetosend)
+        self.MessageQ.enqueue_message(msg, self._timetosend(msg, now))
 
     def dequeue_message(self, msg):
         """Remove a message from the transmission queue.
@@ -233,14 +247,33 @@ class Node(object):
             (timetosend, msg) = info
             if timetosend < now:
                 if msg.IsSystemMessage or self.TokenBucket.consume(len(msg)):
-                    self.MessageQ.dequeue_message(msg)
+                    delay = self.MessageQ.dequeue_message(msg)
+                    if delay is not None:
+                        self.QueueDelay.add_value(delay)
                     return msg
 
         return None
 
+    def next_send_time(self):
+        """Returns the time when the message at the head of the queue can
+        be sent, given the tokens in the token bucket.
+
+        Returns:
+            float: the time to send, or None if the queue is empty.
+        """
+        info = self.MessageQ.Head
+        if info is None:
+            return None
+
+        (timetosend, msg) = info
+        if msg.IsSystemMessage:
+            return timetosend
+
+        return max(timetosend, self.TokenBucket.ready_time(len(msg)))
+
     def message_delivered(self, msg, rtt):
-        """Updates the RoundTripEstimator based on packet round trip
-        time and dequeues the specified message.
+        """Updates the RoundTripEstimator and the send rate based on
+        packet round trip time and dequeues the specified message.
 
         Args:
             msg (message): the message to remove.
@@ -248,12 +281,14 @@ class Node(object):
                 incoming packet.
         """
         self.Estimator.update(rtt)
+        if not msg.IsSystemMessage:
+            self.TokenBucket.delivered(len(msg), rtt)
         self.MessageQ.dequeue_message(msg)
 
     def message_dropped(self, msg, now=None):
-        """Updates the RoundTripEstimator based on the assertion that
-        the message has been dropped and re-enqueues the outgoing
-        message for re-delivery.
+        """Updates the RoundTripEstimator and cuts the send rate based on
+        the assertion that the message has been dropped and re-enqueues
+        the outgoing message for re-delivery.
 
         Args:
             msg (message): the message to re-send.
@@ -262,8 +297,9 @@ class Node(object):
         if not now:
             now = time.time()
 
+        self.TokenBucket.dropped(self.Estimator.RTO, now)
         self.Estimator.backoff()
-        self.enqueue_message(msg, now)
+        self.MessageQ.reschedule_message(msg, self._timetosend(msg, now))
 
     def reset_ticks(self):
         """Resets the MissedTicks counter to zero.
@@ -323,6 +359,16 @@ class RoundTripEstimator(object):
         self._SRTT = 0.0
         self._RTTVAR = 0.0
 
+    @property
+    def SRTT(self):
+        """Returns the smoothed round trip time in seconds, or None if no
+        round trip was measured since the last backoff. Unlike the RTO it
+        is not raised to MinimumRTO.
+        """
+        if self._RTTVAR == 0.0:
+            return None
+        return self._SRTT
+
     def update(self, measuredrto):
         """Updates estimator values based on measured round trip message
         time.
@@ -356,16 +402,16 @@ class RoundTripEstimator(object):
 
 class TransmissionQueue(object):
     """Implements a transmission queue ordered by time to send. A
-    heap is used to order message identifiers by transmission time.
-
-    Note:
-        The heap is not authoritative. Because messages can be queued
-        and dequeued, elements in the heap might become out of date.
+    binary heap orders message identifiers by transmission time and a
+    position map locates the heap entry of each message, so a message
+    can be removed or rescheduled in O(log n) time.
     """
 
     def __init__(self):
         self._messages = {}
-        self._times = {}  # this allows reinsertion of a message
+        self._times = {}
+        self._enqueued = {}
+        self._positions = {}
         self._heap = []
         self._lock = Lock()
 
@@ -381,7 +427,7 @@ class TransmissionQueue(object):
         """Adds a message to the transmission queue.
 
         At most one instance of a message can exist in the queue at a
-        time however multiple references may exist in the heap.
+        time.
 
         Args:
             msg (message): the message to send.
@@ -390,32 +436,53 @@ class TransmissionQueue(object):
         """
         with self._lock:
             messageid = msg.Identifier
-            if (messageid not in self._messages and
-                    messageid not in self._times):
-                self._messages[messageid] = msg
-                self._times[messageid] = timetosend
-
-                heappush(self._heap, (timetosend, messageid))
+            if messageid not in self._messages:
+                self._push(msg, timetosend)
             else:
                 logger.debug('tried to enqueue a message already '
                              'enqueued. messageid %s, self._messages %s',
                              messageid,
                              self._messages)
 
+    def reschedule_message(self, msg, timetosend):
+        """Changes the time to send a message, adding the message to the
+        transmission queue if it is not already there.
+
+        Args:
+            msg (message): the message to send.
+            timetosend (float): python time when message should be sent.
+        """
+        with self._lock:
+            messageid = msg.Identifier
+            if messageid not in self._messages:
+                self._push(msg, timetosend)
+                return
+
+            self._times[messageid] = timetosend
+            pos = self._positions[messageid]
+            self._heap[pos] = (timetosend, messageid)
+            self._siftup(pos)
+            self._siftdown(self._positions[messageid])
+
     def dequeue_message(self, msg):
         """Removes a message from the transmission queue if it exists.
 
-        Rebuild the heap if necessary, but do not explicitly remove
-        the entry from the heap.
-
         Args:
             msg (message): the message to remove.
+
+        Returns:
+            float: the number of seconds the message spent in the queue,
+                or None if the message was not queued.
         """
         with self._lock:
-            self._messages.pop(msg.Identifier, None)
-            self._times.pop(msg.Identifier, None)
+            messageid = msg.Identifier
+            if messageid not in self._messages:
+                return None
 
-            self._buildheap()
+            self._remove(self._positions[messageid])
+            del self._messages[messageid]
+            del self._times[messageid]
+            return time.time() - self._enqueued.pop(messageid)
 
     @property
     def Head(self):
@@ -423,14 +490,10 @@ class TransmissionQueue(object):
         when it should be sent.
         """
         with self._lock:
-            self._trimheap()
             if len(self._heap) == 0:
                 return None
 
             (timetosend, messageid) = self._heap[0]
-            assert messageid in self._messages
-            assert messageid in self._times
-
             return (timetosend, self._messages[messageid])
 
     @property
@@ -446,38 +509,65 @@ class TransmissionQueue(object):
         """
         return self._times.keys()
 
-    def _trimheap(self):
-        """
-        Remove entries in the heap that are no longer valid. Since the heap
-        is not rebuilt when messages are dequeued, there may be invalid
-        entries in the heap.
-        """
+    def _push(self, msg, timetosend):
+        messageid = msg.Identifier
+        self._messages[messageid] = msg
+        self._times[messageid] = timetosend
+        self._enqueued[messageid] = time.time()
 
-        while True:
-            # make sure we haven't emptied the heap
-            if len(self._heap) == 0:
-                return
-            (timetosend, messageid) = self._heap[0]
-
-            # and see if the pair in the heap holds the current tranmission
-            # time for the message id
-            if (messageid in self._times
-                    and self._times[messageid] == timetosend):
-                assert messageid in self._messages
-                return
+        self._heap.append((timetosend, messageid))
+        self._positions[messageid] = len(self._heap) - 1
+        self._siftup(len(self._heap) - 1)
 
-            heappop(self._heap)
-
-    def _buildheap(self):
+    def _remove(self, pos):
+        """Removes the heap entry at a position by moving the last entry
+        into its place and restoring the heap order around it.
         """
-        Rebuild the heap if necessary. This should only happen when
-        a large number of messages have been dequeued
+        (_, messageid) = self._heap[pos]
+        del self._positions[messageid]
+
+        last = self._heap.pop()
+        if pos < len(self._heap):
+            self._heap[pos] = last
+            self._positions[last[1]] = pos
+            self._siftup(pos)
+            self._siftdown(self._positions[last[1]])
+
+    def _siftup(self, pos):
+        """Moves the entry at a position toward the root until its parent
+        is not later than it.
         """
-
-        if 2 * len(self._times) < len(self._heap):
-            self._heap = []
-            for messageid, timetosend in self._times.iteritems():
-                assert messageid in self._messages
-                self._heap.append((timetosend, messageid))
-
-            heapify(self._heap)
+        heap = self._heap
+        entry = heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if heap[parent] <= entry:
+                break
+            heap[pos] = heap[parent]
+            self._positions[heap[pos][1]] = pos
+            pos = parent
+
+        heap[pos] = entry
+        self._positions[entry[1]] = pos
+
+    def _siftdown(self, pos):
+        """Moves the entry at a position toward the leaves until neither
+        child is earlier than it.
+        """
+        heap = self._heap
+        count = len(heap)
+        entry = heap[pos]
+        while True:
+            child = 2 * pos + 1
+            if child >= count:
+                break
+            if child + 1 < count and heap[child + 1] < heap[child]:
+                child += 1
+            if entry <= heap[child]:
+                break
+            heap[pos] = heap[child]
+            self._positions[heap[pos][1]] = pos
+            pos = child
+
+        heap[pos] = entry
+        self._positions[entry[1]] = pos
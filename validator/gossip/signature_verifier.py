@@ -0,0 +1,238 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the SignatureVerifier class which recovers the
+signers of incoming signed objects in batches. Public key recovery is the
+largest cost of handling a message, so with worker processes configured
+the batches are spread over a process pool rather than run on the reactor
+thread.
+"""
+
+from collections import deque
+import logging
+import multiprocessing
+import time
+
+import pybitcointools
+from twisted.internet import reactor
+
+from gossip import stats
+from gossip.signed_object import SignedObject
+from gossip.signed_object import get_verifying_key
+
+logger = logging.getLogger(__name__)
+
+
+def recover_addresses(items):
+    """Recovers the address of the signer for each serialized object and
+    signature pair. This runs in the worker processes.
+
+    Args:
+        items (list): A list of (serialized, signature) tuples.
+
+    Returns:
+        list: The address of each signer, None where the signature could
+            not be used to recover a key.
+    """
+    addresses = []
+    for (serialized, signature) in items:
+        try:
+            verifying_key = get_verifying_key(serialized, signature)
+        except:
+            verifying_key = None
+        addresses.append(pybitcointools.pubtoaddr(verifying_key)
+                         if verifying_key else None)
+    return addresses
+
+
+class _Batch(object):
+    """A group of submissions whose signatures are recovered together.
+    """
+
+    __slots__ = ['Entries', 'Items', 'Addresses']
+
+    def __init__(self, entries):
+        self.Entries = entries
+        self.Items = []
+        for (objects, _, _) in entries:
+            self.Items.extend(
+                (o.serialize(signable=True), o.Signature) for o in objects)
+        self.Addresses = None
+
+
+class SignatureVerifier(object):
+    """Recovers the signers of signed objects in batches.
+
+    Each submission is a list of signed objects and a callback that is
+    called on the reactor thread, in submission order, with True when
+    every signature is valid. Signers found in the signature cache are not
+    recovered again. Without worker processes the recovery happens
+    immediately on the calling thread.
+
+    Attributes:
+        Workers (int): The number of worker processes, 0 to recover keys
+            on the calling thread.
+        BatchSize (int): The number of signatures that triggers sending a
+            batch to the pool.
+        MaximumDelay (float): The number of seconds a signature waits for
+            its batch to fill.
+        VerifierStats (stats.Stats): Counters for the verifier.
+    """
+
+    def __init__(self, nodename, workers=0, batchsize=64, maxdelay=0.005):
+        """Constructor for the SignatureVerifier class.
+
+        Args:
+            nodename (str): The name of the local node, used for stats.
+            workers (int): The number of worker processes.
+            batchsize (int): The number of signatures in a full batch.
+            maxdelay (float): The longest time in seconds to wait for a
+                batch to fill.
+        """
+        self.Workers = workers
+        self.BatchSize = batchsize
+        self.MaximumDelay = maxdelay
+
+        self._pool = multiprocessing.Pool(workers) if workers > 0 else None
+        self._pending = []
+        self._pendingcount = 0
+        self._inflight = deque()
+        self._flushcall = None
+
+        self.VerifierStats = stats.Stats(nodename, 'signature')
+        self.VerifierStats.add_metric(stats.Counter('SignaturesRecovered'))
+        self.VerifierStats.add_metric(stats.Counter('SignatureCacheHits'))
+        self.VerifierStats.add_metric(stats.Counter('InvalidSignatures'))
+        self.VerifierStats.add_metric(stats.Counter('BatchesSent'))
+        self.VerifierStats.add_metric(stats.Average('BatchTime'))
+        self.VerifierStats.add_metric(stats.Sample(
+            'Backlog', lambda: self.Backlog))
+
+        # the signature cache is shared by every signed object
+        self.VerifierStats.add_metric(stats.Sample(
+            'CacheHits', lambda: SignedObject.signature_cache.hits))
+        self.VerifierStats.add_metric(stats.Sample(
+            'CacheMisses', lambda: SignedObject.signature_cache.misses))
+        self.VerifierStats.add_metric(stats.Sample(
+            'CacheSize', lambda: len(SignedObject.signature_cache)))
+
+    @property
+    def Backlog(self):
+        """Returns the number of submissions that wait for a result.
+        """
+        return len(self._pending) + sum(len(b.Entries) for b in self._inflight)
+
+    def submit(self, objects, callback):
+        """Verify the signatures on a list of signed objects.
+
+        Args:
+            objects (list): The SignedObjects to verify.
+            callback (function): Called with a bool once the signers of
+                all the objects are known.
+        """
+        valid = True
+        work = []
+        for obj in objects:
+            if not obj.Signature:
+                valid = False
+                continue
+            address = SignedObject.signature_cache.get(obj.SignatureDigest)
+            if address:
+                obj.set_originator_id(address)
+                self.VerifierStats.SignatureCacheHits.increment()
+            else:
+                work.append(obj)
+
+        # keep submissions in order once anything is waiting
+        if not work and not self._pending and not self._inflight:
+            self._finish(valid, callback)
+            return
+
+        self._pending.append((work, callback, valid))
+        self._pendingcount += len(work)
+
+        if self._pool is None or self._pendingcount >= self.BatchSize:
+            self.flush()
+        elif self._flushcall is None:
+            self._flushcall = reactor.callLater(self.MaximumDelay, self.flush)
+
+    def flush(self):
+        """Start recovering the signers of the pending submissions.
+        """
+        if self._flushcall is not None:
+            if self._flushcall.active():
+                self._flushcall.cancel()
+            self._flushcall = None
+
+        if not self._pending:
+            return
+
+        batch = _Batch(self._pending)
+        self._pending = []
+        self._pendingcount = 0
+        self._inflight.append(batch)
+        self.VerifierStats.BatchesSent.increment()
+
+        if self._pool is None:
+            batch.Addresses = recover_addresses(batch.Items)
+            self.drain()
+            return
+
+        # one slice per worker so that a batch uses the whole pool
+        size = max(1, -(-len(batch.Items) // self.Workers))
+        slices = [batch.Items[i:i + size]
+                  for i in xrange(0, len(batch.Items), size)]
+        start = time.time()
+
+        def completed(results):
+            # runs on the result thread of the pool
+            self.VerifierStats.BatchTime.add_value(time.time() - start)
+            batch.Addresses = [a for r in results for a in r]
+            reactor.callFromThread(self.drain)
+
+        self._pool.map_async(recover_addresses, slices, callback=completed)
+
+    def drain(self):
+        """Deliver the results of completed batches in submission order.
+        """
+        while self._inflight and self._inflight[0].Addresses is not None:
+            batch = self._inflight.popleft()
+            addresses = iter(batch.Addresses)
+            for (objects, callback, valid) in batch.Entries:
+                for obj in objects:
+                    address = next(addresses)
+                    if address:
+                        obj.set_originator_id(address)
+                        SignedObject.signature_cache[
+                            obj.SignatureDigest] = address
+                        self.VerifierStats.SignaturesRecovered.increment()
+                    else:
+                        valid = False
+                self._finish(valid, callback)
+
+    def _finish(self, valid, callback):
+        if not valid:
+            self.VerifierStats.InvalidSignatures.increment()
+        try:
+            callback(valid)
+        except:
+            logger.exception('unexpected error after verifying signatures')
+
+    def close(self):
+        """Stop the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
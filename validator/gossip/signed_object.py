@@ -18,9 +18,10 @@ This module defines the SignedObject class which processes and validates
 objects signed by a signing key.
 """
 
-from collections import deque
+from collections import OrderedDict
 import hashlib
 import logging
+import os
 from threading import Lock
 import pybitcointools
 
@@ -34,33 +35,99 @@ class LruCache(object):
     """
     A simple thread-safe lru cache of the recovered public key and address.
     This prevents multiple key recoveries on signed objects during validation.
+
+    Entries are kept in an OrderedDict in order of use, so lookups, inserts
+    and evictions take constant time.
+
+    Attributes:
+        max_size (int): The maximum number of entries.
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that did not.
     """
     def __init__(self, max_size=100):
         self.max_size = max_size
-        self.order = deque(maxlen=self.max_size)
-        self.values = {}
+        self.values = OrderedDict()
         self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.values)
 
     def __setitem__(self, key, value):
         with self.lock:
-            if key not in self.values:
-                while len(self.order) >= self.max_size:
-                    v = self.order.pop()
-                    del self.values[v]
-                self.values[key] = value
-                self.order.appendleft(key)
+            self.values.pop(key, None)
+            self.values[key] = value
+            self._evict()
 
     def __getitem__(self, key):
         return self.get(key)
 
+    def _evict(self):
+        while len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
     def get(self, key, default=None):
         with self.lock:
-            result = self.values.get(key, default)
+            result = self.values.pop(key, default)
             if result is not default:
-                self.order.remove(key)
-                self.order.appendleft(key)
+                self.values[key] = result
+                self.hits += 1
+            else:
+                self.misses += 1
         return result
 
+    def resize(self, max_size):
+        """Changes the maximum number of entries, dropping the least
+        recently used entries if there are too many.
+
+        Args:
+            max_size (int): The maximum number of entries.
+        """
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def save(self, filename):
+        """Writes the entries to a file, least recently used first.
+
+        Args:
+            filename (str): The name of the file.
+        """
+        with self.lock:
+            lines = ['{0} {1}\n'.format(k, v)
+                     for (k, v) in self.values.iteritems()]
+
+        # write a new file and rename it so that a crash never leaves a
+        # partial cache behind
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fp:
+            fp.writelines(lines)
+        os.rename(tmpname, filename)
+
+    def load(self, filename):
+        """Adds the entries written by save to the cache. A missing or
+        damaged file is ignored, the cache can always be rebuilt.
+
+        Args:
+            filename (str): The name of the file.
+
+        Returns:
+            int: The number of entries loaded.
+        """
+        count = 0
+        try:
+            with open(filename) as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) != 2:
+                        continue
+                    self[fields[0]] = fields[1]
+                    count += 1
+        except IOError:
+            logger.info('no signature cache found in %s', filename)
+        return count
+
 
 def generate_identifier(signingkey):
     """Generates encoded version of the public key associated with
@@ -127,13 +194,24 @@ def get_verifying_key(serialized_msg, serialized_sig):
 class SignedObject(object):
     """Implements a base class for processing & validating signed objects.
 
+    The serialized forms of the object are kept until one of its public
+    attributes is assigned. A field that is changed in place, such as a
+    list that is appended to, must be followed by a call to invalidate,
+    or by signing the object again. Signing builds the serialized forms,
+    so an object is always sent as it was signed.
+
     Attributes:
         Signature (str): The signature used to sign the object.
         SignatureKey (str): The name of the key related to the signature.
             Used to build dict return types.
 
     """
-    signature_cache = LruCache()
+    signature_cache = LruCache(65536)
+
+    # the attributes that hold serialized forms of the object, and the
+    # public attributes that are not serialized
+    _serialized = ('_data', '_signable')
+    _transient = frozenset()
 
     def __init__(self, minfo=None, signkey='Signature'):
         """Constructor for the SignedObject class.
@@ -151,12 +229,22 @@ class SignedObject(object):
         self._identifier = hashlib.sha256(
             self.Signature).hexdigest() if self.Signature else None
         self._originator_id = None
-        self._data = None
+        self.invalidate()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_' and name not in self._transient:
+            self.invalidate()
 
     def __repr__(self):
-        if not self._data:
-            self._data = self.serialize()
-        return self._data
+        return self.serialize()
+
+    def invalidate(self):
+        """Discards the serialized forms of the object after a field was
+        changed in place.
+        """
+        for name in self._serialized:
+            self.__dict__[name] = None
 
     @property
     def Identifier(self):
@@ -175,17 +263,30 @@ class SignedObject(object):
 
         return self._identifier[:16]
 
+    @property
+    def SignatureDigest(self):
+        """Returns the sha256 hexdigest of the signature, which is how the
+        signature cache refers to the object.
+        """
+        assert self.Signature
+
+        if not self._identifier:
+            self._identifier = hashlib.sha256(self.Signature).hexdigest()
+
+        return self._identifier
+
     def _recover_verifying_address(self):
         assert self.Signature
 
         if not self._originator_id:
             self._originator_id = \
-                self.signature_cache[self.Signature]
+                self.signature_cache[self.SignatureDigest]
             if not self._originator_id:
                 serialized = self.serialize(signable=True)
                 verifying_key = get_verifying_key(serialized, self.Signature)
                 self._originator_id = pybitcointools.pubtoaddr(verifying_key)
-                self.signature_cache[self.Signature] = self._originator_id
+                self.signature_cache[self.SignatureDigest] = \
+                    self._originator_id
 
     @property
     def OriginatorID(self):
@@ -199,6 +300,15 @@ class SignedObject(object):
             self._recover_verifying_address()
         return self._originator_id
 
+    def set_originator_id(self, originatorid):
+        """Records the address recovered from the signature elsewhere, for
+        example by a SignatureVerifier.
+
+        Args:
+            originatorid (str): The address of the signer of the object.
+        """
+        self._originator_id = originatorid
+
     def is_valid(self, store):
         """Determines if the signature on the object is valid.
 
@@ -254,12 +364,20 @@ class SignedObject(object):
             signingkey (str): hex encoded private key
         """
 
+        # fields may have been changed in place since the last
+        # serialization, both forms are built from the same dump so that
+        # later changes in place are not sent with the signature
         self._originator_id = None
-        serialized = self.serialize(signable=True)
+        dump = self.dump()
+        dump.pop(self.SignatureKey, None)
+        serialized = dict2cbor(dump)
         self.Signature = pybitcointools.ecdsa_sign(serialized, signingkey)
+        dump[self.SignatureKey] = self.Signature
+        self._signable = serialized
+        self._data = dict2cbor(dump)
+        self._identifier = hashlib.sha256(self.Signature).hexdigest()
 
         self._recover_verifying_address()
-        self._identifier = hashlib.sha256(self.Signature).hexdigest()
 
     def serialize(self, signable=False):
         """Generates a CBOR serialized dict containing the a SignatureKey
@@ -273,12 +391,16 @@ class SignedObject(object):
             bytes: a CBOR representation of a SignatureKey to Signature
                 mapping.
         """
-        dump = self.dump()
-
-        if signable and self.SignatureKey in dump:
-            del dump[self.SignatureKey]
-
-        return dict2cbor(dump)
+        if signable:
+            if self._signable is None:
+                dump = self.dump()
+                dump.pop(self.SignatureKey, None)
+                self._signable = dict2cbor(dump)
+            return self._signable
+
+        if self._data is None:
+            self._data = dict2cbor(self.dump())
+        return self._data
 
     def dump(self):
         """Builds a dict containing a mapping of SignatureKey to Signature.
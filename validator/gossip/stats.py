@@ -15,9 +15,10 @@
 """
 This module defines the Stats class, which manages statistics about the
 gossiper node. Additional supporting classes include: Metric, Value,
-Counter, MapCounter, Average, and Sample.
+Counter, MapCounter, Average, Histogram and Sample.
 """
 
+import bisect
 import logging
 import time
 
@@ -129,8 +130,8 @@ class Stats(object):
 
 class Metric(object):
     """The Metric class acts as a base class for a number of specific
-    Metric types, including Value, Counter, MapCounter, Average, and
-    Sample.
+    Metric types, including Value, Counter, MapCounter, Average,
+    Histogram and Sample.
 
     Attributes:
         Name (str): the name of the metric.
@@ -362,6 +363,58 @@ class Average(Metric):
         self.Count = 0
 
 
+class Histogram(Metric):
+    """The Histogram class extends Metric to count values in a set of
+    buckets.
+
+    Attributes:
+        Bounds (list of float): The ascending upper bounds of the buckets.
+            Values above the last bound are counted in a final bucket.
+        Counts (list of int): The number of values counted in each bucket.
+    """
+
+    def __init__(self, name, bounds):
+        """Constructor for the Histogram class.
+
+        Args:
+            name (str): The name of the metric.
+            bounds (list of float): The ascending upper bounds of the
+                buckets.
+        """
+        super(Histogram, self).__init__(name)
+        self.Bounds = sorted(bounds)
+        self.reset()
+
+    def add_value(self, value):
+        """Counts a value in the first bucket whose bound is not less
+        than the value.
+
+        Args:
+            value (float): The value to count.
+        """
+        self.Counts[bisect.bisect_left(self.Bounds, value)] += 1
+
+    def get_metric(self):
+        """
+        Return the current value of the metric.
+        """
+        return list(self.Counts)
+
+    def dump_metric(self, identifier):
+        """Writes a logger entry containing the provided identifier,
+        the name of the metric, and the count of each bucket.
+
+        Args:
+            identifier (str): The identifier to log.
+        """
+        self.dump(identifier, self.Name, *self.Counts)
+
+    def reset(self):
+        """Resets the count of each bucket to zero.
+        """
+        self.Counts = [0] * (len(self.Bounds) + 1)
+
+
 class Sample(Metric):
     """The Sample class extends Metric to capture the output of a
     provided closure when dump_metric() is called.
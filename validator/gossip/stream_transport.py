@@ -0,0 +1,217 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the StreamTransport class which keeps a persistent TCP
+connection to each peer for bulk traffic. Packets are sent on the stream
+with a length prefix, in the same format as on a datagram, and the kernel
+takes care of retransmission and congestion control.
+"""
+
+import logging
+import time
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
+
+from gossip import stats
+
+logger = logging.getLogger(__name__)
+
+
+class StreamProtocol(Int32StringReceiver):
+    """Carries length-prefixed packets over a TCP connection.
+
+    Attributes:
+        PeerID (str): The identifier of the peer for outgoing connections,
+            None for connections accepted from peers.
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, stream, peerid=None):
+        self.Stream = stream
+        self.PeerID = peerid
+
+    def connectionMade(self):
+        if self.PeerID is not None:
+            self.Stream.connected(self)
+
+    def connectionLost(self, reason):
+        if self.PeerID is not None:
+            self.Stream.disconnected(self)
+
+    def stringReceived(self, data):
+        self.Stream.received(data)
+
+    def lengthLimitExceeded(self, length):
+        logger.warn('stream frame of %d bytes is too large, disconnect',
+                    length)
+        self.transport.loseConnection()
+
+
+class _ListenFactory(ServerFactory):
+    def __init__(self, stream):
+        self.Stream = stream
+
+    def buildProtocol(self, addr):
+        return StreamProtocol(self.Stream)
+
+
+class _PeerFactory(ClientFactory):
+    def __init__(self, stream, peerid):
+        self.Stream = stream
+        self.PeerID = peerid
+
+    def buildProtocol(self, addr):
+        return StreamProtocol(self.Stream, self.PeerID)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.Stream.failed(self.PeerID, reason)
+
+
+class StreamTransport(object):
+    """Persistent stream connections to peers.
+
+    Each node sends on connections that it opened itself and receives on
+    the connections opened by its peers. A connection is opened the first
+    time a peer is used, packets for the peer go over datagrams until the
+    connection is up. A peer that cannot be reached is not tried again
+    for RetryInterval seconds.
+
+    Attributes:
+        RetryInterval (float): The number of seconds to wait before trying
+            to connect again to a peer that could not be reached.
+        ConnectTimeout (float): The number of seconds to wait for a
+            connection to be established.
+        StreamStats (stats.Stats): Counters for the stream connections.
+        Listener (Port): The TCP listener.
+    """
+
+    RetryInterval = 30.0
+    ConnectTimeout = 10.0
+
+    def __init__(self, nodename, port, received):
+        """Constructor for the StreamTransport class.
+
+        Args:
+            nodename (str): The name of the local node, used for stats.
+            port (int): The TCP port to listen on.
+            received (function): Called with each packed packet received
+                from a peer.
+        """
+        self._received = received
+        self._connections = {}
+        self._pending = {}
+        self._retry = {}
+
+        self.StreamStats = stats.Stats(nodename, 'stream')
+        self.StreamStats.add_metric(stats.Counter('PacketsSent'))
+        self.StreamStats.add_metric(stats.Average('BytesSent'))
+        self.StreamStats.add_metric(stats.Counter('PacketsReceived'))
+        self.StreamStats.add_metric(stats.Counter('ConnectFailures'))
+        self.StreamStats.add_metric(stats.Sample(
+            'Connections', lambda: len(self._connections)))
+
+        self.Listener = reactor.listenTCP(port, _ListenFactory(self))
+
+    def is_connected(self, peerid):
+        """Determines whether packets for a peer can go over the stream.
+
+        Args:
+            peerid (str): The identifier of the peer.
+        """
+        return peerid in self._connections
+
+    def connect(self, peer):
+        """Start opening a connection to a peer unless one is open, being
+        opened, or failed recently.
+
+        Args:
+            peer (Node): The peer to connect to.
+        """
+        peerid = peer.Identifier
+        if peerid in self._connections or peerid in self._pending:
+            return
+        if self._retry.get(peerid, 0) > time.time():
+            return
+
+        (host, port) = peer.NetAddress
+        logger.debug('open stream connection to %s', peer)
+        self._pending[peerid] = reactor.connectTCP(
+            host, port, _PeerFactory(self, peerid),
+            timeout=self.ConnectTimeout)
+
+    def send(self, data, peer):
+        """Send a packed packet to a peer.
+
+        Args:
+            data (bytes): The packed packet.
+            peer (Node): The destination of the packet.
+
+        Returns:
+            bool: False if there is no connection to the peer.
+        """
+        protocol = self._connections.get(peer.Identifier)
+        if protocol is None:
+            return False
+
+        protocol.sendString(data)
+        self.StreamStats.PacketsSent.increment()
+        self.StreamStats.BytesSent.add_value(len(data))
+        return True
+
+    def disconnect(self, peerid):
+        """Close the connection to a peer.
+
+        Args:
+            peerid (str): The identifier of the peer.
+        """
+        connector = self._pending.pop(peerid, None)
+        if connector is not None:
+            connector.disconnect()
+
+        protocol = self._connections.pop(peerid, None)
+        if protocol is not None:
+            protocol.transport.loseConnection()
+
+    def connected(self, protocol):
+        self._pending.pop(protocol.PeerID, None)
+        self._retry.pop(protocol.PeerID, None)
+        self._connections[protocol.PeerID] = protocol
+
+    def disconnected(self, protocol):
+        if self._connections.get(protocol.PeerID) is protocol:
+            del self._connections[protocol.PeerID]
+
+    def failed(self, peerid, reason):
+        logger.info('unable to open stream connection to %s; %s',
+                    peerid[:8], reason.getErrorMessage())
+        self._pending.pop(peerid, None)
+        self._retry[peerid] = time.time() + self.RetryInterval
+        self.StreamStats.ConnectFailures.increment()
+
+    def received(self, data):
+        self.StreamStats.PacketsReceived.increment()
+        self._received(data)
+
+    def close(self):
+        """Stop listening and close every connection. Packets already
+        written are still delivered.
+        """
+        for peerid in self._pending.keys() + self._connections.keys():
+            self.disconnect(peerid)
+        self.Listener.stopListening()
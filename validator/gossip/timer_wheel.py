@@ -0,0 +1,133 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the TimerWheel class, which tracks the expiration
+times of a large number of keys.
+
+Keys are kept in buckets that each cover a slice of time the length of
+the resolution of the wheel, and only the buckets themselves are ordered.
+Adding, replacing or removing a key is O(1) and expiring keys costs
+O(1) for each key plus O(log n) for each bucket, no matter how many keys
+have not expired yet. A key expires at the end of its bucket, never
+before its expiration time and at most one resolution after it.
+"""
+
+import math
+from heapq import heappop, heappush
+from threading import Lock
+
+
+class TimerWheel(object):
+    """Maps keys to expiration times and returns the keys as they expire.
+
+    Attributes:
+        Resolution (float): The length in seconds of the time covered by
+            one bucket.
+    """
+
+    def __init__(self, resolution=1.0):
+        """Constructor for the TimerWheel class.
+
+        Args:
+            resolution (float): The length in seconds of the time covered
+                by one bucket.
+        """
+        self.Resolution = resolution
+
+        self._expirations = {}
+        self._buckets = {}
+        self._ticks = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._expirations)
+
+    def __contains__(self, key):
+        return key in self._expirations
+
+    def __iter__(self):
+        return iter(self._expirations.keys())
+
+    def __getitem__(self, key):
+        return self._expirations[key]
+
+    def __setitem__(self, key, exptime):
+        """Sets the expiration time of a key, replacing an earlier one.
+
+        Args:
+            key: The key.
+            exptime (float): The time in seconds since the epoch when the
+                key expires.
+        """
+        tick = self._tick(exptime)
+        with self._lock:
+            self._expirations[key] = exptime
+            bucket = self._buckets.get(tick)
+            if bucket is None:
+                bucket = self._buckets[tick] = []
+                heappush(self._ticks, tick)
+            bucket.append(key)
+
+    def get(self, key, default=None):
+        return self._expirations.get(key, default)
+
+    def pop(self, key, default=None):
+        """Removes a key without waiting for it to expire. The entry in
+        its bucket is skipped when the bucket expires.
+
+        Args:
+            key: The key to remove.
+            default: The value returned if the key is not present.
+
+        Returns:
+            float: The expiration time of the key.
+        """
+        with self._lock:
+            return self._expirations.pop(key, default)
+
+    def next_expiration(self):
+        """Returns the time when the next bucket expires, or None if no
+        bucket is left. The keys of the bucket may have been removed.
+        """
+        with self._lock:
+            if not self._ticks:
+                return None
+            return self._ticks[0] * self.Resolution
+
+    def expire(self, now):
+        """Removes and returns the keys that expired by a time.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            list: The expired keys, in order of expiration bucket.
+        """
+        expired = []
+        with self._lock:
+            while self._ticks and self._ticks[0] * self.Resolution <= now:
+                tick = heappop(self._ticks)
+                for key in self._buckets.pop(tick):
+                    # the key may have been removed, or moved to a later
+                    # bucket
+                    exptime = self._expirations.get(key)
+                    if exptime is not None and self._tick(exptime) == tick:
+                        del self._expirations[key]
+                        expired.append(key)
+
+        return expired
+
+    def _tick(self, exptime):
+        return int(math.ceil(exptime / self.Resolution))
@@ -66,11 +66,44 @@ class TokenBucket(object):
         per second, up to the capacity of the bucket.
         """
         now = time.time()
+        if now < self.LastDrip:
+            # held, no tokens until then
+            return
+
         self.Tokens = min(self.Capacity,
                           self.Tokens + int(self.DripRate *
                                             (now - self.LastDrip)))
         self.LastDrip = now
 
+    def hold(self, seconds):
+        """Empties the bucket and adds no tokens for a while, used when
+        the receiver asks for traffic to be held back.
+
+        Args:
+            seconds (float): The number of seconds to add no tokens.
+        """
+        self.Tokens = 0
+        self.LastDrip = max(self.LastDrip, time.time() + seconds)
+
+    def ready_time(self, amount):
+        """Returns the time when enough tokens will be in the bucket to
+        consume an amount.
+
+        Args:
+            amount (int): the number of tokens to consume.
+
+        Returns:
+            float: The time in seconds since the epoch.
+        """
+        self.drip()
+
+        needed = min(amount, self.Capacity) - self.Tokens
+        if needed <= 0:
+            return self.LastDrip
+
+        # one token more covers the truncation of partial tokens in drip
+        return self.LastDrip + float(needed + 1) / self.DripRate
+
     def consume(self, amount):
         """Consumes tokens from the bucket.
 
@@ -80,11 +113,120 @@ class TokenBucket(object):
         Returns:
             bool: If more tokens are requested than are available, returns
                 False, otherwise subtracts the tokens and returns True.
+                An amount larger than the capacity is allowed from a full
+                bucket, leaving the bucket in debt.
 
         """
         self.drip()
 
-        if amount > self.Tokens:
+        if amount > self.Tokens and self.Tokens < self.Capacity:
             return False
         self.Tokens -= amount
         return True
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """The AdaptiveTokenBucket class adjusts the drip rate of a token
+    bucket to the traffic the peer acknowledges, with additive increase
+    and multiplicative decrease.
+
+    The rate doubles every round trip until the first loss, and then grows
+    by IncreaseRate every round trip. Each loss cuts the rate by
+    DecreaseFactor, at most once per round trip so that the packets lost
+    in one burst count once. The rate only grows while the bucket limits
+    the traffic, and the capacity follows the rate.
+
+    Attributes:
+        DefaultMaximumRate (int): The default limit of the drip rate.
+        MinimumRate (int): The lowest drip rate after a loss.
+        IncreaseRate (int): The number of tokens per second the drip rate
+            grows by every round trip once a loss has been seen.
+        DecreaseFactor (float): The factor the drip rate is multiplied by
+            on a loss.
+        MinimumRoundTrip (float): The shortest round trip in seconds used
+            to pace the increase.
+        MaximumRate (int): The configured limit of the drip rate.
+        Threshold (int): The drip rate above which the rate grows
+            additively, None until the first loss.
+    """
+    DefaultMaximumRate = 12500000
+    MinimumRate = 8000
+    IncreaseRate = 16000
+    DecreaseFactor = 0.5
+    MinimumRoundTrip = 0.01
+
+    def __init__(self, rate=None, capacity=None, maximum=None):
+        """Constructor for the AdaptiveTokenBucket class.
+
+        Args:
+            rate (int): the initial drip rate in tokens per second.
+            capacity (int): the initial capacity, which keeps its ratio
+                to the drip rate as the rate changes.
+            maximum (int): the limit of the drip rate.
+        """
+        super(AdaptiveTokenBucket, self).__init__(rate, capacity)
+
+        self.MaximumRate = max(maximum or self.DefaultMaximumRate,
+                               self.DripRate)
+        self.Threshold = None
+
+        self._rate = float(self.DripRate)
+        self._burst = float(self.Capacity) / self.DripRate
+        self._recovery = 0
+        self._limited = False
+
+    def drip(self):
+        super(AdaptiveTokenBucket, self).drip()
+
+        # a full bucket means the peer is sent less than the rate allows
+        if self.Tokens >= self.Capacity:
+            self._limited = False
+
+    def consume(self, amount):
+        if super(AdaptiveTokenBucket, self).consume(amount):
+            return True
+
+        self._limited = True
+        return False
+
+    def delivered(self, amount, rtt):
+        """Grows the drip rate for tokens acknowledged by the peer.
+
+        Args:
+            amount (int): the number of tokens acknowledged.
+            rtt (float): the measured round trip time in seconds.
+        """
+        if not self._limited:
+            return
+
+        rtt = max(rtt, self.MinimumRoundTrip)
+        if self.Threshold is None or self._rate < self.Threshold:
+            increase = amount / rtt
+        else:
+            increase = self.IncreaseRate * amount / (self._rate * rtt)
+
+        self._setrate(self._rate + increase)
+
+    def dropped(self, rtt, now=None):
+        """Cuts the drip rate for a loss, unless the rate was already cut
+        within the last round trip.
+
+        Args:
+            rtt (float): the current round trip estimate in seconds.
+            now (float): the current time.
+        """
+        if now is None:
+            now = time.time()
+        if now < self._recovery:
+            return
+
+        self._recovery = now + rtt
+        self._setrate(self._rate * self.DecreaseFactor)
+        self.Threshold = self.DripRate
+
+    def _setrate(self, rate):
+        # the fractional rate is kept so small increases add up
+        self._rate = max(self.MinimumRate, min(self.MaximumRate, rate))
+        self.DripRate = int(self._rate)
+        self.Capacity = int(self.DripRate * self._burst)
+        self.Tokens = min(self.Tokens, self.Capacity)
@@ -14,6 +14,7 @@
 # ------------------------------------------------------------------------------
 
 import gossip.topology.barabasi_albert
+import gossip.topology.latency_optimizer
 import gossip.topology.random_walk
 
-__all__ = ['barabasi_albert', 'random_walk']
+__all__ = ['barabasi_albert', 'latency_optimizer', 'random_walk']
@@ -0,0 +1,138 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module implements a topology maintenance loop that keeps rewiring
+the peers of a node toward low latency neighbors.
+
+Each round a node below MinimumConnectivity sends random walks for all
+the peers it lacks and a node below TargetConnectivity sends one, while
+a node above the target asks the peer that costs the most to send a
+message to for agreement to close the link. The peer refuses while it has
+few other links, so no node is cut off, and a peer that refused is not
+asked again while it stays connected. A node at the target leaves its
+peers alone. A few peers are kept as random links that are never pruned
+for their cost, so the overlay stays a small world with a low diameter
+rather than splitting into clusters of nearby nodes.
+"""
+
+import logging
+import random
+
+from twisted.internet import reactor
+
+from gossip.messages import connect_message, random_walk_message
+
+logger = logging.getLogger(__name__)
+
+UpdateInterval = 30.0
+TargetConnectivity = 6
+MinimumConnectivity = 2
+RandomConnectivity = 2
+ReferenceMessageSize = 16384
+
+
+def start_topology_maintenance(gossiper):
+    """Starts the topology maintenance loop, which runs until the node
+    stops processing messages.
+
+    Args:
+        gossiper (Node): The local node.
+    """
+    logger.info("start latency optimized topology maintenance")
+    reactor.callLater(UpdateInterval, _maintain, gossiper, set(), set())
+
+
+def _maintain(gossiper, randompeers, pruned):
+    if not gossiper.ProcessIncomingMessages:
+        return
+
+    update_connections(gossiper, randompeers, pruned)
+    reactor.callLater(UpdateInterval, _maintain, gossiper, randompeers,
+                      pruned)
+
+
+def peer_cost(peer):
+    """Estimates the time in seconds to deliver a message of
+    ReferenceMessageSize bytes to a peer, from the measured round trip and
+    the current send rate.
+
+    Args:
+        peer (Node): The peer.
+
+    Returns:
+        float: The estimated time, None if no round trip was measured.
+    """
+    rtt = peer.Estimator.SRTT
+    if rtt is None:
+        return None
+
+    return rtt / 2.0 + float(ReferenceMessageSize) / peer.TokenBucket.DripRate
+
+
+def update_connections(gossiper, randompeers, pruned):
+    """Runs one round of topology maintenance.
+
+    Args:
+        gossiper (Node): The local node.
+        randompeers (set): The identifiers of the peers kept as random
+            links, updated in place.
+        pruned (set): The identifiers of the peers asked to close the
+            link, updated in place.
+    """
+    peers = gossiper.peer_list()
+    peerids = [p.Identifier for p in peers]
+    randompeers.intersection_update(peerids)
+
+    # a peer asked in an earlier round that is still connected refused
+    pruned.intersection_update(peerids)
+
+    # replace the random links that were lost with other peers picked at
+    # random
+    others = [p for p in peers if p.Identifier not in randompeers]
+    random.shuffle(others)
+    while len(randompeers) < RandomConnectivity and others:
+        randompeers.add(others.pop().Identifier)
+
+    if len(peers) < MinimumConnectivity:
+        count = TargetConnectivity - len(peers)
+        logger.info('probe for %d new peers, %d peers connected', count,
+                    len(peers))
+        for _ in xrange(count):
+            random_walk_message.send_random_walk_message(gossiper)
+        return
+
+    if len(peers) < TargetConnectivity:
+        logger.debug('probe for a new peer, %d peers connected', len(peers))
+        random_walk_message.send_random_walk_message(gossiper)
+        return
+
+    if len(peers) == TargetConnectivity:
+        return
+
+    # peers without a measured round trip are kept until they have one
+    costs = [(peer_cost(p), p) for p in others if p.Identifier not in pruned]
+    costs = [(c, p) for (c, p) in costs if c is not None]
+    if not costs:
+        return
+
+    # one request each round, the peer answers with a disconnect request
+    # if it agrees
+    (cost, peer) = max(costs, key=lambda x: x[0])
+    logger.info('ask peer %s with an estimated cost of %.3f seconds to '
+                'close the link', peer, cost)
+
+    pruned.add(peer.Identifier)
+    gossiper.send_message(connect_message.PruneRequestMessage(),
+                          peer.Identifier)
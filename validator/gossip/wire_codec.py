@@ -0,0 +1,275 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines a compact wire encoding for messages and the
+transactions and blocks they carry.
+
+Every dict with a type field (a message, transaction or transaction block)
+is encoded as a tagged CBOR array holding the 32 bit identifier of its
+schema, a bit mask of the fields that are present and the values of those
+fields in schema order. The type name and field names are not sent. A
+schema is learned from the dump of a new instance of a registered class,
+so two validators running the same code agree on every schema without
+exchanging them. Fields that are not in the schema follow as a map.
+
+The encoding is only used on the wire. Signatures are still computed over
+the canonical CBOR encoding from gossip.common.
+"""
+
+import hashlib
+import logging
+import struct
+
+import cbor
+
+logger = logging.getLogger(__name__)
+
+SchemaTag = 40401
+
+# the keys that name the type of a dict, and the schema it is encoded with
+TypeKeys = ('__TYPE__', 'TransactionType', 'TransactionBlockType')
+
+
+class Schema(object):
+    """The ordered fields of one type of dict.
+
+    Attributes:
+        TypeKey (str): The key that holds the type name.
+        TypeName (str): The type name.
+        Fields (tuple): The names of the fields in encoding order.
+        Identifier (int): A 32 bit identifier computed from the type and
+            the fields.
+    """
+
+    def __init__(self, typekey, typename, fields):
+        self.TypeKey = typekey
+        self.TypeName = typename
+        self.Fields = tuple(sorted(f for f in fields if f != typekey))
+        self._fieldset = frozenset(self.Fields)
+
+        digest = hashlib.sha256(
+            '\0'.join((typekey, typename) + self.Fields)).digest()
+        self.Identifier = struct.unpack('!L', digest[:4])[0]
+
+    def pack(self, info, pack):
+        """Builds the record for a dict.
+
+        Args:
+            info (dict): The dict to encode.
+            pack (function): Encodes the values of the fields.
+
+        Returns:
+            cbor.Tag: The tagged record.
+        """
+        mask = 0
+        record = [self.Identifier, 0]
+        for (bit, field) in enumerate(self.Fields):
+            if field in info:
+                mask |= 1 << bit
+                record.append(pack(info[field]))
+        record[1] = mask
+
+        if len(info) > len(record) - 1:
+            extras = dict((k, pack(v)) for (k, v) in info.iteritems()
+                          if k not in self._fieldset and k != self.TypeKey)
+            if extras:
+                record.append(extras)
+
+        return cbor.Tag(SchemaTag, record)
+
+    def unpack(self, record, unpack):
+        """Rebuilds a dict from its record.
+
+        Args:
+            record (list): The value of the tagged record.
+            unpack (function): Decodes the values of the fields.
+
+        Returns:
+            dict: The decoded dict.
+        """
+        mask = record[1]
+        result = {self.TypeKey: self.TypeName}
+        index = 2
+        for (bit, field) in enumerate(self.Fields):
+            if mask & (1 << bit):
+                result[field] = unpack(record[index])
+                index += 1
+
+        if index < len(record):
+            for (key, value) in record[index].iteritems():
+                result[unpack(key)] = unpack(value)
+
+        return result
+
+
+class WireCodec(object):
+    """Encodes dicts with the schemas of the registered types.
+    """
+
+    def __init__(self):
+        self._byid = {}
+        self._bytype = {}
+
+    def __len__(self):
+        return len(self._byid)
+
+    def register_type(self, cls):
+        """Learn the schemas of a class, and of the objects embedded in it,
+        from the dump of a new instance.
+
+        Args:
+            cls (type): A Message, Transaction or TransactionBlock class.
+        """
+        try:
+            info = cls().dump()
+        except (AssertionError, AttributeError, KeyError, TypeError,
+                ValueError) as e:
+            logger.warn('unable to learn the schema of %s, it is sent '
+                        'with the canonical encoding; %s', cls, e)
+            return
+
+        self._learn(info)
+
+    def _learn(self, item):
+        if isinstance(item, list):
+            for value in item:
+                self._learn(value)
+            return
+
+        if not isinstance(item, dict):
+            return
+
+        for typekey in TypeKeys:
+            if typekey in item:
+                self._add(Schema(typekey, item[typekey], item.keys()))
+                break
+
+        for value in item.itervalues():
+            self._learn(value)
+
+    def _add(self, schema):
+        key = (schema.TypeKey, schema.TypeName)
+        if key in self._bytype:
+            return
+
+        other = self._byid.get(schema.Identifier)
+        if other is not None:
+            logger.warn('schema of %s clashes with %s, sent without one',
+                        schema.TypeName, other.TypeName)
+            return
+
+        self._byid[schema.Identifier] = schema
+        self._bytype[key] = schema
+
+    def _schema(self, info):
+        for typekey in TypeKeys:
+            typename = info.get(typekey)
+            if typename is not None:
+                return self._bytype.get((typekey, typename))
+        return None
+
+    def _pack(self, item):
+        if isinstance(item, dict):
+            schema = self._schema(item)
+            if schema is not None:
+                return schema.pack(item, self._pack)
+            return dict((k, self._pack(v)) for (k, v) in item.iteritems())
+        elif isinstance(item, list):
+            return [self._pack(v) for v in item]
+        return item
+
+    def _unpack(self, item):
+        if isinstance(item, cbor.Tag):
+            schema = self._byid.get(item.value[0]) \
+                if item.tag == SchemaTag else None
+            if schema is None:
+                raise ValueError('unknown schema {0}'.format(item.value[0]))
+            return schema.unpack(item.value, self._unpack)
+        elif isinstance(item, dict):
+            return dict((self._unpack(k), self._unpack(v))
+                        for (k, v) in item.iteritems())
+        elif isinstance(item, list):
+            return [self._unpack(v) for v in item]
+        elif isinstance(item, unicode):
+            return item.encode('ascii')
+        return item
+
+    def encode(self, info):
+        """Encodes a dict.
+
+        Args:
+            info (dict): The dump of a message.
+
+        Returns:
+            bytes: The compact encoding.
+        """
+        record = self._pack(info)
+        if not isinstance(record, cbor.Tag):
+            raise ValueError('no schema for {0}'.format(
+                info.get('__TYPE__')))
+        return cbor.dumps(record)
+
+    def decode(self, data):
+        """Decodes a dict.
+
+        Args:
+            data (bytes): The compact encoding.
+
+        Returns:
+            dict: The decoded dict.
+        """
+        return self._unpack(cbor.loads(data))
+
+
+# the codec shared by everything that sends or receives messages
+_codec = WireCodec()
+_prefix = cbor.dumps(cbor.Tag(SchemaTag, []))[:3]
+
+
+def is_compact(data):
+    """Determines whether data has the compact encoding rather than
+    canonical CBOR.
+
+    Args:
+        data (bytes): The encoded message.
+    """
+    return data[:len(_prefix)] == _prefix
+
+
+def register_type(cls):
+    """Learn the schemas of a class and of the objects embedded in it.
+
+    Args:
+        cls (type): A Message, Transaction or TransactionBlock class.
+    """
+    _codec.register_type(cls)
+
+
+def encode(info):
+    """Encodes a dict with the shared codec.
+
+    Args:
+        info (dict): The dump of a message.
+    """
+    return _codec.encode(info)
+
+
+def decode(data):
+    """Decodes a dict with the shared codec.
+
+    Args:
+        data (bytes): The compact encoding.
+    """
+    return _codec.decode(data)
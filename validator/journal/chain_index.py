@@ -0,0 +1,287 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the ChainIndex class which tracks the height of every
+known block and the committed chain as an array indexed by height. Each
+block also keeps a skip pointer to an ancestor (using the same skip
+heights as bitcoin's CBlockIndex) so that the ancestor of a block at any
+height, and therefore the point where a fork meets the committed chain,
+can be found in a logarithmic number of steps.
+"""
+
+import logging
+
+from gossip.common import NullIdentifier
+
+logger = logging.getLogger(__name__)
+
+
+def _invert_lowest_one(n):
+    return n & (n - 1)
+
+
+def _skip_height(height):
+    if height < 2:
+        return 0
+
+    # odd heights skip a little less far so that the pointers of
+    # neighbouring blocks do not all land on the same ancestor
+    if height & 1:
+        return _invert_lowest_one(_invert_lowest_one(height - 1)) + 1
+    return _invert_lowest_one(height)
+
+
+class ChainIndex(object):
+    """Height and ancestry index for the blocks in a journal.
+
+    The committed chain is persisted in the chain store, one key per
+    height, so it can be reloaded without decoding every block. Heights
+    and skip pointers for other blocks are computed from the block store
+    the first time the block is used.
+
+    Attributes:
+        Height (int): The height of the head of the committed chain, -1
+            if no block is committed.
+        Head (str): The identifier of the head of the committed chain.
+    """
+
+    HeightKey = 'ChainHeight'
+
+    def __init__(self, blockstore, chainstore):
+        """Constructor for the ChainIndex class.
+
+        Args:
+            blockstore (JournalStore): The store of transaction blocks.
+            chainstore (JournalStore): The store used to persist the
+                committed chain.
+        """
+        self._blockstore = blockstore
+        self._chainstore = chainstore
+
+        self._chain = []
+        self._heights = {NullIdentifier: -1}
+        self._previous = {}
+        self._skips = {}
+
+    @property
+    def Height(self):
+        return len(self._chain) - 1
+
+    @property
+    def Head(self):
+        return self._chain[-1] if self._chain else NullIdentifier
+
+    @staticmethod
+    def _chain_key(height):
+        return 'ChainBlock/{0}'.format(height)
+
+    def _add(self, blockid, previd):
+        height = self._heights[previd] + 1
+        self._heights[blockid] = height
+        self._previous[blockid] = previd
+        if height > 0:
+            self._skips[blockid] = self.ancestor(previd, _skip_height(height))
+
+    def _register(self, blockid):
+        """Compute the height of a block and of any unknown predecessors.
+        """
+        pending = []
+        while blockid not in self._heights:
+            pending.append(blockid)
+            blockid = self._blockstore[blockid].PreviousBlockID
+
+        for blockid in reversed(pending):
+            self._add(blockid, self._blockstore[blockid].PreviousBlockID)
+
+    def height(self, blockid):
+        """Returns the height of a block, 0 for the genesis block.
+
+        Args:
+            blockid (str): The identifier of the block.
+        """
+        if blockid not in self._heights:
+            self._register(blockid)
+        return self._heights[blockid]
+
+    def ancestor(self, blockid, height):
+        """Returns the ancestor of a block at a given height.
+
+        Args:
+            blockid (str): The identifier of the block.
+            height (int): The height of the ancestor, -1 returns the null
+                identifier.
+        """
+        current = self.height(blockid)
+        assert -1 <= height <= current
+
+        while current > height:
+            skipheight = _skip_height(current)
+            prevskipheight = _skip_height(current - 1)
+            skip = self._skips.get(blockid)
+            if skip is not None and (
+                    skipheight == height or
+                    (skipheight > height and
+                     not (prevskipheight < skipheight - 2 and
+                          prevskipheight >= height))):
+                blockid = skip
+                current = skipheight
+            else:
+                blockid = self._previous[blockid]
+                current -= 1
+
+        return blockid
+
+    def is_committed(self, blockid):
+        """Determines whether a block is part of the committed chain.
+
+        Args:
+            blockid (str): The identifier of the block.
+        """
+        if blockid == NullIdentifier:
+            return True
+        height = self.height(blockid)
+        return height <= self.Height and self._chain[height] == blockid
+
+    def find_fork(self, blockid):
+        """Find the most recent ancestor of a block (including the block
+        itself) that is part of the committed chain.
+
+        Args:
+            blockid (str): The identifier of the block.
+
+        Returns:
+            str: The identifier of the common block, the null identifier
+                if the chains share no blocks.
+        """
+        if self.is_committed(blockid):
+            return blockid
+
+        # committed ancestors form a prefix of the ancestry of the block so
+        # binary search for the highest one
+        low = -1
+        high = min(self.height(blockid) - 1, self.Height)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.ancestor(blockid, middle) == self._chain[middle]:
+                low = middle
+            else:
+                high = middle - 1
+
+        return self._chain[low] if low >= 0 else NullIdentifier
+
+    def committed_block_ids(self, count=0):
+        """Returns identifiers from the committed chain starting with the
+        head.
+
+        Args:
+            count (int): The maximum number of identifiers, 0 for all.
+        """
+        if count <= 0 or count > len(self._chain):
+            count = len(self._chain)
+        return self._chain[:-count - 1:-1]
+
+    def block_ids(self, height, count):
+        """Returns identifiers from the committed chain in height order.
+
+        Args:
+            height (int): The height of the first block.
+            count (int): The maximum number of identifiers.
+        """
+        return self._chain[height:height + count]
+
+    def push(self, blockid):
+        """Extend the committed chain with a block.
+
+        Args:
+            blockid (str): The identifier of a child of the head.
+        """
+        height = self.height(blockid)
+        assert height == len(self._chain)
+        assert self._previous[blockid] == self.Head
+
+        self._chain.append(blockid)
+        self._chainstore[self._chain_key(height)] = blockid
+        self._chainstore[self.HeightKey] = height
+
+    def pop(self):
+        """Remove the head of the committed chain.
+
+        Returns:
+            str: The identifier of the removed block.
+        """
+        blockid = self._chain.pop()
+        self._chainstore[self.HeightKey] = self.Height
+        return blockid
+
+    def load(self, headid):
+        """Load the committed chain that ends at a block.
+
+        The persisted chain is used if its head matches, otherwise the
+        chain is rebuilt by walking back from the head.
+
+        Args:
+            headid (str): The identifier of the head of the chain.
+        """
+        self._chain = []
+
+        height = self._chainstore.get(self.HeightKey)
+        chain = None
+        if height is not None and height >= 0 and \
+                self._chainstore.get(self._chain_key(height)) == headid:
+            chain = [self._chainstore.get(self._chain_key(h))
+                     for h in xrange(height + 1)]
+            if None in chain:
+                chain = None
+
+        if chain is None:
+            logger.info('rebuild chain index from block %s', headid[:8])
+            chain = []
+            blockid = headid
+            while blockid != NullIdentifier:
+                chain.append(blockid)
+                blockid = self._blockstore[blockid].PreviousBlockID
+            chain.reverse()
+            for index, blockid in enumerate(chain):
+                self._chainstore[self._chain_key(index)] = blockid
+            self._chainstore[self.HeightKey] = len(chain) - 1
+
+        previd = NullIdentifier
+        for blockid in chain:
+            if blockid not in self._heights:
+                self._add(blockid, previd)
+            previd = blockid
+        self._chain = chain
+
+    def seed(self, blockids):
+        """Load a committed chain from its identifiers alone, for a journal
+        whose block store only holds the most recent blocks.
+
+        Args:
+            blockids (list): The identifiers of the committed chain in
+                height order, starting with the genesis block.
+        """
+        self._chain = []
+
+        previd = NullIdentifier
+        for height, blockid in enumerate(blockids):
+            self._heights[blockid] = height
+            self._previous[blockid] = previd
+            if height > 0:
+                self._skips[blockid] = blockids[_skip_height(height)]
+            self._chainstore[self._chain_key(height)] = blockid
+            previd = blockid
+
+        self._chainstore[self.HeightKey] = len(blockids) - 1
+        self._chain = list(blockids)
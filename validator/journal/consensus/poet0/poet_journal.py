@@ -14,12 +14,13 @@
 # ------------------------------------------------------------------------------
 
 import collections
+import copy
 import logging
 import importlib
 
 from time import time
 
-from gossip import common, stats
+from gossip import stats
 from journal import journal_core
 from journal.consensus.poet0 import poet_transaction_block
 from journal.consensus.poet0.wait_timer import WaitTimer
@@ -169,7 +170,7 @@ class PoetJournal(journal_core.Journal):
                 round(nblock.WaitTimer.duration, 2)
 
             for txnid in nblock.TransactionIDs:
-                txn = self.TransactionStore[txnid]
+                txn = copy.copy(self.TransactionStore[txnid])
                 txn.InBlock = "Uncommitted"
                 self.TransactionStore[txnid] = txn
             # fire the build block event handlers
@@ -210,7 +211,8 @@ class PoetJournal(journal_core.Journal):
         certs = collections.deque()
         count = WaitTimer.certificate_sample_length
 
-        while block.PreviousBlockID != common.NullIdentifier \
+        # a journal started from a snapshot only holds recent blocks
+        while block.PreviousBlockID in self.BlockStore \
                 and len(certs) < count:
             block = self.BlockStore[block.PreviousBlockID]
             certs.appendleft(block.WaitCertificate)
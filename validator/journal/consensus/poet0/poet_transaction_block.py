@@ -20,7 +20,6 @@ from threading import RLock
 from journal import transaction_block
 from journal.messages import transaction_block_message
 from journal.consensus.poet0.wait_certificate import WaitCertificate, WaitTimer
-from gossip.common import NullIdentifier
 
 logger = logging.getLogger(__name__)
 
@@ -155,8 +154,9 @@ class PoetTransactionBlock(transaction_block.TransactionBlock):
             assert self.WaitCertificate
             self.AggregateLocalMean = self.WaitCertificate.local_mean
 
-            if self.PreviousBlockID != NullIdentifier:
-                assert self.PreviousBlockID in journal.BlockStore
+            # the oldest block of a journal started from a snapshot has no
+            # predecessor, weights are counted from there
+            if self.PreviousBlockID in journal.BlockStore:
                 self.AggregateLocalMean += \
                     journal.BlockStore[self.PreviousBlockID].AggregateLocalMean
 
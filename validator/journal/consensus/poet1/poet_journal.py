@@ -14,6 +14,7 @@
 # ------------------------------------------------------------------------------
 
 import collections
+import copy
 import logging
 import importlib
 
@@ -169,7 +170,7 @@ class PoetJournal(journal_core.Journal):
                 round(nblock.WaitTimer.duration, 2)
 
             for txnid in nblock.TransactionIDs:
-                txn = self.TransactionStore[txnid]
+                txn = copy.copy(self.TransactionStore[txnid])
                 txn.InBlock = "Uncommitted"
                 self.TransactionStore[txnid] = txn
             # fire the build block event handlers
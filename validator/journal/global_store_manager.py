@@ -14,12 +14,18 @@
 # ------------------------------------------------------------------------------
 
 import anydbm
+import collections
 import logging
 import copy
+import hashlib
+import os
+import whichdb
 
 import cbor
 
 from gossip.common import cbor2dict, dict2cbor, NullIdentifier
+from journal.state_history import StateHistoryFactory
+from journal.state_log import StateLog, read_snapshot, write_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +36,115 @@ class ReadOnlyException(BaseException):
     pass
 
 
+class ReadOnlyDict(collections.Mapping):
+    """A read-only view of a dictionary held in a store.
+
+    The view does not copy the underlying dictionary, nested dictionaries
+    and lists are wrapped in views as they are accessed. Use thaw() (or
+    copy.deepcopy) to get a private, modifiable copy.
+    """
+
+    __slots__ = ['_data']
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return freeze(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._data, memo)
+
+    def __copy__(self):
+        return copy.copy(self._data)
+
+    def thaw(self):
+        """Returns a modifiable copy of the underlying dictionary.
+        """
+        return copy.deepcopy(self._data)
+
+
+class ReadOnlyList(collections.Sequence):
+    """A read-only view of a list held in a store.
+    """
+
+    __slots__ = ['_data']
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReadOnlyList(self._data[index])
+        return freeze(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._data, memo)
+
+    def __copy__(self):
+        return copy.copy(self._data)
+
+    def thaw(self):
+        """Returns a modifiable copy of the underlying list.
+        """
+        return copy.deepcopy(self._data)
+
+
+def freeze(value):
+    """Wrap a value from a store in a read-only view without copying it.
+
+    Args:
+        value (object): The value to wrap.
+
+    Returns:
+        object: A ReadOnlyDict or ReadOnlyList for dictionaries and
+            lists, otherwise the value itself.
+    """
+    if isinstance(value, dict):
+        return ReadOnlyDict(value)
+    if isinstance(value, list):
+        return ReadOnlyList(value)
+    return value
+
+
 class GlobalStoreManager(object):
     """The GlobalStoreManager class encapsulates persistent management
     of state associated with blocks in the ledger.
@@ -40,41 +155,133 @@ class GlobalStoreManager(object):
     with the method CommitRootBlock. This step is necessary whether or not
     this is the first time the validator is run.
 
+    The state of each committed block is appended to a checksummed log as
+    the delta from its predecessor. Periodically, when an old block is
+    flattened, the full state of that block is written to a snapshot and
+    the log is compacted to the blocks that follow it, so a restart only
+    needs to load the snapshot and replay the tail of the log.
+
+    State written by earlier versions to a dbm file named blockstorefile
+    is imported into the log the first time the log is opened.
+
     Attributes:
         RootBlockID (str): The ID of the root block.
+        SyncInterval (int): The number of committed blocks appended to
+            the log between forced writes to disk.
+        SnapshotInterval (int): The minimum number of committed blocks
+            between snapshots, 0 disables snapshots.
     """
 
     RootBlockID = NullIdentifier
 
-    def __init__(self, blockstorefile='blockstore', dbmode='c'):
+    def __init__(self, blockstorefile='blockstore', dbmode='c',
+                 historytype=None, syncinterval=1, snapshotinterval=1000):
         """Initialize a GlobalStoreManager, opening the database file.
 
         Args:
             blockstorefile (str): The name of the file to use for
-                persistent data.
-            dbmode (str): The mode used to open the file (see anydbm
-                parameters).
+                persistent data, the log and snapshot files are named
+                by replacing its extension.
+            dbmode (str): The mode used to open the file, 'n' to start
+                with empty state or 'c' to restore existing state.
+            historytype (str): The type of versioned history used to
+                hold flattened state, one of None, 'memory' or 'lmdb'.
+                With no history, flattening copies the full state into
+                a single dictionary.
+            syncinterval (int): The number of committed blocks appended
+                to the log between forced writes to disk.
+            snapshotinterval (int): The minimum number of committed
+                blocks between snapshots, 0 disables snapshots.
         """
         logger.info('create blockstore from file %s with flag %s',
                     blockstorefile, dbmode)
 
+        self.SyncInterval = max(1, syncinterval)
+        self.SnapshotInterval = snapshotinterval
+
+        basename = os.path.splitext(blockstorefile)[0]
+        self._snapshotfile = basename + '.snapshot'
+        if dbmode == 'n' and os.path.isfile(self._snapshotfile):
+            os.remove(self._snapshotfile)
+
         self._blockmap = {}
-        self._persistmap = anydbm.open(blockstorefile, dbmode)
+        self._statelog = StateLog(basename + '.log', dbmode)
+        self._unsynced = 0
+        self._sincesnapshot = 0
+
+        self._snapshotid = None
+        self._export = None
+        snapshot = read_snapshot(self._snapshotfile)
+        if snapshot is not None:
+            self._snapshotid = snapshot[0]
+
+        if dbmode == 'n':
+            for filename in _legacy_files(blockstorefile):
+                os.remove(filename)
+        elif len(self._statelog) == 0 and self._snapshotid is None and \
+                whichdb.whichdb(blockstorefile):
+            self._import_legacy(blockstorefile)
+
+        self._historyfactory = None
+        if historytype is not None and historytype != 'none':
+            historyfile = basename + '_history.lmdb'
+            self._historyfactory = StateHistoryFactory(historytype,
+                                                       historyfile)
 
         rootstore = BlockStore()
         rootstore.commit_block(self.RootBlockID)
         self._blockmap[self.RootBlockID] = rootstore
-        self._persistmap[self.RootBlockID] = \
-            dict2cbor(rootstore.dump_block(True))
-        self._persistmap.sync()
 
         logger.debug('the persistent block store has %s keys',
-                     len(self._persistmap))
+                     len(self.persistmap_keys()))
+
+    def _import_legacy(self, blockstorefile):
+        """Append the blocks held in a dbm file written by earlier
+        versions to the state log, each block after its predecessor.
+        """
+        logger.warn('import state from legacy database %s', blockstorefile)
+
+        legacy = anydbm.open(blockstorefile, 'r')
+        try:
+            previous = {}
+            for blockid in legacy.keys():
+                if blockid != self.RootBlockID:
+                    previous[blockid] = \
+                        cbor2dict(legacy[blockid])['PreviousBlockID']
+
+            depth = {}
+            for blockid in previous:
+                chain = []
+                while blockid in previous and blockid not in depth:
+                    chain.append(blockid)
+                    blockid = previous[blockid]
+                count = depth.get(blockid, 0)
+                for blockid in reversed(chain):
+                    count += 1
+                    depth[blockid] = count
+
+            for blockid in sorted(previous, key=depth.get):
+                self._statelog.append(blockid, previous[blockid],
+                                      legacy[blockid])
+            self._statelog.sync()
+        finally:
+            legacy.close()
+
+        logger.info('imported %d blocks from %s', len(previous),
+                    blockstorefile)
 
     def close(self):
         """Close the database file.
         """
-        self._persistmap.close()
+        self._statelog.close()
+        if self._historyfactory is not None:
+            self._historyfactory.close()
+
+    def sync(self):
+        """Force the state of all committed blocks to disk.
+        """
+        self._statelog.sync()
+        self._unsynced = 0
 
     def add_transaction_store(self, tname, tstore):
         """Registers a data store type with a particular transaction type.
@@ -90,14 +297,27 @@ class GlobalStoreManager(object):
         # initialization
         assert len(self._blockmap) == 1
 
+        if self._historyfactory is not None:
+            tstore.attach_history(self._historyfactory.create(tname))
+
         rootstore = self._blockmap[self.RootBlockID]
         rootstore.add_transaction_store(tname, tstore)
 
         rootstore.commit_block(self.RootBlockID)
         self._blockmap[self.RootBlockID] = rootstore
-        self._persistmap[self.RootBlockID] = \
-            dict2cbor(rootstore.dump_block(True))
-        self._persistmap.sync()
+
+    def _persisted(self, blockid):
+        return blockid == self.RootBlockID \
+            or blockid == self._snapshotid \
+            or blockid in self._statelog
+
+    def has_block_store(self, blockid):
+        """Determines whether the state of a block is available.
+
+        Args:
+            blockid (str): Identifier associated with the block.
+        """
+        return blockid in self._blockmap or self._persisted(blockid)
 
     def commit_block_store(self, blockid, blockstore):
         """Associates the blockstore with the blockid and commits
@@ -113,12 +333,27 @@ class GlobalStoreManager(object):
 
         # if we commit a block then we know that either this is the genesis
         # block or that the previous block is committed already
-        assert blockstore.PreviousBlockID in self._persistmap
+        assert self._persisted(blockstore.PreviousBlockID)
 
         blockstore.commit_block(blockid)
         self._blockmap[blockid] = blockstore
-        self._persistmap[blockid] = dict2cbor(blockstore.dump_block(True))
-        self._persistmap.sync()
+        self._statelog.append(blockid, blockstore.PreviousBlockID,
+                              dict2cbor(blockstore.dump_block(True)))
+
+        self._sincesnapshot += 1
+        self._unsynced += 1
+        if self._unsynced >= self.SyncInterval:
+            self.sync()
+
+    def _load_snapshot(self):
+        logger.info('load state snapshot for block %s', self._snapshotid)
+        (blockid, _, payload) = read_snapshot(self._snapshotfile)
+        assert blockid == self._snapshotid
+
+        rootstore = self._blockmap[self.RootBlockID]
+        blockstore = rootstore.clone_block(cbor.loads(payload), True)
+        blockstore.commit_block(blockid)
+        self._blockmap[blockid] = blockstore
 
     def require_store(self, blockid):
         """Ensure that the store for this block (including all dependent
@@ -132,23 +367,27 @@ class GlobalStoreManager(object):
         # like avoiding recursion is a very useful thing
 
         # pass 1... build the list of blocks that we need to load in order
-        # to load the current block
+        # to load the current block, the walk ends at a block in memory or
+        # at the snapshot which holds the complete state of its block
         blocklist = []
         while blockid not in self._blockmap:
+            if blockid == self._snapshotid:
+                self._load_snapshot()
+                break
+
             logger.info('add block %s to the queue for loading', blockid)
             blocklist.insert(0, blockid)
 
-            if blockid not in self._persistmap:
+            if blockid not in self._statelog:
                 raise KeyError('unknown block', blockid)
 
-            blockinfo = cbor2dict(self._persistmap[blockid])
-            blockid = blockinfo['PreviousBlockID']
+            blockid = self._statelog.previous_block_id(blockid)
 
         # pass 2... starting with the oldest block, begin to load
         # the stores
         for blockid in blocklist:
             logger.info('load block %s from storage', blockid)
-            blockinfo = cbor.loads(self._persistmap[blockid])
+            blockinfo = cbor.loads(self._statelog.read(blockid))
             prevstore = self._blockmap[blockinfo['PreviousBlockID']]
             blockstore = prevstore.clone_block(blockinfo, True)
             blockstore.commit_block(blockid)
@@ -198,7 +437,9 @@ class GlobalStoreManager(object):
         Flattening creates duplicate copies of the objects so it is
         important to release the history of the blockstore from memory.
         It is best if this is called only for relatively old blocks
-        that are unlikely to be rolled back.
+        that are unlikely to be rolled back. Once enough blocks have been
+        committed since the last snapshot, the flattened block becomes
+        the new snapshot.
 
         Args:
             blockid (str): Identifier associated with the block.
@@ -207,13 +448,138 @@ class GlobalStoreManager(object):
         blockstore = self.get_block_store(blockid)
         blockstore.flatten()
 
+        if self.SnapshotInterval > 0 and \
+                self._sincesnapshot >= self.SnapshotInterval and \
+                blockid in self._statelog:
+            self.snapshot_block_store(blockid)
+
         self.flush_block_store(blockstore.PreviousBlockID)
 
+    def snapshot_block_store(self, blockid):
+        """Write the complete state of a block to the snapshot and drop
+        the log records that are no longer reachable from it.
+
+        Blocks that precede the snapshot block, and forks that branch
+        from them, can no longer be loaded from storage afterwards.
+
+        Args:
+            blockid (str): Identifier associated with the block.
+        """
+        logger.info('write state snapshot for block %s', blockid)
+
+        blockstore = self.get_block_store(blockid)
+
+        self.sync()
+        write_snapshot(self._snapshotfile, blockid,
+                       blockstore.PreviousBlockID,
+                       self._encode_snapshot(blockid))
+        self._snapshotid = blockid
+        self._sincesnapshot = 0
+
+        # keep only the records that descend from the snapshot block
+        reachable = {blockid: False}
+        for bid in self._statelog.keys():
+            path = []
+            while bid not in reachable:
+                path.append(bid)
+                if bid not in self._statelog:
+                    reachable[bid] = False
+                    break
+                bid = self._statelog.previous_block_id(bid)
+
+            keep = reachable[bid] or bid == blockid
+            for pid in path:
+                reachable[pid] = keep
+
+        self._statelog.compact(
+            [b for b in self._statelog.keys() if reachable[b]])
+
+    def _encode_snapshot(self, blockid):
+        """Encode the complete state of a block as a block that follows
+        the root block. The encoding only depends on the state, so every
+        node produces the same bytes for the same block.
+        """
+        blockstore = self.get_block_store(blockid)
+        blockinfo = dict()
+        blockinfo['BlockID'] = blockid
+        blockinfo['PreviousBlockID'] = self.RootBlockID
+        blockinfo['TransactionStores'] = {}
+        for tname, tstore in blockstore.TransactionStores.iteritems():
+            blockinfo['TransactionStores'][tname] = {
+                'Store': tstore.compose(readonly=True),
+                'DeletedKeys': []
+            }
+        return dict2cbor(blockinfo)
+
+    def export_snapshot(self, blockid, chunksize):
+        """Encode the complete state of a block and split it into chunks
+        so that it can be sent to a node that is joining the network.
+
+        The most recent export is kept since every chunk of a snapshot is
+        requested separately.
+
+        Args:
+            blockid (str): Identifier associated with the block.
+            chunksize (int): The size of each chunk in bytes.
+
+        Returns:
+            tuple: (hashes, chunks) where hashes is the list of sha256
+                hex digests of the chunks in order and chunks maps each
+                digest to its data.
+
+        Raises:
+            KeyError: If the state of the block is not available.
+        """
+        if self._export is None or self._export[:2] != (blockid, chunksize):
+            logger.info('export state snapshot for block %s', blockid)
+            payload = self._encode_snapshot(blockid)
+            hashes = []
+            chunks = {}
+            for offset in xrange(0, len(payload), chunksize):
+                data = payload[offset:offset + chunksize]
+                digest = hashlib.sha256(data).hexdigest()
+                hashes.append(digest)
+                chunks[digest] = data
+            self._export = (blockid, chunksize, hashes, chunks)
+
+        return self._export[2], self._export[3]
+
+    def install_snapshot(self, blockid, previd, payload):
+        """Use a snapshot received from another node as the state of a
+        block. The state of the blocks that precede it is not available.
+
+        Args:
+            blockid (str): Identifier associated with the block.
+            previd (str): Identifier of the block that precedes it.
+            payload (bytes): The output of export_snapshot, reassembled.
+        """
+        # a snapshot can only replace an empty state
+        assert len(self._blockmap) == 1 and len(self._statelog) == 0
+
+        logger.info('install state snapshot for block %s', blockid)
+        write_snapshot(self._snapshotfile, blockid, previd, payload)
+        self._snapshotid = blockid
+        self._sincesnapshot = 0
+        self._load_snapshot()
+
     def persistmap_keys(self):
         '''
         Returns: a list of the block ids in the persistent store
         '''
-        return self._persistmap.keys()
+        keys = [self.RootBlockID]
+        if self._snapshotid is not None:
+            keys.append(self._snapshotid)
+        keys.extend(self._statelog.keys())
+        return keys
+
+
+def _legacy_files(blockstorefile):
+    """Returns the names of the files that hold a dbm database written
+    by earlier versions, the dbm modules add their own extensions.
+    """
+    names = [blockstorefile] + [blockstorefile + ext for ext in
+                                ['.db', '.dat', '.dir', '.pag', '.bak']]
+    return [n for n in names if os.path.isfile(n)]
 
 
 class BlockStore(object):
@@ -339,11 +705,17 @@ class KeyValueStore(object):
     enables rollback through generational updates.
 
     For optimization the chain of stores can be flattened to limit
-    traversal of the chain.
+    traversal of the chain. When a StateHistory is attached to the root
+    of the chain, flattening moves the checkpoints into the history
+    rather than copying the composed state, and the flattened store
+    reads the settled state from the history.
 
     Attributes:
         ReadOnly (bool): Whether or not the store is read only.
         PrevStore (KeyValueStore): The previous checkpoint of the store.
+        History (StateHistory): The versioned history shared by the
+            chain of stores, None if flattening composes the state.
+        Version (int): The depth of this checkpoint in the chain.
     """
 
     def __init__(self, prevstore=None, storeinfo=None, readonly=False):
@@ -358,6 +730,9 @@ class KeyValueStore(object):
 
         self.ReadOnly = False
         self.PrevStore = prevstore
+        self.History = prevstore.History if prevstore else None
+        self.Version = prevstore.Version + 1 if prevstore else 0
+        self._settled = False
         copyfn = copy.copy if readonly else copy.deepcopy
 
         if storeinfo:
@@ -379,6 +754,28 @@ class KeyValueStore(object):
         """
         return KeyValueStore(self, storeinfo, readonly)
 
+    def attach_history(self, history):
+        """Use a versioned history to hold the flattened state of this
+        store and the stores cloned from it.
+
+        The current contents of the store are moved into the history, so
+        this should be called on the root of a chain.
+
+        Args:
+            history (StateHistory): An empty history.
+        """
+        assert self.PrevStore is None
+
+        history.append(self.Version, self._store, self._deletedkeys)
+        self.History = history
+        self._settle()
+
+    def _settle(self):
+        self._store = dict()
+        self._deletedkeys = set()
+        self.PrevStore = None
+        self._settled = True
+
     def commit(self):
         """Marks the store as read only.
 
@@ -407,9 +804,16 @@ class KeyValueStore(object):
         store = self
         while store:
             storelist.insert(0, store)
+            if store._settled:
+                break
             store = store.PrevStore
 
         result = dict()
+        base = storelist[0]
+        if base._settled:
+            for k in base.History.keys(base.Version):
+                result[k] = copyfn(base.History.lookup(k, base.Version))
+
         for store in storelist:
             # copy our dictionary into the result
             result.update(copyfn(store._store))
@@ -430,29 +834,70 @@ class KeyValueStore(object):
         Collapse all previous stores into this one and remove any
         reverse references.
         """
-        if self.ReadOnly:
-            self._store = self.compose(readonly=True)
-            self._deletedkeys = set()
-            self.PrevStore = None
+        if not self.ReadOnly or self._settled:
+            return
 
-    def get(self, key):
-        """Gets the value associated with a key, cascading the
-        request through the chain of stores.
+        if self.History is not None and self._fold_history():
+            return
 
-        Args:
-            key (str): The key to lookup.
+        self._store = self.compose(readonly=True)
+        self._deletedkeys = set()
+        self.PrevStore = None
+
+    def _fold_history(self):
+        """Append the checkpoints between the most recently settled
+        store and this one to the history.
 
         Returns:
-            object: The value associated with the key.
+            bool: True if the checkpoints were appended, False if this
+                store does not extend the head of the history (for
+                example after a fork replaced settled blocks).
         """
+        stores = []
+        store = self
+        while store is not None and not store._settled:
+            if not store.ReadOnly:
+                return False
+            stores.append(store)
+            store = store.PrevStore
+
+        if store is None or store.History is not self.History \
+                or store.Version != self.History.LatestVersion:
+            return False
+
+        for store in reversed(stores):
+            self.History.append(store.Version, store._store,
+                                store._deletedkeys)
+
+        self._settle()
+        return True
+
+    def _lookup(self, key):
         store = self
         while store is not None and key not in store._deletedkeys:
             if key in store._store:
-                return copy.deepcopy(store._store[key])
+                return store._store[key]
+            if store._settled:
+                return store.History.lookup(key, store.Version)
 
             store = store.PrevStore
         raise KeyError('attempt to access missing key', key)
 
+    def get(self, key, readonly=False):
+        """Gets the value associated with a key, cascading the
+        request through the chain of stores.
+
+        Args:
+            key (str): The key to lookup.
+            readonly (bool): Whether to return a read-only view of the
+                stored value rather than a private copy.
+
+        Returns:
+            object: The value associated with the key.
+        """
+        value = self._lookup(key)
+        return freeze(value) if readonly else copy.deepcopy(value)
+
     def __getitem__(self, key):
         return self.get(key)
 
@@ -503,13 +948,7 @@ class KeyValueStore(object):
         Returns:
             bool: Whether or not the key exists in the store.
         """
-        if key in self._store:
-            return True
-
-        if self.PrevStore and key not in self._deletedkeys:
-            return key in self.PrevStore
-
-        return False
+        return key in self
 
     def _keys(self):
         """Computes the set of valid keys used in the store.
@@ -522,10 +961,14 @@ class KeyValueStore(object):
         store = self
         while store is not None:
             stores.append(store)
+            if store._settled:
+                break
             store = store.PrevStore
         stores.reverse()
         # reconstruct history
         retval = set()
+        if stores[0]._settled:
+            retval = stores[0].History.keys(stores[0].Version)
         for store in stores:
             retval -= store._deletedkeys
             retval |= set(store._store.keys())
@@ -545,11 +988,19 @@ class KeyValueStore(object):
         for k in self.keys():
             yield k
 
-    def iteritems(self):
+    def iteritems(self, readonly=False):
         """Creates an iterator for items in the store.
+
+        Args:
+            readonly (bool): Whether to return read-only views of the
+                stored values rather than private copies.
         """
-        for k in self.keys():
-            yield k, self.get(k)
+        if readonly:
+            for k, v in self.compose(readonly=True).iteritems():
+                yield k, freeze(v)
+        else:
+            for k in self.keys():
+                yield k, self.get(k)
 
     def __contains__(self, key):
         """Determines whether a key occurs in the store.
@@ -560,16 +1011,17 @@ class KeyValueStore(object):
         Returns:
             bool: Whether the key exists in the store.
         """
-        retval = False
         store = self
         while store is not None:
             if key in store._store:
-                retval = True
-                break
-            if key in self._deletedkeys:
-                break
+                return True
+            if key in store._deletedkeys:
+                return False
+            if store._settled:
+                return store.History.contains(key, store.Version)
             store = store.PrevStore
-        return retval
+
+        return False
 
     def dump(self, readonly=False):
         """Returns a dict containing information about the store.
@@ -580,7 +1032,10 @@ class KeyValueStore(object):
         copyfn = copy.copy if readonly else copy.deepcopy
 
         result = dict()
-        result['Store'] = copyfn(self._store)
+        if self._settled:
+            result['Store'] = self.compose(readonly)
+        else:
+            result['Store'] = copyfn(self._store)
         result['DeletedKeys'] = list(self._deletedkeys)
 
         return result
@@ -13,15 +13,19 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import copy
 import logging
-from threading import RLock
+from threading import Lock, RLock
 import time
 from collections import OrderedDict
 
-from gossip import common, event_handler, gossip_core, stats
+from gossip import common, event_handler, gossip_core, stats, wire_codec
+from gossip.signed_object import SignedObject
 from journal import transaction, transaction_block
 from journal import journal_store
+from journal.chain_index import ChainIndex
 from journal.global_store_manager import GlobalStoreManager
+from journal.messages import inventory_message
 from journal.messages import journal_debug
 from journal.messages import journal_transfer
 from journal.messages import transaction_block_message
@@ -95,6 +99,33 @@ class Journal(gossip_core.Gossip):
             which still need to be processed.
         GlobalStoreMap (GlobalStoreManager): Manages access to the
             various persistence stores.
+        ChainIndex (ChainIndex): Height and ancestry index of the
+            committed chain.
+        TransferWindow (int): The maximum number of block and transaction
+            requests outstanding during a journal transfer.
+        TransferPeerCount (int): The maximum number of peers a journal
+            transfer fetches blocks and transactions from.
+        TransferBatchSize (int): The maximum number of blocks or
+            transactions named in one journal transfer request.
+        TransferTimeout (float): The number of seconds a journal transfer
+            waits for a reply before asking another peer.
+        SyncMode (str): How a new node gets the ledger from its peers,
+            'full' replays every block and 'snapshot' starts from the
+            state of a recent block.
+        SnapshotSyncDepth (int): The number of blocks behind the head of
+            the peer's chain that a snapshot is taken.
+        SnapshotSyncHistory (int): The number of committed blocks, ending
+            with the snapshot block, fetched with a snapshot.
+        SignatureCacheFile (str): The file the signature cache is saved
+            to at shutdown, None if it is not saved.
+        ForwardMode (str): How handled transactions and blocks reach the
+            peers, 'flood' forwards the messages and 'announce' sends
+            batches of identifiers that the peers request if they lack
+            them.
+        AnnounceInterval (float): The number of seconds between inventory
+            announcements in 'announce' mode.
+        AnnounceBatchSize (int): The maximum number of identifiers in one
+            inventory announcement.
     """
 
     def __init__(self, node, **kwargs):
@@ -106,6 +137,43 @@ class Journal(gossip_core.Gossip):
                 with a genesis node.
             Restore (bool): Whether or not to restore block data.
             DataDirectory (str):
+            BlockCacheSize (int): The number of decoded blocks to keep in
+                memory, 0 disables the cache.
+            TransactionCacheSize (int): The number of decoded transactions
+                to keep in memory, 0 disables the cache.
+            StateHistoryType (str): The versioned history used to hold
+                flattened global state, one of 'none', 'memory' or 'lmdb'.
+            StateSyncInterval (int): The number of committed blocks
+                whose state is appended to the state log between forced
+                writes to disk.
+            StateSnapshotInterval (int): The minimum number of committed
+                blocks between snapshots of the global state, 0 disables
+                snapshots.
+            TransferWindow (int): The maximum number of block and
+                transaction requests outstanding during a journal transfer.
+            TransferPeerCount (int): The maximum number of peers a journal
+                transfer fetches blocks and transactions from.
+            TransferBatchSize (int): The maximum number of blocks or
+                transactions named in one journal transfer request.
+            TransferTimeout (float): The number of seconds a journal
+                transfer waits for a reply before asking another peer.
+            SyncMode (str): How a new node gets the ledger from its
+                peers, 'full' or 'snapshot'.
+            SnapshotSyncDepth (int): The number of blocks behind the head
+                of the peer's chain that a snapshot is taken.
+            SnapshotSyncHistory (int): The number of committed blocks,
+                ending with the snapshot block, fetched with a snapshot;
+                PoET needs at least as many as its certificate sample.
+            PersistSignatureCache (bool): Whether to save the signature
+                cache at shutdown and reload it when restoring, so that
+                the signers of recent transactions are not recovered
+                again.
+            ForwardMode (str): How handled transactions and blocks reach
+                the peers, 'flood' or 'announce'.
+            AnnounceInterval (float): The number of seconds between
+                inventory announcements in 'announce' mode.
+            AnnounceBatchSize (int): The maximum number of identifiers in
+                one inventory announcement.
         """
         super(Journal, self).__init__(node, **kwargs)
 
@@ -143,6 +211,20 @@ class Journal(gossip_core.Gossip):
         self.GenesisLedger = kwargs.get('GenesisLedger', False)
         self.Restore = kwargs.get('Restore', False)
 
+        # Parameters of the journal transfer used to join the network
+        self.TransferWindow = kwargs.get('TransferWindow', 16)
+        self.TransferPeerCount = kwargs.get('TransferPeerCount', 4)
+        self.TransferBatchSize = kwargs.get('TransferBatchSize', 100)
+        self.TransferTimeout = kwargs.get('TransferTimeout', 10.0)
+        self.SyncMode = kwargs.get('SyncMode', 'full')
+        self.SnapshotSyncDepth = kwargs.get('SnapshotSyncDepth', 10)
+        self.SnapshotSyncHistory = kwargs.get('SnapshotSyncHistory', 100)
+
+        # How handled transactions and blocks are sent on to the peers
+        self.ForwardMode = kwargs.get('ForwardMode', 'flood')
+        self.AnnounceInterval = kwargs.get('AnnounceInterval', 0.1)
+        self.AnnounceBatchSize = kwargs.get('AnnounceBatchSize', 500)
+
         # set up the event handlers that the transaction families can use
         self.onGenesisBlock = event_handler.EventHandler('onGenesisBlock')
         self.onPreBuildBlock = event_handler.EventHandler('onPreBuildBlock')
@@ -157,6 +239,8 @@ class Journal(gossip_core.Gossip):
         dbflag = 'c' if self.Restore else 'n'
         dbdir = kwargs.get('DataDirectory', 'db')
         store_type = kwargs.get('StoreType', 'shelf')
+        blockcachesize = kwargs.get('BlockCacheSize', 256)
+        txncachesize = kwargs.get('TransactionCacheSize', 4096)
 
         self._txn_lock = RLock()
         self.PendingTransactions = OrderedDict()
@@ -169,10 +253,12 @@ class Journal(gossip_core.Gossip):
 
             self.TransactionStore = journal_store.JournalStore(
                 shelf_database.ShelfDatabase(dbprefix + "_txn" + ".shelf",
-                                             dbflag))
+                                             dbflag),
+                txncachesize)
             self.BlockStore = journal_store.JournalStore(
                 shelf_database.ShelfDatabase(dbprefix + "_block" + ".shelf",
-                                             dbflag))
+                                             dbflag),
+                blockcachesize)
             self.ChainStore = journal_store.JournalStore(
                 shelf_database.ShelfDatabase(dbprefix + "_chain" + ".shelf",
                                              dbflag))
@@ -181,22 +267,45 @@ class Journal(gossip_core.Gossip):
 
             self.TransactionStore = journal_store.JournalStore(
                 lmdb_database.LMDBDatabase(dbprefix + "_txn" + ".lmdb",
-                                           dbflag))
+                                           dbflag),
+                txncachesize)
             self.BlockStore = journal_store.JournalStore(
                 lmdb_database.LMDBDatabase(dbprefix + "_block" + ".lmdb",
-                                           dbflag))
+                                           dbflag),
+                blockcachesize)
             self.ChainStore = journal_store.JournalStore(
                 lmdb_database.LMDBDatabase(dbprefix + "_chain" + ".lmdb",
                                            dbflag))
         else:
             raise KeyError("%s is not a supported StoreType", store_type)
 
+        self.ChainIndex = ChainIndex(self.BlockStore, self.ChainStore)
+
+        self.SignatureCacheFile = None
+        if kwargs.get('PersistSignatureCache', False):
+            self.SignatureCacheFile = dbprefix + "_signature.cache"
+            if self.Restore:
+                count = SignedObject.signature_cache.load(
+                    self.SignatureCacheFile)
+                logger.info('loaded %d recovered signers from %s', count,
+                            self.SignatureCacheFile)
+
         self.RequestedTransactions = {}
         self.RequestedBlocks = {}
 
         self.next_block_retry = time.time() + self.BlockRetryInterval
         self.onHeartbeatTimer += self._trigger_retry_blocks
 
+        # the identifiers waiting to be announced, the peers known to hold
+        # them and the requests for announced objects that are outstanding
+        self._inventory_lock = Lock()
+        self._announcements = OrderedDict()
+        self._inventorysources = {}
+        self._inventoryrequests = {}
+        self._nextannouncement = 0
+        if self.ForwardMode == 'announce':
+            self.onHeartbeatTimer += self._announceinventory
+
         self.MostRecentCommittedBlockID = common.NullIdentifier
         self.PendingTransactionBlock = None
 
@@ -204,13 +313,17 @@ class Journal(gossip_core.Gossip):
         self.InvalidBlockIDs = set()
 
         # Set up the global store and transaction handlers
-        self.GlobalStoreMap = GlobalStoreManager(dbprefix + "_state" + ".dbm",
-                                                 dbflag)
+        self.GlobalStoreMap = GlobalStoreManager(
+            dbprefix + "_state" + ".dbm", dbflag,
+            historytype=kwargs.get('StateHistoryType'),
+            syncinterval=kwargs.get('StateSyncInterval', 1),
+            snapshotinterval=kwargs.get('StateSnapshotInterval', 1000))
 
         # initialize the ledger stats data structures
         self._initledgerstats()
 
         # connect the message handlers
+        inventory_message.register_message_handlers(self)
         transaction_message.register_message_handlers(self)
         transaction_block_message.register_message_handlers(self)
         journal_transfer.register_message_handlers(self)
@@ -265,6 +378,9 @@ class Journal(gossip_core.Gossip):
         self.BlockStore.close()
         self.ChainStore.close()
 
+        if self.SignatureCacheFile is not None:
+            SignedObject.signature_cache.save(self.SignatureCacheFile)
+
         super(Journal, self).shutdown()
 
     def add_transaction_store(self, family):
@@ -277,6 +393,9 @@ class Journal(gossip_core.Gossip):
         tstore = family.TransactionStoreType()
         self.GlobalStoreMap.add_transaction_store(tname, tstore)
 
+        # transactions are also sent in batches without their messages
+        wire_codec.register_type(family)
+
     @property
     def GlobalStore(self):
         """Returns a reference to the global store associated with the
@@ -308,17 +427,85 @@ class Journal(gossip_core.Gossip):
         Returns:
             list: A list of committed block ids.
         """
-        if count == 0:
-            count = len(self.BlockStore)
+        self._checkchainindex()
+        return self.ChainIndex.committed_block_ids(count)
 
-        blockids = []
+    def committed_block_ids_by_height(self, height, count):
+        """Returns the list of block identifiers from the committed chain
+        in chain order, starting with the block at a given height.
 
-        blkid = self.MostRecentCommittedBlockID
-        while blkid != common.NullIdentifier and len(blockids) < count:
-            blockids.append(blkid)
-            blkid = self.BlockStore[blkid].PreviousBlockID
+        Args:
+            height (int): The height of the first block, 0 is the genesis
+                block.
+            count (int): How many results should be returned.
+
+        Returns:
+            list: A list of committed block ids.
+        """
+        self._checkchainindex()
+        return self.ChainIndex.block_ids(height, count)
+
+    def restore_snapshot(self, blockids, blocks, transactions, payload):
+        """Start the journal from a snapshot of the state of a committed
+        block, received from a peer during initialization.
+
+        The blocks and transactions that follow the snapshot block are
+        then committed as usual once initialization completes.
+
+        Args:
+            blockids (list): The identifiers of the committed chain from
+                the genesis block through the snapshot block.
+            blocks (list): The most recent committed blocks, in chain
+                order, ending with the snapshot block.
+            transactions (list): The transactions in those blocks.
+            payload (bytes): The encoded state of the snapshot block.
+
+        Returns:
+            bool: Whether the blocks are a signed suffix of the chain.
+        """
+        assert self.Initializing
+
+        if [b.Identifier for b in blocks] != blockids[-len(blocks):]:
+            logger.warn('snapshot blocks do not match the committed chain')
+            return False
+        for blk in blocks:
+            if not blk.verify_signature():
+                logger.warn('blkid: %s - invalid block in snapshot',
+                            blk.Identifier[:8])
+                return False
+
+        snapshotid = blockids[-1]
+        self.GlobalStoreMap.install_snapshot(
+            snapshotid, blocks[-1].PreviousBlockID, payload)
+
+        for txn in transactions:
+            txn.Status = transaction.Status.committed
+            self.TransactionStore[txn.Identifier] = txn
+
+        # weights are counted from the oldest block that is available
+        for blk in blocks:
+            for txnid in blk.TransactionIDs:
+                txn = copy.copy(self.TransactionStore.get(txnid))
+                if txn:
+                    txn.InBlock = blk.Identifier
+                    self.TransactionStore[txnid] = txn
+            blk.Status = transaction_block.Status.valid
+            blk.update_block_weight(self)
+            self.BlockStore[blk.Identifier] = blk
 
-        return blockids
+        self.ChainIndex.seed(blockids)
+        self.MostRecentCommittedBlockID = snapshotid
+        self.ChainStore['MostRecentBlockID'] = snapshotid
+
+        logger.info('ledger restored from snapshot of block %s at height %d',
+                    snapshotid[:8], len(blockids) - 1)
+        return True
+
+    def _checkchainindex(self):
+        # the head can be set directly, for example while restoring, so
+        # make sure the index follows it before using it
+        if self.ChainIndex.Head != self.MostRecentCommittedBlockID:
+            self.ChainIndex.load(self.MostRecentCommittedBlockID)
 
     def compute_chain_root(self):
         """
@@ -377,6 +564,8 @@ class Journal(gossip_core.Gossip):
                             'recomputing')
                 self.MostRecentCommittedBlockID = self.compute_chain_root()
 
+            self.ChainIndex.load(self.MostRecentCommittedBlockID)
+
             return
 
         for txn in self.InitialTransactions:
@@ -625,6 +814,98 @@ class Journal(gossip_core.Gossip):
                                  exceptions=exceptions,
                                  initialize=False)
 
+    def propagate_message(self, msg, objectid, isblock=False):
+        """Sends a handled transaction or block message on to the peers.
+
+        In 'flood' mode the message is forwarded to every peer but the
+        sender. In 'announce' mode only the identifier is announced, in a
+        batch with others, and the peers that lack the object request it.
+
+        Args:
+            msg (message.Message): The transaction or block message.
+            objectid (str): The identifier of the transaction or block.
+            isblock (bool): Whether the message carries a block.
+        """
+        if self.ForwardMode != 'announce':
+            self.forward_message(msg,
+                                 exceptions=[msg.SenderID],
+                                 initialize=False)
+            return
+
+        with self._inventory_lock:
+            self._announcements[objectid] = isblock
+            self._inventorysources.setdefault(objectid, set()).add(
+                msg.SenderID)
+            self._inventoryrequests.pop(objectid, None)
+
+    def inventory_received(self, peerid, txnids, blockids):
+        """Requests the announced transactions and blocks that are not in
+        the journal from the peer that announced them. An object already
+        requested from another peer is not requested again until that
+        request expires.
+
+        Args:
+            peerid (str): The identifier of the announcing peer.
+            txnids (list): The identifiers of the announced transactions.
+            blockids (list): The identifiers of the announced blocks.
+        """
+        now = time.time()
+        wanted = {'TransactionIDs': [], 'BlockIDs': []}
+        with self._inventory_lock:
+            for (key, objectids, store) in [
+                    ('TransactionIDs', txnids, self.TransactionStore),
+                    ('BlockIDs', blockids, self.BlockStore)]:
+                for objectid in objectids:
+                    if objectid in store:
+                        continue
+
+                    self._inventorysources.setdefault(objectid, set()).add(
+                        peerid)
+                    if self._inventoryrequests.get(objectid, 0) > now:
+                        continue
+
+                    self._inventoryrequests[objectid] = \
+                        now + self.MissingRequestInterval
+                    wanted[key].append(objectid)
+
+        if wanted['TransactionIDs'] or wanted['BlockIDs']:
+            self.send_message(
+                inventory_message.InventoryRequestMessage(wanted), peerid)
+
+    def _announceinventory(self, now):
+        """A periodic handler that announces the transactions and blocks
+        handled since the last announcement. Peers known to hold every
+        object in a batch are skipped.
+
+        Args:
+            now (float): Current time.
+        """
+        if now < self._nextannouncement:
+            return
+
+        self._nextannouncement = now + self.AnnounceInterval
+
+        with self._inventory_lock:
+            announcements = self._announcements.items()
+            self._announcements = OrderedDict()
+            sources = [self._inventorysources.pop(objectid, set())
+                       for (objectid, _) in announcements]
+
+            # forget the requests that were never answered
+            for (objectid, exptime) in self._inventoryrequests.items():
+                if exptime < now:
+                    del self._inventoryrequests[objectid]
+                    self._inventorysources.pop(objectid, None)
+
+        size = self.AnnounceBatchSize
+        for start in xrange(0, len(announcements), size):
+            batch = announcements[start:start + size]
+            msg = inventory_message.InventoryMessage({
+                'TransactionIDs': [o for (o, isblock) in batch if not isblock],
+                'BlockIDs': [o for (o, isblock) in batch if isblock]})
+            exceptions = set.intersection(*sources[start:start + size])
+            self.forward_message(msg, exceptions=list(exceptions))
+
     def build_transaction_block(self, genesis=False):
         """Builds the next transaction block for the ledger.
 
@@ -736,6 +1017,9 @@ class Journal(gossip_core.Gossip):
 
         assert tblock.Identifier in self.PendingBlockIDs
 
+        # the block may come from the block store, which shares its values
+        tblock = copy.copy(tblock)
+
         with self._txn_lock:
             # initialize the state of this block
             self.BlockStore[tblock.Identifier] = tblock
@@ -937,12 +1221,14 @@ class Journal(gossip_core.Gossip):
                 if txnid in self.PendingTransactions:
                     del self.PendingTransactions[txnid]
 
-                txn = self.TransactionStore[txnid]
+                txn = copy.copy(self.TransactionStore[txnid])
                 txn.Status = transaction.Status.committed
                 txn.InBlock = tblock.Identifier
                 self.TransactionStore[txnid] = txn
 
             # Update the head of the chain
+            self._checkchainindex()
+            self.ChainIndex.push(tblock.Identifier)
             self.MostRecentCommittedBlockID = tblock.Identifier
             self.ChainStore['MostRecentBlockID'] = \
                 self.MostRecentCommittedBlockID
@@ -984,6 +1270,8 @@ class Journal(gossip_core.Gossip):
             self.onDecommitBlock.fire(self, block)
 
             # move the head of the chain back
+            self._checkchainindex()
+            self.ChainIndex.pop()
             self.MostRecentCommittedBlockID = block.PreviousBlockID
             self.ChainStore['MostRecentBlockID'] = \
                 self.MostRecentCommittedBlockID
@@ -996,7 +1284,7 @@ class Journal(gossip_core.Gossip):
                 # there is a chance that this block is incomplete and some
                 # of the transactions have not arrived, don't put
                 # transactions into pending if we dont have the transaction
-                txn = self.TransactionStore.get(txnid)
+                txn = copy.copy(self.TransactionStore.get(txnid))
                 if txn:
                     txn.Status = transaction.Status.pending
                     self.TransactionStore[txnid] = txn
@@ -1059,16 +1347,8 @@ class Journal(gossip_core.Gossip):
         :param depth int: depth in the current chain to search, 0 implies all
         """
 
-        blockids = set(self.committed_block_ids(0))
-        forkid = tblock.PreviousBlockID
-        while True:
-            if forkid == common.NullIdentifier or forkid in blockids:
-                return forkid
-
-            assert forkid in self.BlockStore
-            forkid = self.BlockStore[forkid].PreviousBlockID
-
-        return None
+        self._checkchainindex()
+        return self.ChainIndex.find_fork(tblock.PreviousBlockID)
 
     def _preparetransactionlist(self, maxcount=0):
         """
@@ -1186,6 +1466,7 @@ class Journal(gossip_core.Gossip):
             # if all of the dependencies have not been met then there isn't any
             # point in continuing on so bail out
             if not ready:
+                txn = copy.copy(txn)
                 txn.increment_age()
                 self.TransactionStore[txn.Identifier] = txn
                 logger.info('txnid: %s - not ready (age %s)',
@@ -1238,14 +1519,15 @@ class Journal(gossip_core.Gossip):
                     % self.MaximumBlocksToKeep == 0:
                 logger.info('compress global state for block number %s',
                             self.MostRecentCommittedBlock.BlockNum)
-                depth = 0
-                blockid = self.MostRecentCommittedBlockID
-                while (blockid != common.NullIdentifier and
-                       depth < self.MaximumBlocksToKeep):
-                    blockid = self.BlockStore[blockid].PreviousBlockID
-                    depth += 1
-
-                if blockid != common.NullIdentifier:
+                self._checkchainindex()
+                height = self.ChainIndex.Height - self.MaximumBlocksToKeep
+                blockid = self.ChainIndex.ancestor(
+                    self.MostRecentCommittedBlockID, max(height, -1))
+
+                # a node started from a snapshot has no state for the
+                # blocks that precede it
+                if blockid != common.NullIdentifier and \
+                        self.GlobalStoreMap.has_block_store(blockid):
                     logger.debug('flatten storage for block %s', blockid)
                     self.GlobalStoreMap.flatten_block_store(blockid)
 
@@ -1278,6 +1560,19 @@ class Journal(gossip_core.Gossip):
 
         self.StatDomains['ledgerconfig'] = self.JournalConfigStats
 
+        self.JournalCacheStats = stats.Stats(self.LocalNode.Name,
+                                             'ledgercache')
+        for name, jstore in [('Block', self.BlockStore),
+                             ('Transaction', self.TransactionStore)]:
+            self.JournalCacheStats.add_metric(stats.Sample(
+                name + 'CacheHits', lambda s=jstore: s.CacheHits))
+            self.JournalCacheStats.add_metric(stats.Sample(
+                name + 'CacheMisses', lambda s=jstore: s.CacheMisses))
+            self.JournalCacheStats.add_metric(stats.Sample(
+                name + 'CacheEvictions', lambda s=jstore: s.CacheEvictions))
+
+        self.StatDomains['ledgercache'] = self.JournalCacheStats
+
     def _id2name(self, nodeid):
         if nodeid in self.NodeMap:
             return str(self.NodeMap[nodeid])
@@ -13,6 +13,9 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+from collections import OrderedDict
+from threading import RLock
+
 
 class JournalStore(object):
     """JournalStore exposes dict-like behaviors on an underlying key-value
@@ -24,19 +27,41 @@ class JournalStore(object):
     of the underlying key-value database while continuing to provide a
     simple get/set semantic to consumers.
 
+    Decoding values from the database is expensive, so the JournalStore
+    can keep the most recently used values in a write-through cache.
+    Values returned from the cache are shared and must be treated as
+    read only, a caller that changes a value copies it first (copy.copy
+    is enough for the transactions and blocks in the journal) and writes
+    the copy back with set().
+
     Attributes:
         database (journal.database.Database): An instance of a class
             extending the Database interface.
+        CacheSize (int): The maximum number of values kept in the cache,
+            0 disables the cache.
+        CacheHits (int): The number of reads satisfied by the cache.
+        CacheMisses (int): The number of reads that went to the database.
+        CacheEvictions (int): The number of values evicted from the cache
+            to make room for more recently used values.
     """
 
-    def __init__(self, database):
+    def __init__(self, database, cachesize=0):
         """Constructor for the JournalStore class.
 
         Args:
             database (journal.database.Database): An instance of a class
                 extending the database interface.
+            cachesize (int): The maximum number of values to keep in the
+                cache, 0 disables the cache.
         """
         self._database = database
+        self._cache = OrderedDict()
+        self._lock = RLock()
+
+        self.CacheSize = cachesize
+        self.CacheHits = 0
+        self.CacheMisses = 0
+        self.CacheEvictions = 0
 
     def __getitem__(self, key):
         return self.get(key)
@@ -48,15 +73,38 @@ class JournalStore(object):
         return len(self._database)
 
     def __contains__(self, key):
+        with self._lock:
+            if key in self._cache:
+                return True
         return key in self._database
 
+    def _cache_value(self, key, value):
+        self._cache[key] = value
+        while len(self._cache) > self.CacheSize:
+            self._cache.popitem(last=False)
+            self.CacheEvictions += 1
+
     def get(self, key):
         """Retrieves a value associated with a key from the database
 
         Args:
             key (str): The key to retrieve
         """
-        return self._database.get(key)
+        if self.CacheSize <= 0:
+            return self._database.get(key)
+
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self._cache[key] = value
+                self.CacheHits += 1
+                return value
+
+            self.CacheMisses += 1
+            value = self._database.get(key)
+            if value is not None:
+                self._cache_value(key, value)
+            return value
 
     def set(self, key, value):
         """Sets a value associated with a key in the database
@@ -65,7 +113,11 @@ class JournalStore(object):
             key (str): The key to set.
             value (str): The value to associate with the key.
         """
-        self._database.set(key, value)
+        with self._lock:
+            self._database.set(key, value)
+            if self.CacheSize > 0:
+                self._cache.pop(key, None)
+                self._cache_value(key, value)
 
     def delete(self, key):
         """Removes a key:value from the database
@@ -73,7 +125,9 @@ class JournalStore(object):
         Args:
             key (str): The key to remove.
         """
-        self._database.delete(key)
+        with self._lock:
+            self._cache.pop(key, None)
+            self._database.delete(key)
 
     def sync(self):
         """Ensures that pending writes are flushed to disk
@@ -13,5 +13,5 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
-__all__ = ['journal_debug', 'journal_transfer', 'transaction_block_message',
-           'transaction_message']
+__all__ = ['inventory_message', 'journal_debug', 'journal_transfer',
+           'transaction_block_message', 'transaction_message']
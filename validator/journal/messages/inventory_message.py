@@ -0,0 +1,125 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import logging
+
+from gossip import message
+
+logger = logging.getLogger(__name__)
+
+
+def register_message_handlers(journal):
+    """Registers the inventory message handlers with the journal.
+
+    Args:
+        journal (journal_core.Journal): The journal to register the message
+            handlers against.
+    """
+    journal.register_message_handler(InventoryMessage, _inventoryhandler)
+    journal.register_message_handler(InventoryRequestMessage,
+                                     _inventoryrequesthandler)
+
+
+class InventoryMessage(message.Message):
+    """Announces the transactions and blocks that a node has handled, so
+    that its peers can request the ones they lack.
+
+    Attributes:
+        InventoryMessage.MessageType (str): The class name of the message.
+        TransactionIDs (list): The identifiers of the announced
+            transactions.
+        BlockIDs (list): The identifiers of the announced blocks.
+    """
+    MessageType = "/journal.messages.InventoryMessage/Inventory"
+    DispatchLane = 'Transaction'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(InventoryMessage, self).__init__(minfo)
+
+        self.IsSystemMessage = False
+        self.IsForward = False
+        self.IsReliable = True
+
+        self.TransactionIDs = minfo.get('TransactionIDs', [])
+        self.BlockIDs = minfo.get('BlockIDs', [])
+
+    def dump(self):
+        result = super(InventoryMessage, self).dump()
+        result['TransactionIDs'] = self.TransactionIDs
+        result['BlockIDs'] = self.BlockIDs
+
+        return result
+
+
+def _inventoryhandler(msg, journal):
+    journal.inventory_received(msg.SenderID, msg.TransactionIDs,
+                               msg.BlockIDs)
+
+
+class InventoryRequestMessage(message.Message):
+    """Requests the announced transactions and blocks that a node lacks
+    from the peer that announced them.
+
+    Attributes:
+        InventoryRequestMessage.MessageType (str): The class name of the
+            message.
+        TransactionIDs (list): The identifiers of the requested
+            transactions.
+        BlockIDs (list): The identifiers of the requested blocks.
+    """
+    MessageType = "/journal.messages.InventoryMessage/InventoryRequest"
+    DispatchLane = 'Transaction'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(InventoryRequestMessage, self).__init__(minfo)
+
+        self.IsSystemMessage = False
+        self.IsForward = False
+        self.IsReliable = True
+
+        self.TransactionIDs = minfo.get('TransactionIDs', [])
+        self.BlockIDs = minfo.get('BlockIDs', [])
+
+    def dump(self):
+        result = super(InventoryRequestMessage, self).dump()
+        result['TransactionIDs'] = self.TransactionIDs
+        result['BlockIDs'] = self.BlockIDs
+
+        return result
+
+
+def _inventoryrequesthandler(msg, journal):
+    # the objects go only to the peer that asked for them, which handles
+    # and announces them as if they had been forwarded
+    with journal._txn_lock:
+        for txnid in msg.TransactionIDs:
+            txn = journal.TransactionStore.get(txnid)
+            if txn:
+                journal.send_message(txn.build_message(), msg.SenderID)
+            else:
+                logger.debug('request for unknown transaction %s from %s',
+                             txnid[:8], msg.SenderID[:8])
+
+    for blockid in msg.BlockIDs:
+        blk = journal.BlockStore.get(blockid)
+        if blk:
+            journal.send_message(blk.build_message(), msg.SenderID)
+        else:
+            logger.debug('request for unknown block %s from %s',
+                         blockid[:8], msg.SenderID[:8])
@@ -13,9 +13,11 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import base64
 import logging
 
 from gossip import message
+from gossip.common import dict2cbor
 
 logger = logging.getLogger(__name__)
 
@@ -31,10 +33,31 @@ def register_message_handlers(journal):
     journal.register_message_handler(BlockRequestMessage, _blockrequesthandler)
     journal.register_message_handler(TransactionRequestMessage,
                                      _txnrequesthandler)
+    journal.register_message_handler(BlockBatchRequestMessage,
+                                     _blockbatchrequesthandler)
+    journal.register_message_handler(TransactionBatchRequestMessage,
+                                     _txnbatchrequesthandler)
+    journal.register_message_handler(SnapshotRequestMessage,
+                                     _snapshotrequesthandler)
+    journal.register_message_handler(SnapshotChunkRequestMessage,
+                                     _snapshotchunkrequesthandler)
+
+
+# Space left in a batch reply for the packet header, the message envelope
+# and signature, and the lists of identifiers
+BatchReserve = 1024
+
+
+def snapshot_chunk_size(journal):
+    """Returns the number of bytes of state in a snapshot chunk, chosen
+    so that one base64 encoded chunk fits in a batch reply.
+    """
+    return (journal.MaximumPacketSize - 2 * BatchReserve) // 4 * 3
 
 
 class BlockListRequestMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/BlockListRequest"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -76,12 +99,8 @@ def _blocklistrequesthandler(msg, journal):
     reply.InReplyTo = msg.Identifier
     reply.BlockListIndex = msg.BlockListIndex
 
-    blockids = journal.committed_block_ids()
-    blockids.reverse()
-
-    index = msg.BlockListIndex
-    if index < len(blockids):
-        reply.BlockIDs = blockids[index:index + 100]
+    reply.BlockIDs = journal.committed_block_ids_by_height(
+        msg.BlockListIndex, 100)
 
     logger.debug('sending %d committed blocks to %s for request %s',
                  len(reply.BlockIDs), source, msg.Identifier[:8])
@@ -90,6 +109,7 @@ def _blocklistrequesthandler(msg, journal):
 
 class BlockListReplyMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/BlockListReply"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -123,6 +143,7 @@ class BlockListReplyMessage(message.Message):
 
 class UncommittedListRequestMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/UncommittedListRequest"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -177,6 +198,7 @@ def _uncommittedlistrequesthandler(msg, journal):
 
 class UncommittedListReplyMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/UncommittedListReply"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -205,6 +227,7 @@ class UncommittedListReplyMessage(message.Message):
 
 class BlockRequestMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/BlockRequest"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -251,6 +274,7 @@ def _blockrequesthandler(msg, journal):
 
 class BlockReplyMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/BlockReply"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -277,6 +301,7 @@ class BlockReplyMessage(message.Message):
 
 class TransactionRequestMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/TransactionRequest"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -326,6 +351,7 @@ def _txnrequesthandler(msg, journal):
 
 class TransactionReplyMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/TransactionReply"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -351,6 +377,7 @@ class TransactionReplyMessage(message.Message):
 
 class TransferFailedMessage(message.Message):
     MessageType = "/journal.messages.JournalTransfer/TransferFailed"
+    DispatchLane = 'Transfer'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -364,3 +391,416 @@ class TransferFailedMessage(message.Message):
     def dump(self):
         result = super(TransferFailedMessage, self).dump()
         return result
+
+
+class BlockBatchRequestMessage(message.Message):
+    """Requests a batch of committed blocks together with their
+    transactions.
+
+    The blocks are named either by BlockIDs or, when BlockIDs is empty,
+    as BlockCount blocks of the committed chain starting at height
+    BlockListIndex.
+    """
+    MessageType = "/journal.messages.JournalTransfer/BlockBatchRequest"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(BlockBatchRequestMessage, self).__init__(minfo)
+        self.BlockIDs = minfo.get('BlockIDs', [])
+        self.BlockListIndex = minfo.get('BlockListIndex', 0)
+        self.BlockCount = minfo.get('BlockCount', 0)
+        self.IncludeTransactions = minfo.get('IncludeTransactions', True)
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(BlockBatchRequestMessage, self).dump()
+        result['BlockIDs'] = list(self.BlockIDs)
+        result['BlockListIndex'] = self.BlockListIndex
+        result['BlockCount'] = self.BlockCount
+        result['IncludeTransactions'] = self.IncludeTransactions
+        return result
+
+
+def _batch_budget(journal, objids):
+    """Returns the number of bytes available for objects in a batch reply,
+    after room has been set aside to return every requested identifier.
+    """
+    return journal.MaximumPacketSize - BatchReserve - \
+        sum(len(objid) + 3 for objid in objids)
+
+
+def _batchreplyfailed(msg, journal, kind):
+    if journal.Initializing:
+        src = journal.NodeMap.get(msg.OriginatorID, msg.OriginatorID[:8])
+        logger.warn(
+            'received %s batch transfer request from %s prior to completing '
+            'initialization',
+            kind, src)
+        journal.send_message(TransferFailedMessage(), msg.OriginatorID)
+        return True
+    return False
+
+
+def _blockbatchrequesthandler(msg, journal):
+    logger.debug('processing incoming block batch request for journal '
+                 'transfer')
+
+    if _batchreplyfailed(msg, journal, 'block'):
+        return
+
+    blockids = msg.BlockIDs
+    if not blockids:
+        blockids = journal.committed_block_ids_by_height(
+            msg.BlockListIndex, msg.BlockCount)
+
+    reply = BlockBatchReplyMessage()
+    reply.InReplyTo = msg.Identifier
+
+    # always send at least one block so that every reply makes progress,
+    # then stop at the first block or transaction that does not fit
+    budget = _batch_budget(journal, blockids)
+    for index, blockid in enumerate(blockids):
+        blk = journal.BlockStore.get(blockid)
+        if not blk:
+            reply.MissingIDs.append(blockid)
+            continue
+
+        bdata = blk.build_message().dump()
+        size = len(dict2cbor(bdata))
+        if reply.TransactionBlockMessages and size > budget:
+            reply.RemainingIDs = blockids[index:]
+            break
+        reply.TransactionBlockMessages.append(bdata)
+        budget -= size
+
+        full = False
+        if msg.IncludeTransactions:
+            for txnid in blk.TransactionIDs:
+                txn = journal.TransactionStore.get(txnid)
+                if not txn:
+                    continue
+                tdata = txn.build_message().dump()
+                size = len(dict2cbor(tdata))
+                if size > budget:
+                    full = True
+                    break
+                reply.TransactionMessages.append(tdata)
+                budget -= size
+
+        # transactions that did not fit are requested separately
+        if full:
+            reply.RemainingIDs = blockids[index + 1:]
+            break
+
+    logger.debug('sending %d blocks and %d transactions to %s for request '
+                 '%s, %d remaining',
+                 len(reply.TransactionBlockMessages),
+                 len(reply.TransactionMessages),
+                 journal.NodeMap.get(msg.OriginatorID, msg.OriginatorID[:8]),
+                 msg.Identifier[:8], len(reply.RemainingIDs))
+    journal.send_message(reply, msg.OriginatorID)
+
+
+class BlockBatchReplyMessage(message.Message):
+    """Carries as many of the requested blocks, and their transactions, as
+    fit in a packet.
+
+    MissingIDs names the requested blocks the peer does not have and
+    RemainingIDs the blocks that did not fit and must be requested again.
+    """
+    MessageType = "/journal.messages.JournalTransfer/BlockBatchReply"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(BlockBatchReplyMessage, self).__init__(minfo)
+
+        self.InReplyTo = minfo.get('InReplyTo')
+        self.TransactionBlockMessages = minfo.get('TransactionBlockMessages',
+                                                  [])
+        self.TransactionMessages = minfo.get('TransactionMessages', [])
+        self.MissingIDs = minfo.get('MissingIDs', [])
+        self.RemainingIDs = minfo.get('RemainingIDs', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(BlockBatchReplyMessage, self).dump()
+        result['InReplyTo'] = self.InReplyTo
+        result['TransactionBlockMessages'] = list(
+            self.TransactionBlockMessages)
+        result['TransactionMessages'] = list(self.TransactionMessages)
+        result['MissingIDs'] = list(self.MissingIDs)
+        result['RemainingIDs'] = list(self.RemainingIDs)
+        return result
+
+
+class TransactionBatchRequestMessage(message.Message):
+    """Requests a batch of transactions.
+    """
+    MessageType = "/journal.messages.JournalTransfer/TransactionBatchRequest"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(TransactionBatchRequestMessage, self).__init__(minfo)
+        self.TransactionIDs = minfo.get('TransactionIDs', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(TransactionBatchRequestMessage, self).dump()
+        result['TransactionIDs'] = list(self.TransactionIDs)
+        return result
+
+
+def _txnbatchrequesthandler(msg, journal):
+    logger.debug('processing incoming transaction batch request for '
+                 'journal transfer')
+
+    if _batchreplyfailed(msg, journal, 'transaction'):
+        return
+
+    reply = TransactionBatchReplyMessage()
+    reply.InReplyTo = msg.Identifier
+
+    budget = _batch_budget(journal, msg.TransactionIDs)
+    for index, txnid in enumerate(msg.TransactionIDs):
+        txn = journal.TransactionStore.get(txnid)
+        if not txn:
+            reply.MissingIDs.append(txnid)
+            continue
+
+        tdata = txn.build_message().dump()
+        size = len(dict2cbor(tdata))
+        if reply.TransactionMessages and size > budget:
+            reply.RemainingIDs = msg.TransactionIDs[index:]
+            break
+        reply.TransactionMessages.append(tdata)
+        budget -= size
+
+    journal.send_message(reply, msg.OriginatorID)
+
+
+class TransactionBatchReplyMessage(message.Message):
+    """Carries as many of the requested transactions as fit in a packet.
+
+    MissingIDs names the requested transactions the peer does not have
+    and RemainingIDs the transactions that did not fit and must be
+    requested again.
+    """
+    MessageType = "/journal.messages.JournalTransfer/TransactionBatchReply"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(TransactionBatchReplyMessage, self).__init__(minfo)
+
+        self.InReplyTo = minfo.get('InReplyTo')
+        self.TransactionMessages = minfo.get('TransactionMessages', [])
+        self.MissingIDs = minfo.get('MissingIDs', [])
+        self.RemainingIDs = minfo.get('RemainingIDs', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(TransactionBatchReplyMessage, self).dump()
+        result['InReplyTo'] = self.InReplyTo
+        result['TransactionMessages'] = list(self.TransactionMessages)
+        result['MissingIDs'] = list(self.MissingIDs)
+        result['RemainingIDs'] = list(self.RemainingIDs)
+        return result
+
+
+class SnapshotRequestMessage(message.Message):
+    """Requests a description of the state of a recent committed block.
+
+    The peer picks the block Depth blocks behind the head of its chain.
+    """
+    MessageType = "/journal.messages.JournalTransfer/SnapshotRequest"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(SnapshotRequestMessage, self).__init__(minfo)
+        self.Depth = minfo.get('Depth', 0)
+        self.ChunkSize = minfo.get('ChunkSize', 0)
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(SnapshotRequestMessage, self).dump()
+        result['Depth'] = self.Depth
+        result['ChunkSize'] = self.ChunkSize
+        return result
+
+
+def _snapshotrequesthandler(msg, journal):
+    logger.debug('processing incoming snapshot request for journal transfer')
+
+    if _batchreplyfailed(msg, journal, 'snapshot'):
+        return
+
+    blockids = journal.committed_block_ids(msg.Depth + 1)
+    try:
+        blockid = blockids[-1]
+        (hashes, _) = journal.GlobalStoreMap.export_snapshot(blockid,
+                                                             msg.ChunkSize)
+    except (IndexError, KeyError):
+        logger.warn('no committed block is available for a snapshot')
+        journal.send_message(TransferFailedMessage(), msg.OriginatorID)
+        return
+    height = journal.ChainIndex.height(blockid)
+
+    reply = SnapshotReplyMessage()
+    reply.InReplyTo = msg.Identifier
+    reply.BlockID = blockid
+    reply.BlockListIndex = height
+    reply.ChunkSize = msg.ChunkSize
+    reply.ChunkHashes = hashes
+    journal.send_message(reply, msg.OriginatorID)
+
+
+class SnapshotReplyMessage(message.Message):
+    """Describes the snapshot of a block as the sha256 digests of its
+    chunks, in order.
+    """
+    MessageType = "/journal.messages.JournalTransfer/SnapshotReply"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(SnapshotReplyMessage, self).__init__(minfo)
+
+        self.InReplyTo = minfo.get('InReplyTo')
+        self.BlockID = minfo.get('BlockID')
+        self.BlockListIndex = minfo.get('BlockListIndex', 0)
+        self.ChunkSize = minfo.get('ChunkSize', 0)
+        self.ChunkHashes = minfo.get('ChunkHashes', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(SnapshotReplyMessage, self).dump()
+        result['InReplyTo'] = self.InReplyTo
+        result['BlockID'] = self.BlockID
+        result['BlockListIndex'] = self.BlockListIndex
+        result['ChunkSize'] = self.ChunkSize
+        result['ChunkHashes'] = list(self.ChunkHashes)
+        return result
+
+
+class SnapshotChunkRequestMessage(message.Message):
+    """Requests chunks of the snapshot of a block by their digests.
+    """
+    MessageType = "/journal.messages.JournalTransfer/SnapshotChunkRequest"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(SnapshotChunkRequestMessage, self).__init__(minfo)
+        self.BlockID = minfo.get('BlockID')
+        self.ChunkSize = minfo.get('ChunkSize', 0)
+        self.ChunkHashes = minfo.get('ChunkHashes', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(SnapshotChunkRequestMessage, self).dump()
+        result['BlockID'] = self.BlockID
+        result['ChunkSize'] = self.ChunkSize
+        result['ChunkHashes'] = list(self.ChunkHashes)
+        return result
+
+
+def _snapshotchunkrequesthandler(msg, journal):
+    logger.debug('processing incoming snapshot chunk request for journal '
+                 'transfer')
+
+    if _batchreplyfailed(msg, journal, 'snapshot chunk'):
+        return
+
+    reply = SnapshotChunkReplyMessage()
+    reply.InReplyTo = msg.Identifier
+    reply.BlockID = msg.BlockID
+
+    # the encoding of a snapshot only depends on the state, so any peer
+    # that has committed the block can serve its chunks
+    try:
+        (_, chunks) = journal.GlobalStoreMap.export_snapshot(msg.BlockID,
+                                                             msg.ChunkSize)
+    except KeyError:
+        chunks = {}
+
+    budget = _batch_budget(journal, msg.ChunkHashes)
+    for index, digest in enumerate(msg.ChunkHashes):
+        if digest not in chunks:
+            reply.MissingIDs.append(digest)
+            continue
+
+        data = base64.b64encode(chunks[digest])
+        if reply.Chunks and len(data) > budget:
+            reply.RemainingIDs = msg.ChunkHashes[index:]
+            break
+        reply.Chunks.append(data)
+        budget -= len(data)
+
+    journal.send_message(reply, msg.OriginatorID)
+
+
+class SnapshotChunkReplyMessage(message.Message):
+    """Carries as many of the requested snapshot chunks as fit in a
+    packet, base64 encoded.
+
+    MissingIDs names the requested chunks the peer does not have and
+    RemainingIDs the chunks that did not fit and must be requested again.
+    """
+    MessageType = "/journal.messages.JournalTransfer/SnapshotChunkReply"
+    DispatchLane = 'Transfer'
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(SnapshotChunkReplyMessage, self).__init__(minfo)
+
+        self.InReplyTo = minfo.get('InReplyTo')
+        self.BlockID = minfo.get('BlockID')
+        self.Chunks = minfo.get('Chunks', [])
+        self.MissingIDs = minfo.get('MissingIDs', [])
+        self.RemainingIDs = minfo.get('RemainingIDs', [])
+
+        self.IsSystemMessage = True
+        self.IsForward = False
+        self.IsReliable = True
+
+    def dump(self):
+        result = super(SnapshotChunkReplyMessage, self).dump()
+        result['InReplyTo'] = self.InReplyTo
+        result['BlockID'] = self.BlockID
+        result['Chunks'] = list(self.Chunks)
+        result['MissingIDs'] = list(self.MissingIDs)
+        result['RemainingIDs'] = list(self.RemainingIDs)
+        return result
@@ -49,6 +49,7 @@ class TransactionBlockMessage(message.Message):
             with the message.
     """
     MessageType = "/journal.messages.TransactionBlockMessage/TransactionBlock"
+    DispatchLane = 'Block'
 
     def __init__(self, minfo=None):
         """Constructor for the TransactionBlockMessage class.
@@ -66,6 +67,12 @@ class TransactionBlockMessage(message.Message):
         self.IsReliable = True
         self.TransactionBlock = None
 
+    def signed_objects(self):
+        objects = super(TransactionBlockMessage, self).signed_objects()
+        if self.TransactionBlock is not None:
+            objects.append(self.TransactionBlock)
+        return objects
+
     def dump(self):
         """Returns a dict containing information about the
         transaction block message.
@@ -99,7 +106,8 @@ def transaction_block_message_handler(msg, journal):
         return
 
     journal.commit_transaction_block(msg.TransactionBlock)
-    journal.forward_message(msg, exceptions=[msg.SenderID], initialize=False)
+    journal.propagate_message(msg, msg.TransactionBlock.Identifier,
+                              isblock=True)
 
 
 class BlockRequestMessage(message.Message):
@@ -29,6 +29,7 @@ def register_message_handlers(journal):
 
 class TransactionMessage(message.Message):
     MessageType = "/journal.messages.TransactionMessage/Transaction"
+    DispatchLane = 'Transaction'
 
     def __init__(self, minfo=None):
         if minfo is None:
@@ -40,6 +41,12 @@ class TransactionMessage(message.Message):
         self.IsReliable = True
         self.Transaction = None
 
+    def signed_objects(self):
+        objects = super(TransactionMessage, self).signed_objects()
+        if self.Transaction is not None:
+            objects.append(self.Transaction)
+        return objects
+
     def dump(self):
         result = super(TransactionMessage, self).dump()
         result['Transaction'] = self.Transaction.dump()
@@ -66,9 +73,7 @@ def transaction_message_handler(msg, journal):
             return
 
         journal.add_pending_transaction(msg.Transaction)
-        journal.forward_message(msg,
-                                exceptions=[msg.SenderID],
-                                initialize=False)
+        journal.propagate_message(msg, msg.Transaction.Identifier)
 
 
 class TransactionRequestMessage(message.Message):
@@ -14,9 +14,9 @@
 # ------------------------------------------------------------------------------
 
 import logging
-import copy
 
 from journal import global_store_manager
+from journal.persistent_map import PersistentMap
 
 
 LOGGER = logging.getLogger(__name__)
@@ -31,28 +31,95 @@ class UniqueConstraintError(Exception):
 
 
 class ObjectStore(global_store_manager.KeyValueStore):
+    """
+    A KeyValueStore of object info dictionaries with unique secondary
+    indexes on 'object-type:attribute' pairs.
+
+    Indexes are persistent maps, a clone shares the indexes of the store
+    it was cloned from and updates only copy the path to the changed
+    entry. Subclasses can declare the indexes that every store of the
+    type maintains in the Indexes class attribute; other indexes are
+    built the first time they are used by lookup.
+
+    Uniqueness is enforced for the indexes passed to the constructor and
+    for those used by lookup in the store. A declared index is only a
+    lookup accelerator until then, so declaring one does not change which
+    objects can be stored.
+
+    Attributes:
+        Indexes (list): The indexes maintained by every store of the
+            class.
+    """
+
+    Indexes = []
+
     def __init__(self, prevstore=None, storeinfo=None, readonly=False,
-                 indexes=None, clone_indexes=None):
+                 indexes=None, clone_indexes=None, clone_unique=None):
         super(ObjectStore, self).__init__(
             prevstore, storeinfo, readonly)
 
+        # the indexes whose uniqueness is enforced by set
+        self._unique = set(clone_unique or [])
+
         if clone_indexes is not None:
-            self._indexes = copy.deepcopy(clone_indexes)
+            self._indexes = dict(clone_indexes)
+            # bring the shared indexes up to date with a restored delta
+            if storeinfo is not None and prevstore is not None:
+                keys = set(storeinfo['DeletedKeys'])
+                keys.update(storeinfo['Store'].iterkeys())
+                for key in keys:
+                    self._update_indexes(
+                        self._get_or_none(prevstore, key),
+                        self._get_or_none(self, key))
         else:
             self._indexes = {}
-            if indexes is not None:
-                for key in indexes:
-                    self._parse_and_check_index(key)
-                    self._indexes[key] = {}
+            for key in list(self.Indexes) + list(indexes or []):
+                self._build_index(key)
+            self._unique.update(indexes or [])
+
+    @staticmethod
+    def _get_or_none(store, key):
+        try:
+            return global_store_manager.KeyValueStore.get(store, key, True)
+        except KeyError:
+            return None
 
     def _build_index(self, index):
-        self._indexes[index] = {}
         object_type, attribute = self._parse_and_check_index(index)
-        for _, object_info in self.iteritems():
+        entries = PersistentMap()
+        for _, object_info in self.iteritems(readonly=True):
             if attribute in object_info and \
-                    object_info[attribute] not in self._indexes[index] \
+                    object_info[attribute] not in entries \
                     and object_type == object_info['object-type']:
-                self._indexes[index][object_info[attribute]] = object_info
+                entries = entries.set(object_info[attribute], object_info)
+        self._indexes[index] = entries
+
+    def _update_indexes(self, old_object, new_object):
+        """Replace the index entries of an object.
+
+        Args:
+            old_object (ReadOnlyDict): The object being replaced, None if
+                the object is new.
+            new_object (ReadOnlyDict): The stored object, None if the
+                object was deleted.
+        """
+        if old_object is not None:
+            prefix = old_object['object-type'] + ":"
+            for att in old_object.iterkeys():
+                index = prefix + att
+                entries = self._indexes.get(index)
+                if entries is not None and \
+                        entries.get(old_object[att]) == old_object:
+                    self._indexes[index] = entries.delete(old_object[att])
+
+        if new_object is not None:
+            prefix = new_object['object-type'] + ":"
+            for att in new_object.iterkeys():
+                index = prefix + att
+                entries = self._indexes.get(index)
+                if entries is not None:
+                    self._indexes[index] = entries.set(new_object[att],
+                                                       new_object)
 
     @staticmethod
     def _object_type_check(obj, object_type, key):
@@ -81,7 +148,8 @@ class ObjectStore(global_store_manager.KeyValueStore):
                 store.
         """
         return ObjectStore(self, storeinfo, readonly,
-                           clone_indexes=self._indexes)
+                           clone_indexes=self._indexes,
+                           clone_unique=self._unique)
 
     def lookup(self, index, key):
         """
@@ -100,18 +168,19 @@ class ObjectStore(global_store_manager.KeyValueStore):
 
         if index not in self._indexes:
             self._build_index(index)
+        self._unique.add(index)
         obj = self._indexes[index].get(key)
 
         ObjectStore._object_type_check(obj, object_type, key)
         return obj
 
-    def get(self, key, object_type=None):
+    def get(self, key, object_type=None, readonly=False):
         # pylint: disable=arguments-differ
-        obj = super(ObjectStore, self).get(key)
+        obj = super(ObjectStore, self).get(key, readonly)
         ObjectStore._object_type_check(obj, object_type, key)
         return obj
 
-    def iteritems_by_object_type(self, object_type):
+    def iteritems_by_object_type(self, object_type, readonly=False):
         """
             Return an iterator that can be used to iterate through object
             info dictionaries for objects of the type provided.
@@ -120,15 +189,20 @@ class ObjectStore(global_store_manager.KeyValueStore):
             object_type: (str) The object type, for example "bond",
                             that will be compared against an object info
                             dictionary's 'object-type' key.
+            readonly: (bool) Whether to return read-only views of the
+                            object info dictionaries rather than copies.
 
         Returns:
             An iterator
         """
-        for key, object_info in self.iteritems():
+        # scan with views so that only the matching objects are copied
+        for key, object_info in self.iteritems(readonly=True):
             if object_info['object-type'] == object_type:
+                if not readonly:
+                    object_info = object_info.thaw()
                 yield key, object_info
 
-    def get_all_by_object_type(self, object_type):
+    def get_all_by_object_type(self, object_type, readonly=False):
         """
             Returns of object info dictionaries whose 'object-type' field
             matches object_type.
@@ -137,20 +211,22 @@ class ObjectStore(global_store_manager.KeyValueStore):
             object_type: (str) The object type, for example "bond",
                             that will be compared against an object's
                             'object-type' field.
+            readonly: (bool) Whether to return read-only views of the
+                            object info dictionaries rather than copies.
 
         Returns:
             A list of object info dictionaryies of the object type given
         """
         return \
             [object_info for _, object_info
-             in self.iteritems_by_object_type(object_type)]
+             in self.iteritems_by_object_type(object_type, readonly)]
 
     def set(self, key, value):
         ObjectStore._object_type_check(value, None, key)
         object_type = value['object-type']
         old_object = None
         try:
-            old_object = super(ObjectStore, self).get(key)
+            old_object = super(ObjectStore, self).get(key, readonly=True)
         except KeyError:
             pass
 
@@ -158,7 +234,7 @@ class ObjectStore(global_store_manager.KeyValueStore):
             # error out early if any index would be violated
             for att in value.keys():
                 index = object_type + ":" + att
-                if index in self._indexes and \
+                if index in self._unique and \
                         value[att] in self._indexes[index]:
                     raise UniqueConstraintError(
                         "value for {} already used in "
@@ -166,12 +242,6 @@ class ObjectStore(global_store_manager.KeyValueStore):
                             att, index, value[att]
                         ))
 
-            super(ObjectStore, self).set(key, value)
-
-            for att in value.keys():
-                index = object_type + ":" + att
-                if index in self._indexes:
-                    self._indexes[index][value[att]] = value
         else:
             # on update make sure the new object isn't of a different type
             ObjectStore._object_type_check(value,
@@ -180,7 +250,7 @@ class ObjectStore(global_store_manager.KeyValueStore):
             # value's attribute
             for att in old_object.iterkeys():
                 index = object_type + ":" + att
-                if index in self._indexes \
+                if index in self._unique \
                         and old_object[att] != value[att] \
                         and value[att] in self._indexes[index] \
                         and self._indexes[index][value[att]] != old_object:
@@ -188,21 +258,12 @@ class ObjectStore(global_store_manager.KeyValueStore):
                                                 "in unique index {}: {}".
                                                 format(att, index,
                                                        value[att]))
-            for att in old_object.iterkeys():
-                index = object_type + ":" + att
-                if index in self._indexes:
-                    self._indexes[index][value[att]] = value
 
-            super(ObjectStore, self).set(key, value)
+        super(ObjectStore, self).set(key, value)
+        self._update_indexes(old_object, self.get(key, readonly=True))
 
     def delete(self, key, object_type=None):
         # pylint: disable=arguments-differ
-        obj = self.get(key, object_type=object_type)
+        obj = self.get(key, object_type=object_type, readonly=True)
         super(ObjectStore, self).delete(key)
-        for attribute in obj.keys():
-            if object_type is None:
-                index = obj['object-type'] + ":" + attribute
-            else:
-                index = object_type + ":" + attribute
-            if index in self._indexes:
-                del self._indexes[index][obj[attribute]]
+        self._update_indexes(obj, None)
@@ -0,0 +1,242 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines PersistentMap, an immutable hash array mapped trie.
+Updates return a new map that shares all unchanged nodes with the
+original, so a map can be handed to a new checkpoint of a store in
+constant time and each update only copies the O(log n) nodes on the path
+to the modified key.
+"""
+
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+_HASHBITS = 64
+_HASHMASK = (1 << _HASHBITS) - 1
+
+
+class _Bucket(object):
+    """Holds the entries for keys whose hashes are identical.
+    """
+
+    __slots__ = ['Hash', 'Items']
+
+    def __init__(self, keyhash, items):
+        self.Hash = keyhash
+        self.Items = items
+
+
+def _hash(key):
+    return hash(key) & _HASHMASK
+
+
+def _entry_hash(entry):
+    return entry.Hash if isinstance(entry, _Bucket) else entry[2]
+
+
+def _merge(entry, leaf, shift):
+    """Build the node that holds an existing entry and a new leaf whose
+    hashes agree in all bits below shift.
+    """
+    entryhash = _entry_hash(entry)
+    if entryhash == leaf[2]:
+        if isinstance(entry, _Bucket):
+            return _Bucket(entryhash, entry.Items + ((leaf[0], leaf[1]), ))
+        return _Bucket(entryhash, ((entry[0], entry[1]), (leaf[0], leaf[1])))
+
+    slot1 = (entryhash >> shift) & _MASK
+    slot2 = (leaf[2] >> shift) & _MASK
+    if slot1 == slot2:
+        return {slot1: _merge(entry, leaf, shift + _BITS)}
+    return {slot1: entry, slot2: leaf}
+
+
+def _set(node, shift, keyhash, key, value):
+    """Returns a copy of node with the key set and whether the key is new.
+    """
+    slot = (keyhash >> shift) & _MASK
+    child = node.get(slot)
+    result = dict(node)
+
+    if child is None:
+        result[slot] = (key, value, keyhash)
+        return result, True
+
+    if isinstance(child, tuple):
+        if child[2] == keyhash and child[0] == key:
+            result[slot] = (key, value, keyhash)
+            return result, False
+        result[slot] = _merge(child, (key, value, keyhash), shift + _BITS)
+        return result, True
+
+    if isinstance(child, _Bucket):
+        if child.Hash != keyhash:
+            result[slot] = _merge(child, (key, value, keyhash),
+                                  shift + _BITS)
+            return result, True
+        items = tuple(i for i in child.Items if i[0] != key)
+        added = len(items) == len(child.Items)
+        result[slot] = _Bucket(keyhash, items + ((key, value), ))
+        return result, added
+
+    (result[slot], added) = _set(child, shift + _BITS, keyhash, key, value)
+    return result, added
+
+
+def _delete(node, shift, keyhash, key):
+    """Returns a copy of node without the key, None if the node would be
+    empty.
+
+    Raises:
+        KeyError: If the key is not in the node.
+    """
+    slot = (keyhash >> shift) & _MASK
+    child = node.get(slot)
+
+    if child is None:
+        raise KeyError(key)
+
+    if isinstance(child, tuple):
+        if child[2] != keyhash or child[0] != key:
+            raise KeyError(key)
+        replacement = None
+    elif isinstance(child, _Bucket):
+        items = tuple(i for i in child.Items if i[0] != key)
+        if child.Hash != keyhash or len(items) == len(child.Items):
+            raise KeyError(key)
+        if len(items) == 1:
+            replacement = (items[0][0], items[0][1], keyhash)
+        else:
+            replacement = _Bucket(keyhash, items)
+    else:
+        replacement = _delete(child, shift + _BITS, keyhash, key)
+        # pull a lone leaf up so that paths stay as short as possible
+        if replacement is not None and len(replacement) == 1:
+            only = replacement.values()[0]
+            if not isinstance(only, dict):
+                replacement = only
+
+    result = dict(node)
+    if replacement is None:
+        del result[slot]
+    else:
+        result[slot] = replacement
+    return result if result else None
+
+
+def _iterentries(node):
+    for child in node.itervalues():
+        if isinstance(child, tuple):
+            yield child[0], child[1]
+        elif isinstance(child, _Bucket):
+            for item in child.Items:
+                yield item
+        else:
+            for item in _iterentries(child):
+                yield item
+
+
+class PersistentMap(object):
+    """An immutable mapping with structurally shared updates.
+
+    Reads use the usual mapping syntax; set() and delete() leave the map
+    unchanged and return the updated map.
+    """
+
+    __slots__ = ['_root', '_count']
+
+    def __init__(self, root=None, count=0):
+        self._root = root
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        keyhash = _hash(key)
+        node = self._root
+        shift = 0
+        while node is not None:
+            child = node.get((keyhash >> shift) & _MASK)
+            if child is None:
+                break
+            if isinstance(child, tuple):
+                if child[2] == keyhash and child[0] == key:
+                    return child[1]
+                break
+            if isinstance(child, _Bucket):
+                for (ikey, ivalue) in child.Items:
+                    if ikey == key:
+                        return ivalue
+                break
+            node = child
+            shift += _BITS
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Returns the value for a key, or default if it is missing.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        """Creates an iterator for the (key, value) pairs in the map.
+        """
+        if self._root is None:
+            return iter(())
+        return _iterentries(self._root)
+
+    def set(self, key, value):
+        """Returns a map that binds key to value.
+
+        Args:
+            key (object): A hashable key.
+            value (object): The value to associate with the key.
+
+        Returns:
+            PersistentMap: The updated map.
+        """
+        (root, added) = _set(self._root or {}, 0, _hash(key), key, value)
+        return PersistentMap(root, self._count + 1 if added else self._count)
+
+    def delete(self, key):
+        """Returns a map without key.
+
+        Args:
+            key (object): The key to remove.
+
+        Returns:
+            PersistentMap: The updated map.
+
+        Raises:
+            KeyError: If the key is not in the map.
+        """
+        if self._root is None:
+            raise KeyError(key)
+        return PersistentMap(_delete(self._root, 0, _hash(key), key),
+                             self._count - 1)
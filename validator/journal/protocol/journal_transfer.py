@@ -13,27 +13,40 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import base64
+import hashlib
 import logging
 import random
 import sys
+import time
 import traceback
+from collections import deque
 from collections import OrderedDict
 
 from twisted.internet import reactor
 
+from gossip import stats
+
 from journal.messages.journal_transfer import BlockListRequestMessage
 from journal.messages.journal_transfer import BlockListReplyMessage
 
-from journal.messages.journal_transfer import BlockRequestMessage
-from journal.messages.journal_transfer import BlockReplyMessage
+from journal.messages.journal_transfer import BlockBatchRequestMessage
+from journal.messages.journal_transfer import BlockBatchReplyMessage
 
-from journal.messages.journal_transfer import TransactionRequestMessage
-from journal.messages.journal_transfer import TransactionReplyMessage
+from journal.messages.journal_transfer import TransactionBatchRequestMessage
+from journal.messages.journal_transfer import TransactionBatchReplyMessage
 
 from journal.messages.journal_transfer import UncommittedListRequestMessage
 from journal.messages.journal_transfer import UncommittedListReplyMessage
 
+from journal.messages.journal_transfer import SnapshotRequestMessage
+from journal.messages.journal_transfer import SnapshotReplyMessage
+
+from journal.messages.journal_transfer import SnapshotChunkRequestMessage
+from journal.messages.journal_transfer import SnapshotChunkReplyMessage
+
 from journal.messages.journal_transfer import TransferFailedMessage
+from journal.messages.journal_transfer import snapshot_chunk_size
 
 
 logger = logging.getLogger(__name__)
@@ -64,14 +77,71 @@ def start_journal_transfer(journal, oncomplete):
     return True
 
 
+class _Request(object):
+    """Tracks an outstanding request for a batch of blocks, transactions
+    or snapshot chunks.
+    """
+
+    __slots__ = ['Kind', 'ObjectIDs', 'PeerID', 'SentTime']
+
+    def __init__(self, kind, objids, peerid, senttime):
+        self.Kind = kind
+        self.ObjectIDs = objids
+        self.PeerID = peerid
+        self.SentTime = senttime
+
+
 class JournalTransfer(object):
-    """Handles the transfer of a journal to peers.
+    """Handles the transfer of a journal from peers.
+
+    The list of committed blocks and uncommitted transactions is read
+    from a single source peer so that it describes one consistent chain.
+    Blocks and transactions are fetched as soon as their identifiers are
+    known, in batches of up to BatchSize objects, with up to Window
+    requests outstanding at a time spread over as many as PeerCount
+    peers. A block batch also returns the transactions of its blocks.
+    A peer answers with as many objects as fit in a packet and names the
+    rest so they can be requested again. A request that has not been
+    answered within Timeout seconds, or that was sent to a peer that
+    reports a failure, is sent again to a different peer.
+
+    In snapshot mode the source peer also describes the state of a
+    recent block as a list of chunk digests. Only the chunks, the most
+    recent blocks up to that block and the blocks that follow it are
+    fetched; the chunks can come from any peer since every node encodes
+    the same state the same way.
 
     Attributes:
         Journal (journal_core.Journal): The journal to transfer.
         Callback (function): The function to call when the
             journal transfer has completed.
+        Window (int): The maximum number of outstanding block and
+            transaction requests.
+        BatchSize (int): The maximum number of objects named in one
+            request.
+        PeerCount (int): The maximum number of peers to fetch from.
+        Timeout (float): The number of seconds to wait for a reply
+            before the request is sent to another peer.
+        Peer (Node): The peer that provides the block and transaction
+            lists.
+        Peers (list): The peers that blocks and transactions are
+            fetched from.
+        BlockMap (OrderedDict): The committed blocks in chain order,
+            None for blocks that have not been received.
+        TransactionMap (dict): The transactions referenced by the blocks
+            and the uncommitted list, None for transactions that have not
+            been received.
+        UncommittedTransactions (list): The identifiers of the
+            uncommitted transactions in the order of the source peer.
+        SnapshotSync (bool): Whether to start from a snapshot.
+        SnapshotBlockID (str): The block whose state is transferred, None
+            if every block is replayed.
+        ChainIDs (list): The committed chain through the snapshot block.
+        ChunkMap (OrderedDict): The snapshot chunks by digest, None for
+            chunks that have not been received.
+        TransferStats (stats.Stats): Progress of the transfer.
     """
+
     def __init__(self, journal, callback):
         """Constructor for the JournalTransfer class.
 
@@ -83,101 +153,324 @@ class JournalTransfer(object):
         self.Journal = journal
         self.Callback = callback
 
+        self.Window = max(1, journal.TransferWindow)
+        self.PeerCount = max(1, journal.TransferPeerCount)
+        self.BatchSize = max(1, journal.TransferBatchSize)
+        self.Timeout = journal.TransferTimeout
+        self.SnapshotSync = journal.SyncMode == 'snapshot'
+
+        self.Peer = None
+        self.Peers = []
+        self.BlockMap = OrderedDict()
+        self.TransactionMap = {}
+        self.UncommittedTransactions = []
+        self.PendingBlocks = deque()
+        self.PendingTransactions = deque()
+
+        self.SnapshotBlockID = None
+        self.ChainIDs = []
+        self.ChunkMap = OrderedDict()
+        self.PendingChunks = deque()
+        self._chunkhashes = []
+        self._chunksize = snapshot_chunk_size(journal)
+
+        self._outstanding = {}
+        self._load = {}
+        self._tried = {}
+        self._missing = {}
+        self._listing = False
+        self._nextcheck = 0
+
+        self._initstats()
+
+    def _initstats(self):
+        self.TransferStats = stats.Stats(self.Journal.LocalNode.Name,
+                                         'ledgertransfer')
+        self.TransferStats.add_metric(stats.Counter('BlocksReceived'))
+        self.TransferStats.add_metric(stats.Counter('TransactionsReceived'))
+        self.TransferStats.add_metric(stats.Counter('ChunksReceived'))
+        self.TransferStats.add_metric(stats.Counter('RequestsRetried'))
+        self.TransferStats.add_metric(stats.Counter('PeerFailures'))
+        self.TransferStats.add_metric(stats.Sample(
+            'BlocksKnown', lambda: len(self.BlockMap)))
+        self.TransferStats.add_metric(stats.Sample(
+            'TransactionsKnown', lambda: len(self.TransactionMap)))
+        self.TransferStats.add_metric(stats.Sample(
+            'ChunksKnown', lambda: len(self.ChunkMap)))
+        self.TransferStats.add_metric(stats.Sample(
+            'RequestsOutstanding', lambda: len(self._outstanding)))
+        self.TransferStats.add_metric(stats.Sample(
+            'PeerCount', lambda: len(self.Peers)))
+
+        self.Journal.StatDomains['ledgertransfer'] = self.TransferStats
+
     def initiate_journal_transfer(self):
         """Initiates journal transfer to peers.
         """
-        if len(self.Journal.peer_list()) == 0:
+        peers = self.Journal.peer_list()
+        if len(peers) == 0:
             reactor.callLater(10, self.initiate_journal_transfer)
             return
 
-        self.Peer = random.choice(self.Journal.peer_list())
-        logger.info('initiate journal transfer from %s', self.Peer)
+        random.shuffle(peers)
+        self.Peers = peers[:self.PeerCount]
+        self.Peer = self.Peers[0]
+        logger.info('initiate journal transfer from %s using %d peers',
+                    self.Peer, len(self.Peers))
 
         self.BlockMap = OrderedDict()
-        self.PendingBlocks = []
-        self.TransactionMap = OrderedDict()
-        self.PendingTransactions = []
-
-        self.ProcessingUncommitted = False
+        self.TransactionMap = {}
         self.UncommittedTransactions = []
+        self.PendingBlocks = deque()
+        self.PendingTransactions = deque()
+
+        self.SnapshotBlockID = None
+        self.ChainIDs = []
+        self.ChunkMap = OrderedDict()
+        self.PendingChunks = deque()
+        self._chunkhashes = []
+
+        self._outstanding = {}
+        self._load = dict((p.Identifier, 0) for p in self.Peers)
+        self._tried = {}
+        self._missing = {}
+        self._listing = True
 
         self.Journal.register_message_handler(BlockListReplyMessage,
                                               self._blocklistreplyhandler)
-        self.Journal.register_message_handler(BlockReplyMessage,
+        self.Journal.register_message_handler(BlockBatchReplyMessage,
                                               self._blockreplyhandler)
         self.Journal.register_message_handler(UncommittedListReplyMessage,
                                               self._txnlistreplyhandler)
-        self.Journal.register_message_handler(TransactionReplyMessage,
+        self.Journal.register_message_handler(TransactionBatchReplyMessage,
                                               self._txnreplyhandler)
+        self.Journal.register_message_handler(SnapshotReplyMessage,
+                                              self._snapshotreplyhandler)
+        self.Journal.register_message_handler(SnapshotChunkReplyMessage,
+                                              self._chunkreplyhandler)
         self.Journal.register_message_handler(TransferFailedMessage,
                                               self._failedhandler)
+        self.Journal.onHeartbeatTimer += self._timeouthandler
 
         request = BlockListRequestMessage()
         request.BlockListIndex = 0
         self.Journal.send_message(request, self.Peer.Identifier)
 
-    def _failedhandler(self, msg, journal):
-        logger.warn('journal transfer failed')
-
-        # clear all of the message handlers
+    def _clearhandlers(self):
         self.Journal.clear_message_handler(BlockListReplyMessage)
-        self.Journal.clear_message_handler(BlockReplyMessage)
+        self.Journal.clear_message_handler(BlockBatchReplyMessage)
         self.Journal.clear_message_handler(UncommittedListReplyMessage)
-        self.Journal.clear_message_handler(TransactionReplyMessage)
+        self.Journal.clear_message_handler(TransactionBatchReplyMessage)
+        self.Journal.clear_message_handler(SnapshotReplyMessage)
+        self.Journal.clear_message_handler(SnapshotChunkReplyMessage)
         self.Journal.clear_message_handler(TransferFailedMessage)
+        self.Journal.onHeartbeatTimer -= self._timeouthandler
+
+    def _restart(self):
+        self._clearhandlers()
+        self._retry_later()
 
+    def _retry_later(self):
+        logger.warn('journal transfer failed')
+
+        self._outstanding = {}
         self.RetryID = reactor.callLater(10, self.initiate_journal_transfer)
 
-    def _kick_off_next_block(self):
+    def _peername(self, peerid):
+        return str(self.Journal.NodeMap.get(peerid, peerid[:8]))
+
+    def _failedhandler(self, msg, journal):
+        peerid = msg.OriginatorID
+        if peerid == self.Peer.Identifier:
+            self._restart()
+            return
+
+        if peerid not in self._load:
+            return
+
+        # the failure does not say which request it answers so stop using
+        # the peer and send everything it was asked for somewhere else
+        logger.info('dropping %s from journal transfer',
+                    self._peername(peerid))
+        self.TransferStats.PeerFailures.increment()
+        self.Peers = [p for p in self.Peers if p.Identifier != peerid]
+        del self._load[peerid]
+
+        for (msgid, request) in self._outstanding.items():
+            if request.PeerID == peerid:
+                self._retry(msgid)
+
+        self._fill_window()
+
+    def _timeouthandler(self, now):
+        if now < self._nextcheck:
+            return
+        self._nextcheck = now + 1.0
+
+        expired = now - self.Timeout
+        for (msgid, request) in self._outstanding.items():
+            if request.SentTime < expired:
+                logger.info('request for %d %ss timed out at %s',
+                            len(request.ObjectIDs), request.Kind,
+                            self._peername(request.PeerID))
+                self._retry(msgid)
+
+        self._fill_window()
+
+    def _queue(self, kind):
+        """Returns the queue of objects waiting to be requested and the map
+        of objects received for a kind of request.
         """
-        Check to see if there are any blocks to be received and kick off
-        retrieval of the first one that doesnt already exist in our journal
+        if kind == 'block':
+            return (self.PendingBlocks, self.BlockMap)
+        elif kind == 'chunk':
+            return (self.PendingChunks, self.ChunkMap)
+        return (self.PendingTransactions, self.TransactionMap)
+
+    def _requeue(self, kind, objids):
+        self._queue(kind)[0].extendleft(reversed(objids))
+
+    def _retry(self, msgid):
+        """Return the objects of an outstanding request to the front of
+        their queue so that they are sent to another peer.
         """
-        while len(self.PendingBlocks) > 0:
-            blockid = self.PendingBlocks.pop(0)
-            if blockid not in self.Journal.BlockStore:
-                request = BlockRequestMessage()
-                request.BlockID = blockid
-                self.Journal.send_message(request, self.Peer.Identifier)
-                return True
-
-            # copy the block information
-            self.BlockMap[blockid] = self.Journal.BlockStore[blockid]
-
-            # add all the transaction to the transaction map in order
-            for txnid in self.BlockMap[blockid].TransactionIDs:
-                self.TransactionMap[txnid] = None
-                self.PendingTransactions.append(txnid)
-
-        # there were no blocks, but we might have added transactions to the
-        # queue to return so kick off a transaction request for the next one
-        return self._kick_off_next_transaction()
-
-    def _kick_off_next_transaction(self):
+        request = self._outstanding.pop(msgid)
+        if request.PeerID in self._load:
+            self._load[request.PeerID] -= 1
+        for objid in request.ObjectIDs:
+            self._tried.setdefault(objid, set()).add(request.PeerID)
+        self.TransferStats.RequestsRetried.increment()
+
+        self._requeue(request.Kind, request.ObjectIDs)
+
+    def _choose_peer(self, objid):
+        """Pick the least loaded peer that has neither been asked for an
+        object nor reported it missing. Once every peer that might have
+        the object has been asked, start over; None if no peer has it.
         """
-        Check to see if there are any transactions to be received and kick off
-        retrieval of the first one that doesnt already exist in our journal
+        missing = self._missing.get(objid, ())
+        tried = self._tried.get(objid, ())
+        candidates = [p for p in self.Peers
+                      if p.Identifier not in missing and
+                      p.Identifier not in tried]
+        if not candidates:
+            self._tried.pop(objid, None)
+            candidates = [p for p in self.Peers
+                          if p.Identifier not in missing]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: self._load[p.Identifier])
+
+    def _send_request(self, kind, objids):
+        """Send a batch request to the peer chosen for its first object.
+
+        Returns:
+            bool: False if no peer is able to provide the first object.
         """
-        while len(self.PendingTransactions) > 0:
-            txnid = self.PendingTransactions.pop(0)
-            if txnid not in self.Journal.TransactionStore:
-                request = TransactionRequestMessage()
-                request.TransactionID = txnid
-                self.Journal.send_message(request, self.Peer.Identifier)
-                return True
+        peer = self._choose_peer(objids[0])
+        if peer is None:
+            logger.warn('no peer is able to provide %s %s', kind,
+                        objids[0][:8])
+            return False
 
-            self.TransactionMap[txnid] = self.Journal.TransactionStore[txnid]
+        if kind == 'block':
+            request = BlockBatchRequestMessage()
+            request.BlockIDs = objids
+        elif kind == 'chunk':
+            request = SnapshotChunkRequestMessage()
+            request.BlockID = self.SnapshotBlockID
+            request.ChunkSize = self._chunksize
+            request.ChunkHashes = objids
+        else:
+            request = TransactionBatchRequestMessage()
+            request.TransactionIDs = objids
+        self.Journal.send_message(request, peer.Identifier)
+
+        self._outstanding[request.Identifier] = _Request(
+            kind, objids, peer.Identifier, time.time())
+        self._load[peer.Identifier] += 1
+        return True
+
+    def _add_block(self, block):
+        self.BlockMap[block.Identifier] = block
+        for txnid in block.TransactionIDs:
+            self._add_transaction_id(txnid)
+
+    def _add_transaction_id(self, txnid):
+        if txnid in self.TransactionMap:
+            return
+        if txnid in self.Journal.TransactionStore:
+            self.TransactionMap[txnid] = \
+                self.Journal.TransactionStore[txnid]
+        else:
+            self.TransactionMap[txnid] = None
+            self.PendingTransactions.append(txnid)
+
+    def _next_batch(self, kind):
+        """Take the next batch of objects that are still needed from the
+        front of a queue.
+        """
+        (queue, objmap) = self._queue(kind)
+
+        batch = []
+        while len(queue) > 0 and len(batch) < self.BatchSize:
+            objid = queue.popleft()
+            if objmap[objid] is not None:
+                continue
+            if kind == 'block' and objid in self.Journal.BlockStore:
+                self._add_block(self.Journal.BlockStore[objid])
+                continue
+            batch.append(objid)
+        return batch
+
+    def _fill_window(self):
+        """Send requests until the window is full, blocks first since each
+        one adds more transactions to fetch.
+        """
+        while len(self._outstanding) < self.Window:
+            for kind in ('block', 'chunk', 'transaction'):
+                batch = self._next_batch(kind)
+                if batch:
+                    break
+            if not batch:
+                break
+            if not self._send_request(kind, batch):
+                self._restart()
+                return
 
-        return False
+        if not self._listing and len(self._outstanding) == 0:
+            self._finish()
+
+    def _complete_request(self, msg, kind):
+        """Account for a batch reply and queue the objects that it did not
+        return.
+        """
+        request = self._outstanding.pop(msg.InReplyTo, None)
+        if request is None:
+            # the request timed out and its objects were already queued
+            return None
+        if request.PeerID in self._load:
+            self._load[request.PeerID] -= 1
+
+        # objects the peer does not have are asked of someone else, those
+        # that did not fit in the reply are asked again
+        for objid in msg.MissingIDs:
+            self._missing.setdefault(objid, set()).add(msg.OriginatorID)
+        self._requeue(kind, list(msg.MissingIDs) + list(msg.RemainingIDs))
+        return request
 
     def _blocklistreplyhandler(self, msg, journal):
         logger.debug('request %s, received %d block identifiers from %s',
                      msg.InReplyTo[:8], len(msg.BlockIDs), self.Peer.Name)
 
-        # add all the blocks to the block map in order
+        # start fetching the blocks right away, they are committed in the
+        # order of the list no matter when they arrive; with a snapshot
+        # only the most recent blocks are needed so wait for the list
         for blockid in msg.BlockIDs:
-            self.BlockMap[blockid] = None
-            self.PendingBlocks.append(blockid)
+            if blockid not in self.BlockMap:
+                self.BlockMap[blockid] = None
+                if not self.SnapshotSync:
+                    self.PendingBlocks.append(blockid)
 
         # if we received any block ids at all then we need to go back and ask
         # for more when no more are returned, then we know we have all of them
@@ -185,16 +478,52 @@ class JournalTransfer(object):
             request = BlockListRequestMessage()
             request.BlockListIndex = msg.BlockListIndex + len(msg.BlockIDs)
             self.Journal.send_message(request, self.Peer.Identifier)
-            return
+        elif self.SnapshotSync:
+            request = SnapshotRequestMessage()
+            request.Depth = self.Journal.SnapshotSyncDepth
+            request.ChunkSize = self._chunksize
+            self.Journal.send_message(request, self.Peer.Identifier)
+        else:
+            self._request_uncommitted()
+
+        self._fill_window()
 
-        # no more block list messages, now start grabbing blocks
-        if self._kick_off_next_block():
+    def _request_uncommitted(self):
+        request = UncommittedListRequestMessage()
+        request.TransactionListIndex = 0
+        self.Journal.send_message(request, self.Peer.Identifier)
+
+    def _snapshotreplyhandler(self, msg, journal):
+        blockids = list(self.BlockMap)
+        height = msg.BlockListIndex
+        if height >= len(blockids) or blockids[height] != msg.BlockID:
+            logger.warn('snapshot block %s from %s is not in its chain',
+                        msg.BlockID[:8], self.Peer.Name)
+            self._restart()
             return
 
-        # kick off retrieval of the uncommitted transactions
-        request2 = UncommittedListRequestMessage()
-        request2.TransactionListIndex = 0
-        self.Journal.send_message(request2, self.Peer.Identifier)
+        start = height + 1 - self.Journal.SnapshotSyncHistory
+        if start > 0:
+            logger.info('transfer state of block %s at height %d from %d '
+                        'chunks', msg.BlockID[:8], height,
+                        len(msg.ChunkHashes))
+            self.SnapshotBlockID = msg.BlockID
+            self.ChainIDs = blockids[:height + 1]
+            self.BlockMap = OrderedDict((b, None) for b in blockids[start:])
+
+            self._chunksize = msg.ChunkSize
+            self._chunkhashes = list(msg.ChunkHashes)
+            for digest in self._chunkhashes:
+                if digest not in self.ChunkMap:
+                    self.ChunkMap[digest] = None
+                    self.PendingChunks.append(digest)
+        else:
+            logger.info('chain from %s is too short for a snapshot, replay '
+                        'every block', self.Peer.Name)
+
+        self.PendingBlocks.extend(self.BlockMap)
+        self._request_uncommitted()
+        self._fill_window()
 
     def _txnlistreplyhandler(self, msg, journal):
         logger.debug(
@@ -203,108 +532,186 @@ class JournalTransfer(object):
             len(msg.TransactionIDs),
             self.Peer.Name)
 
-        # save the uncommitted transactions
         for txnid in msg.TransactionIDs:
             self.UncommittedTransactions.append(txnid)
+            self._add_transaction_id(txnid)
 
         if len(msg.TransactionIDs) > 0:
             request = UncommittedListRequestMessage()
             request.TransactionListIndex = msg.TransactionListIndex + len(
                 msg.TransactionIDs)
             self.Journal.send_message(request, self.Peer.Identifier)
-            return
+        else:
+            self._listing = False
 
-        # if there are no more transactions, then get the next block
-        if self._kick_off_next_block():
-            return
+        self._fill_window()
+
+    def _add_transactions(self, tdatalist):
+        for tdata in tdatalist:
+            # the actual transaction is encapsulated in a message within the
+            # reply message so we need to decode it here... this is mostly to
+            # make sure we have the handle to the gossiper for decoding
+            tmessage = self.Journal.unpack_message(tdata['__TYPE__'], tdata)
+            txn = tmessage.Transaction
 
-        self._handleuncommitted()
+            # a retried request may be answered twice
+            if self.TransactionMap.get(txn.Identifier) is None:
+                self.TransactionMap[txn.Identifier] = txn
+                self.TransferStats.TransactionsReceived.increment()
 
     def _blockreplyhandler(self, msg, journal):
-        # leaving this as info to provide some feedback in the log for
-        # ongoing progress on the journal transfer
-        logger.info('request %s, received block from %s', msg.InReplyTo[:8],
-                    self.Peer.Name)
+        self._complete_request(msg, 'block')
 
-        # the actual transaction block is encapsulated in a message within the
-        # reply message so we need to decode it here... this is mostly to make
-        # sure we have the handle to the gossiper for decoding
-        btype = msg.TransactionBlockMessage['__TYPE__']
-        bmessage = self.Journal.unpack_message(btype,
-                                               msg.TransactionBlockMessage)
+        # record the transactions first so that the blocks do not queue
+        # requests for them
+        self._add_transactions(msg.TransactionMessages)
 
-        self.BlockMap[
-            bmessage.TransactionBlock.Identifier] = bmessage.TransactionBlock
+        for bdata in msg.TransactionBlockMessages:
+            bmessage = self.Journal.unpack_message(bdata['__TYPE__'], bdata)
+            block = bmessage.TransactionBlock
 
-        # add all the transaction to the transaction map in order
-        for txnid in bmessage.TransactionBlock.TransactionIDs:
-            self.TransactionMap[txnid] = None
-            self.PendingTransactions.append(txnid)
-
-        # check to see if there are any transactions
-        if self._kick_off_next_transaction():
-            return
+            if self.BlockMap.get(block.Identifier, block) is None:
+                self._add_block(block)
+                self.TransferStats.BlocksReceived.increment()
 
-        # and if there are no more transactions then
-        # check to see if there are more blocks
-        if self._kick_off_next_block():
-            return
+        # leaving this as info to provide some feedback in the log for
+        # ongoing progress on the journal transfer
+        logger.info('request %s, received %d blocks from %s, %d of %d',
+                    msg.InReplyTo[:8], len(msg.TransactionBlockMessages),
+                    self._peername(msg.OriginatorID),
+                    self.TransferStats.BlocksReceived.Value,
+                    len(self.BlockMap))
 
-        self._handleuncommitted()
+        self._fill_window()
 
     def _txnreplyhandler(self, msg, journal):
-        logger.debug('request %s, received transaction from %s',
-                     msg.InReplyTo[:8], self.Peer.Name)
-
-        # the actual transaction is encapsulated in a message within the reply
-        # message so we need to decode it here... this is mostly to make sure
-        # we have the handle to the gossiper for decoding
-        ttype = msg.TransactionMessage['__TYPE__']
-        tmessage = self.Journal.unpack_message(ttype, msg.TransactionMessage)
-
-        self.TransactionMap[
-            tmessage.Transaction.Identifier] = tmessage.Transaction
-
-        # if there are more transaction pending for this block, then kick off
-        # retrieval of the next one
-        if self._kick_off_next_transaction():
-            return
-
-        # finished the last block, now its time to start the next one, send
-        # a request for it
-        if self._kick_off_next_block():
-            return
-
-        self._handleuncommitted()
-
-    def _handleuncommitted(self):
-        logger.debug('transition to uncommitted messages')
-
-        if not self.ProcessingUncommitted and len(
-                self.UncommittedTransactions) > 0:
-            self.ProcessingUncommitted = True
-
+        self._complete_request(msg, 'transaction')
+
+        logger.debug('request %s, received %d transactions from %s',
+                     msg.InReplyTo[:8], len(msg.TransactionMessages),
+                     self._peername(msg.OriginatorID))
+
+        self._add_transactions(msg.TransactionMessages)
+        self._fill_window()
+
+    def _chunkreplyhandler(self, msg, journal):
+        request = self._complete_request(msg, 'chunk')
+
+        for data in msg.Chunks:
+            data = base64.b64decode(data)
+            digest = hashlib.sha256(data).hexdigest()
+            if self.ChunkMap.get(digest, data) is None:
+                self.ChunkMap[digest] = data
+                self.TransferStats.ChunksReceived.increment()
+
+        # a chunk that does not match its digest is asked of another peer
+        if request is not None:
+            named = set(msg.MissingIDs) | set(msg.RemainingIDs)
+            damaged = [d for d in request.ObjectIDs
+                       if self.ChunkMap[d] is None and d not in named]
+            if damaged:
+                logger.warn('received %d damaged snapshot chunks from %s',
+                            len(damaged), self._peername(msg.OriginatorID))
+                for digest in damaged:
+                    self._missing.setdefault(digest, set()).add(
+                        msg.OriginatorID)
+                self._requeue('chunk', damaged)
+
+        logger.debug('request %s, received %d snapshot chunks from %s, %d '
+                     'of %d', msg.InReplyTo[:8], len(msg.Chunks),
+                     self._peername(msg.OriginatorID),
+                     self.TransferStats.ChunksReceived.Value,
+                     len(self.ChunkMap))
+
+        self._fill_window()
+
+    def _ordered_transactions(self, blocks, uncommitted=True,
+                              rejected=()):
+        """Returns the transactions of the blocks in block order, followed
+        by the uncommitted transactions, leaving out the rejected ones.
+        """
+        txnids = OrderedDict()
+        for blk in blocks:
+            for txnid in blk.TransactionIDs:
+                txnids[txnid] = True
+        if uncommitted:
             for txnid in self.UncommittedTransactions:
-                self.TransactionMap[txnid] = None
-                self.PendingTransactions.append(txnid)
+                txnids[txnid] = True
+        return [self.TransactionMap[t] for t in txnids if t not in rejected]
 
-            # now kick off the retrieval of the first transaction
-            if self._kick_off_next_transaction():
-                return
+    def _restore_snapshot(self, blocks, rejected):
+        """Install the transferred state and the blocks up to the snapshot
+        block, returns the blocks that still have to be committed.
+        """
+        count = [b.Identifier for b in blocks].index(self.SnapshotBlockID) + 1
+        history = blocks[:count]
 
-        self._finish()
+        payload = ''.join(self.ChunkMap[d] for d in self._chunkhashes)
+        if not self.Journal.restore_snapshot(
+                self.ChainIDs, history,
+                self._ordered_transactions(history, False, rejected),
+                payload):
+            return None
+        return blocks[count:]
 
     def _finish(self):
-        # everything has been returned... time to update the journal,
-        # first copy the transactions over and apply them to the
-        # global store, then copy the blocks in
+        # everything has been returned, recover the signers of all the
+        # blocks and transactions in batches rather than one at a time as
+        # they are committed
+        self._clearhandlers()
+        self.Journal.SignatureVerifier.submit(
+            self.BlockMap.values() + self.TransactionMap.values(),
+            self._commit)
+
+    def _rejected(self):
+        """Returns the identifiers of the blocks and transactions whose
+        signers could not be recovered, the signers of the others are
+        cached so checking them again is cheap.
+        """
+        rejected = set()
+        for (objid, obj) in self.BlockMap.items() + \
+                self.TransactionMap.items():
+            if not obj.verify_signature():
+                rejected.add(objid)
+
+        logger.warn('%d blocks and transactions from %s have bad signatures',
+                    len(rejected), self.Peer.Name)
+        return rejected
+
+    def _commit(self, valid):
+        # time to update the journal, first copy the transactions over and
+        # apply them to the global store, then copy the blocks in; when a
+        # signature failed the objects at fault are left out and the chain
+        # stops before the first bad block, the journal fetches the rest
+        # from its peers once it is running
+        rejected = set() if valid else self._rejected()
+
+        blocks = self.BlockMap.values()
+        for (index, blk) in enumerate(blocks):
+            if blk.Identifier in rejected:
+                blocks = blocks[:index]
+                break
+
+        if self.SnapshotBlockID is not None:
+            if self.SnapshotBlockID not in [b.Identifier for b in blocks]:
+                logger.warn('snapshot chain from %s has bad signatures',
+                            self.Peer.Name)
+                self._retry_later()
+                return
+
+            blocks = self._restore_snapshot(blocks, rejected)
+            if blocks is None:
+                logger.warn('snapshot from %s does not match its chain',
+                            self.Peer.Name)
+                self._retry_later()
+                return
 
         try:
-            for txnid, txn in self.TransactionMap.iteritems():
+            for txn in self._ordered_transactions(blocks, True, rejected):
                 self.Journal.add_pending_transaction(txn,
                                                      build_block=False)
 
-            for blkid, blk in self.BlockMap.iteritems():
+            for blk in blocks:
                 self.Journal.commit_transaction_block(blk)
 
         except AssertionError:
@@ -320,17 +727,10 @@ class JournalTransfer(object):
                 str(sys.exc_info()[0]))
 
         logger.info(
-            'journal transferred from %s, %d transactions, %d blocks, current '
-            'head is %s',
-            self.Peer, len(self.TransactionMap), len(self.BlockMap),
+            'journal transferred from %s and %d other peers, %d '
+            'transactions, %d blocks, %d retries, current head is %s',
+            self.Peer, len(self.Peers) - 1, len(self.TransactionMap),
+            len(self.BlockMap), self.TransferStats.RequestsRetried.Value,
             self.Journal.MostRecentCommittedBlockID[:8])
 
-        # clear all of the message handlers
-        self.Journal.clear_message_handler(BlockListReplyMessage)
-        self.Journal.clear_message_handler(BlockReplyMessage)
-        self.Journal.clear_message_handler(UncommittedListReplyMessage)
-        self.Journal.clear_message_handler(TransactionReplyMessage)
-        self.Journal.clear_message_handler(TransferFailedMessage)
-
-        # self.RetryID.cancel()
         self.Callback()
@@ -0,0 +1,302 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the versioned state history used by the KeyValueStore
+to hold the settled portion of a transaction store. Every key keeps the
+full list of values it has held, tagged with the version (the depth of the
+checkpoint in the chain of stores) where the value was written, so the
+value of a key as of any version can be found with a single binary search
+regardless of the length of the chain.
+"""
+
+import bisect
+import logging
+import os
+import struct
+import cPickle as pickle
+
+logger = logging.getLogger(__name__)
+
+
+class StateHistoryError(Exception):
+    """An exception raised when versions are appended out of order.
+    """
+    pass
+
+
+class StateHistory(object):
+    """An in-memory versioned record of the values of a store.
+
+    Versions must be appended in strictly increasing order; the history
+    represents a single linear chain of checkpoints.
+
+    Attributes:
+        LatestVersion (int): The most recent version appended to the
+            history, -1 if the history is empty.
+    """
+
+    _tombstone = object()
+
+    def __init__(self):
+        self.LatestVersion = -1
+        self._versions = {}
+        self._values = {}
+
+    def append(self, version, updates, deletions):
+        """Record the changes made by a single checkpoint.
+
+        Args:
+            version (int): The version of the checkpoint, must be greater
+                than LatestVersion.
+            updates (dict): Keys set in the checkpoint and their values.
+            deletions (iterable): Keys deleted in the checkpoint.
+        """
+        if version <= self.LatestVersion:
+            raise StateHistoryError(
+                'version {0} is not newer than {1}'.format(
+                    version, self.LatestVersion))
+
+        for key, value in updates.iteritems():
+            self._put(key, version, value)
+        for key in deletions:
+            self._put(key, version, self._tombstone)
+
+        self.LatestVersion = version
+
+    def _put(self, key, version, value):
+        if key not in self._versions:
+            self._versions[key] = []
+            self._values[key] = []
+        self._versions[key].append(version)
+        self._values[key].append(value)
+
+    def lookup(self, key, version):
+        """Return the value associated with a key as of a version.
+
+        Args:
+            key (str): The key to lookup.
+            version (int): The version at which to read the key.
+
+        Returns:
+            object: The stored value, callers must copy it before
+                modifying it.
+
+        Raises:
+            KeyError: If the key does not exist at the version.
+        """
+        versions = self._versions.get(key)
+        if versions:
+            index = bisect.bisect_right(versions, version)
+            if index > 0:
+                value = self._values[key][index - 1]
+                if value is not self._tombstone:
+                    return value
+        raise KeyError('attempt to access missing key', key)
+
+    def contains(self, key, version):
+        """Determine whether a key exists as of a version.
+
+        Args:
+            key (str): The key to search for.
+            version (int): The version at which to test the key.
+
+        Returns:
+            bool: Whether or not the key exists.
+        """
+        try:
+            self.lookup(key, version)
+        except KeyError:
+            return False
+        return True
+
+    def keys(self, version):
+        """Compute the set of keys that exist as of a version.
+
+        Args:
+            version (int): The version at which to compute the keys.
+
+        Returns:
+            set: The keys that exist at the version.
+        """
+        return set(k for k in self._versions if self.contains(k, version))
+
+    def close(self):
+        """Release any resources held by the history.
+        """
+        pass
+
+
+class LMDBStateHistory(StateHistory):
+    """A versioned record of the values of a store kept in an LMDB
+    database, so the history does not need to fit in memory.
+
+    Records are indexed by the key followed by the big-endian version so
+    that finding the value of a key at a version is a single B-tree seek.
+    The versions at which each key was set or deleted are also indexed in
+    memory, so the keys of a version are found without reading the
+    database. The history is a cache of the settled chain and is
+    truncated when it is opened.
+    """
+
+    _separator = '\x00'
+
+    def __init__(self, environment, name):
+        """Constructor for the LMDBStateHistory class.
+
+        Args:
+            environment (lmdb.Environment): The shared LMDB environment.
+            name (str): The name of the sub-database for this history.
+        """
+        super(LMDBStateHistory, self).__init__()
+        self._lmdb = environment
+        self._db = environment.open_db(name)
+
+        # key index, the values stay in the database
+        self._exists = {}
+        self._live = set()
+
+    @staticmethod
+    def open_environment(filename, maxhistories=64):
+        """Open the LMDB environment used to hold a set of histories.
+
+        Args:
+            filename (str): The name of the database file.
+            maxhistories (int): The maximum number of histories that
+                will be stored in the environment.
+
+        Returns:
+            lmdb.Environment: The opened environment.
+        """
+        import lmdb
+
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+        return lmdb.Environment(path=filename,
+                                map_size=1024**4,
+                                writemap=True,
+                                subdir=False,
+                                create=True,
+                                lock=False,
+                                max_dbs=maxhistories)
+
+    def _encode(self, key, version):
+        return key + self._separator + struct.pack('>Q', version)
+
+    def append(self, version, updates, deletions):
+        if version <= self.LatestVersion:
+            raise StateHistoryError(
+                'version {0} is not newer than {1}'.format(
+                    version, self.LatestVersion))
+
+        with self._lmdb.begin(write=True, db=self._db) as txn:
+            for key, value in updates.iteritems():
+                txn.put(self._encode(key, version),
+                        pickle.dumps((True, value), pickle.HIGHEST_PROTOCOL))
+            for key in deletions:
+                txn.put(self._encode(key, version),
+                        pickle.dumps((False, None), pickle.HIGHEST_PROTOCOL))
+
+        for key in updates:
+            self._index(key, version, True)
+        for key in deletions:
+            self._index(key, version, False)
+
+        self.LatestVersion = version
+
+    def _index(self, key, version, exists):
+        if key not in self._versions:
+            self._versions[key] = []
+            self._exists[key] = []
+        self._versions[key].append(version)
+        self._exists[key].append(exists)
+
+        if exists:
+            self._live.add(key)
+        else:
+            self._live.discard(key)
+
+    def lookup(self, key, version):
+        prefix = key + self._separator
+        with self._lmdb.begin(db=self._db) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(self._encode(key, version + 1)):
+                found = cursor.prev()
+            else:
+                found = cursor.last()
+
+            if found:
+                rkey = cursor.key()
+                if rkey.startswith(prefix) and len(rkey) == len(prefix) + 8:
+                    (exists, value) = pickle.loads(cursor.value())
+                    if exists:
+                        return value
+        raise KeyError('attempt to access missing key', key)
+
+    def contains(self, key, version):
+        versions = self._versions.get(key)
+        if versions:
+            index = bisect.bisect_right(versions, version)
+            if index > 0:
+                return self._exists[key][index - 1]
+        return False
+
+    def keys(self, version):
+        if version >= self.LatestVersion:
+            return set(self._live)
+        return set(k for k in self._versions if self.contains(k, version))
+
+
+class StateHistoryFactory(object):
+    """Creates the histories for the transaction stores of a ledger and
+    owns any resources they share.
+    """
+
+    def __init__(self, historytype, filename):
+        """Constructor for the StateHistoryFactory class.
+
+        Args:
+            historytype (str): The type of history, either 'memory' or
+                'lmdb'.
+            filename (str): The name of the file that holds lmdb
+                histories.
+        """
+        self._environment = None
+
+        if historytype == 'lmdb':
+            self._environment = LMDBStateHistory.open_environment(filename)
+        elif historytype != 'memory':
+            raise KeyError(
+                '{0} is not a supported StateHistoryType'.format(historytype))
+
+    def create(self, tname):
+        """Create the history for a transaction store.
+
+        Args:
+            tname (str): The name of the transaction store.
+
+        Returns:
+            StateHistory: An empty history.
+        """
+        if self._environment is not None:
+            return LMDBStateHistory(self._environment, tname)
+        return StateHistory()
+
+    def close(self):
+        """Release the resources shared by the histories.
+        """
+        if self._environment is not None:
+            self._environment.close()
+            self._environment = None
@@ -0,0 +1,262 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+"""
+This module defines the StateLog class, an append-only, checksummed log of
+the per-block state deltas written by the GlobalStoreManager, and the
+helpers used to write and read the compacted state snapshots that allow
+the log to be truncated.
+"""
+
+import logging
+import os
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class StateLogError(Exception):
+    """An exception raised when a state log record cannot be decoded.
+    """
+    pass
+
+
+_HEADER_FORMAT = '!II'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_IDS_FORMAT = '!HH'
+_IDS_SIZE = struct.calcsize(_IDS_FORMAT)
+
+
+def _encode_record(blockid, previd, payload):
+    body = struct.pack(_IDS_FORMAT, len(blockid), len(previd)) + \
+        blockid + previd + payload
+    crc = zlib.crc32(body) & 0xffffffff
+    return struct.pack(_HEADER_FORMAT, len(body), crc) + body
+
+
+def _read_record(fp):
+    """Read the next record from a file.
+
+    Returns:
+        tuple: (blockid, previd, payload) or None at a clean end of file.
+
+    Raises:
+        StateLogError: If the record is truncated or fails its checksum.
+    """
+    header = fp.read(_HEADER_SIZE)
+    if len(header) == 0:
+        return None
+    if len(header) < _HEADER_SIZE:
+        raise StateLogError('truncated record header')
+
+    (length, crc) = struct.unpack(_HEADER_FORMAT, header)
+    body = fp.read(length)
+    if len(body) < length:
+        raise StateLogError('truncated record body')
+    if zlib.crc32(body) & 0xffffffff != crc:
+        raise StateLogError('record checksum mismatch')
+
+    (bidlen, pidlen) = struct.unpack(_IDS_FORMAT, body[:_IDS_SIZE])
+    offset = _IDS_SIZE
+    blockid = body[offset:offset + bidlen]
+    offset += bidlen
+    previd = body[offset:offset + pidlen]
+    offset += pidlen
+    return (blockid, previd, body[offset:])
+
+
+def write_snapshot(filename, blockid, previd, payload):
+    """Atomically replace a snapshot file.
+
+    Args:
+        filename (str): The name of the snapshot file.
+        blockid (str): The block the snapshot captures.
+        previd (str): The block that precedes the snapshot block.
+        payload (bytes): The encoded state.
+    """
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fp:
+        fp.write(_encode_record(blockid, previd, payload))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmpname, filename)
+
+
+def read_snapshot(filename):
+    """Read a snapshot file.
+
+    Args:
+        filename (str): The name of the snapshot file.
+
+    Returns:
+        tuple: (blockid, previd, payload) or None if there is no usable
+            snapshot.
+    """
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, 'rb') as fp:
+        try:
+            return _read_record(fp)
+        except StateLogError as e:
+            logger.warn('ignoring damaged state snapshot %s; %s',
+                        filename, e)
+            return None
+
+
+class StateLog(object):
+    """An append-only log of block state records.
+
+    Each record is framed with its length and a CRC32 of its contents.
+    On open the log is scanned once to build an index of block id to
+    file offset; a damaged or partially written tail (for example from a
+    crash during a write) is truncated. Appends are buffered and only
+    forced to disk on sync(), so callers control the size of the batch.
+
+    Attributes:
+        Filename (str): The name of the log file.
+    """
+
+    def __init__(self, filename, flag='c'):
+        """Constructor for the StateLog class.
+
+        Args:
+            filename (str): The name of the log file.
+            flag (str): 'n' to always create a new, empty log or 'c' to
+                open an existing log, creating it if necessary.
+        """
+        self.Filename = filename
+        self._index = {}
+        self._previous = {}
+
+        if flag == 'n' and os.path.isfile(filename):
+            os.remove(filename)
+
+        if not os.path.isfile(filename):
+            open(filename, 'wb').close()
+
+        self._fp = open(filename, 'r+b')
+        self._scan()
+        self._fp.seek(0, os.SEEK_END)
+
+    def _scan(self):
+        self._fp.seek(0)
+        offset = 0
+        while True:
+            try:
+                record = _read_record(self._fp)
+            except StateLogError as e:
+                logger.warn('truncating state log %s at offset %d; %s',
+                            self.Filename, offset, e)
+                self._fp.truncate(offset)
+                break
+
+            if record is None:
+                break
+
+            (blockid, previd, _) = record
+            self._index[blockid] = offset
+            self._previous[blockid] = previd
+            offset = self._fp.tell()
+
+        logger.info('state log %s contains %d blocks', self.Filename,
+                    len(self._index))
+
+    def __contains__(self, blockid):
+        return blockid in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        """Returns the list of block ids in the log.
+        """
+        return self._index.keys()
+
+    def previous_block_id(self, blockid):
+        """Returns the id of the block that precedes a block in the log.
+
+        Args:
+            blockid (str): The block id to look up.
+        """
+        return self._previous[blockid]
+
+    def append(self, blockid, previd, payload):
+        """Append the state record for a block.
+
+        Args:
+            blockid (str): The identifier of the block.
+            previd (str): The identifier of the preceding block.
+            payload (bytes): The encoded state delta for the block.
+        """
+        self._fp.seek(0, os.SEEK_END)
+        offset = self._fp.tell()
+        self._fp.write(_encode_record(blockid, previd, payload))
+        self._index[blockid] = offset
+        self._previous[blockid] = previd
+
+    def read(self, blockid):
+        """Read the state record for a block.
+
+        Args:
+            blockid (str): The identifier of the block.
+
+        Returns:
+            bytes: The encoded state delta for the block.
+        """
+        self._fp.flush()
+        self._fp.seek(self._index[blockid])
+        (_, _, payload) = _read_record(self._fp)
+        self._fp.seek(0, os.SEEK_END)
+        return payload
+
+    def sync(self):
+        """Force all appended records to disk.
+        """
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def compact(self, keep):
+        """Rewrite the log so that it only contains the specified blocks.
+
+        Args:
+            keep (set): The identifiers of the blocks to retain.
+        """
+        tmpname = self.Filename + '.tmp'
+        index = {}
+        previous = {}
+        with open(tmpname, 'wb') as fp:
+            # rewrite in the original order so that parents continue to
+            # precede their children
+            for blockid in sorted(keep, key=lambda b: self._index[b]):
+                index[blockid] = fp.tell()
+                previous[blockid] = self._previous[blockid]
+                fp.write(_encode_record(blockid, previous[blockid],
+                                        self.read(blockid)))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        self._fp.close()
+        os.rename(tmpname, self.Filename)
+        self._fp = open(self.Filename, 'r+b')
+        self._fp.seek(0, os.SEEK_END)
+        self._index = index
+        self._previous = previous
+
+    def close(self):
+        """Flush and close the log.
+        """
+        self.sync()
+        self._fp.close()
@@ -143,8 +143,9 @@ class TransactionBlock(signed_object.SignedObject):
         assert self.Status == Status.valid
         self.TransactionDepth = len(self.TransactionIDs)
 
-        if self.PreviousBlockID != common.NullIdentifier:
-            assert self.PreviousBlockID in journal.BlockStore
+        # the oldest block of a journal started from a snapshot has no
+        # predecessor, weights are counted from there
+        if self.PreviousBlockID in journal.BlockStore:
             self.TransactionDepth += journal.BlockStore[
                 self.PreviousBlockID].TransactionDepth
 
@@ -0,0 +1,119 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import unittest
+
+from gossip.common import NullIdentifier
+from journal.chain_index import ChainIndex
+
+
+class FakeBlock(object):
+    def __init__(self, previd):
+        self.PreviousBlockID = previd
+
+
+class TestChainIndex(unittest.TestCase):
+    def setUp(self):
+        self.blockstore = {}
+        self.chainstore = {}
+
+    def _extend(self, previd, count, prefix):
+        blockids = []
+        for i in xrange(count):
+            blockid = '{0}{1:04d}'.format(prefix, i)
+            self.blockstore[blockid] = FakeBlock(previd)
+            blockids.append(blockid)
+            previd = blockid
+        return blockids
+
+    def _commit(self, index, blockids):
+        for blockid in blockids:
+            index.push(blockid)
+
+    def test_committed_chain(self):
+        index = ChainIndex(self.blockstore, self.chainstore)
+        main = self._extend(NullIdentifier, 300, 'main')
+        self._commit(index, main)
+
+        self.assertEqual(index.Height, 299)
+        self.assertEqual(index.committed_block_ids(), main[::-1])
+        self.assertEqual(index.committed_block_ids(3), main[:-4:-1])
+        self.assertEqual(index.block_ids(100, 5), main[100:105])
+        self.assertEqual(index.block_ids(298, 5), main[298:])
+
+        for height in [0, 1, 2, 7, 64, 100, 255, 298]:
+            self.assertEqual(index.ancestor(main[299], height), main[height])
+        self.assertEqual(index.ancestor(main[299], -1), NullIdentifier)
+
+        self.assertEqual(index.pop(), main[-1])
+        self.assertEqual(index.Head, main[-2])
+
+    def test_find_fork(self):
+        index = ChainIndex(self.blockstore, self.chainstore)
+        main = self._extend(NullIdentifier, 200, 'main')
+        self._commit(index, main)
+
+        fork = self._extend(main[120], 150, 'fork')
+        self.assertEqual(index.find_fork(fork[-1]), main[120])
+        self.assertEqual(index.find_fork(main[50]), main[50])
+
+        other = self._extend(NullIdentifier, 10, 'other')
+        self.assertEqual(index.find_fork(other[-1]), NullIdentifier)
+
+        # switch the committed chain to the fork
+        while index.Head != main[120]:
+            index.pop()
+        self._commit(index, fork)
+        self.assertEqual(index.find_fork(main[-1]), main[120])
+        self.assertFalse(index.is_committed(main[121]))
+        self.assertTrue(index.is_committed(fork[3]))
+
+    def test_load(self):
+        index = ChainIndex(self.blockstore, self.chainstore)
+        main = self._extend(NullIdentifier, 50, 'main')
+        self._commit(index, main)
+        index.pop()
+
+        # the persisted chain is used when the head matches
+        restored = ChainIndex({}, self.chainstore)
+        restored.load(main[-2])
+        self.assertEqual(restored.committed_block_ids(), main[-2::-1])
+
+        # otherwise the chain is rebuilt from the block store
+        restored = ChainIndex(self.blockstore, {})
+        restored.load(main[-1])
+        self.assertEqual(restored.committed_block_ids(), main[::-1])
+        self.assertEqual(restored.find_fork(main[10]), main[10])
+
+    def test_seed(self):
+        main = self._extend(NullIdentifier, 100, 'main')
+
+        # only the most recent blocks are in the block store
+        blockstore = dict((b, self.blockstore[b]) for b in main[-5:])
+        index = ChainIndex(blockstore, self.chainstore)
+        index.seed(main[:-2])
+        self._commit(index, main[-2:])
+
+        self.assertEqual(index.Head, main[-1])
+        for height in [0, 1, 37, 64, 97]:
+            self.assertEqual(index.ancestor(main[-1], height), main[height])
+
+        fork = self._extend(main[96], 3, 'fork')
+        blockstore.update((b, self.blockstore[b]) for b in fork)
+        self.assertEqual(index.find_fork(fork[-1]), main[96])
+
+        restored = ChainIndex({}, self.chainstore)
+        restored.load(main[-1])
+        self.assertEqual(restored.committed_block_ids(), main[::-1])
@@ -0,0 +1,62 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import hashlib
+import unittest
+
+from gossip.duplicate_filter import DuplicateFilter
+
+
+def _digest(index):
+    return hashlib.sha256(str(index)).digest()
+
+
+class TestDuplicateFilter(unittest.TestCase):
+    def test_add_and_discard(self):
+        dfilter = DuplicateFilter(capacity=1000, error_rate=1e-4)
+        for i in range(500):
+            dfilter.add(_digest(i))
+        for i in range(500):
+            self.assertIn(_digest(i), dfilter)
+
+        # with this error rate no false positives are expected here
+        missing = [i for i in range(500, 1500) if _digest(i) in dfilter]
+        self.assertLessEqual(len(missing), 1)
+
+        dfilter.discard(_digest(1))
+        self.assertNotIn(_digest(1), dfilter)
+        dfilter.add(_digest(1))
+        self.assertIn(_digest(1), dfilter)
+
+    def test_rotation(self):
+        dfilter = DuplicateFilter(capacity=10, error_rate=1e-4)
+        for i in range(10):
+            dfilter.add(_digest(i))
+
+        # a full generation is kept for one more generation
+        dfilter.add(_digest(10))
+        self.assertIn(_digest(0), dfilter)
+        for i in range(11, 21):
+            dfilter.add(_digest(i))
+        self.assertNotIn(_digest(0), dfilter)
+        self.assertIn(_digest(10), dfilter)
+
+    def test_window(self):
+        dfilter = DuplicateFilter(capacity=10, window=0.0)
+        dfilter.add(_digest(0))
+        dfilter.add(_digest(1))
+        dfilter.add(_digest(2))
+        self.assertNotIn(_digest(0), dfilter)
+        self.assertIn(_digest(1), dfilter)
@@ -13,15 +13,19 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import copy
+import hashlib
 import unittest
 import time
 import pybitcointools
 
 import gossip.signed_object as SigObj
 
-from gossip.gossip_core import Gossip, GossipException
-from gossip.message import Packet, Message
+from gossip.duplicate_filter import DuplicateFilter
+from gossip.gossip_core import Gossip, GossipException, MessageQueue
+from gossip.message import Packet, PacketBundle, PacketFragment, Message
 from gossip.node import Node
+from gossip.messages import busy_message
 from gossip.messages import shutdown_message
 
 
@@ -30,6 +34,25 @@ def generate_private_key():
     return pybitcointools.encode_privkey(pybitcointools.random_key(), 'wif')
 
 
+class BlockMessage(Message):
+    DispatchLane = 'Block'
+
+
+class TransactionMessage(Message):
+    DispatchLane = 'Transaction'
+
+
+class LargeMessage(Message):
+    def __init__(self, minfo=None):
+        super(LargeMessage, self).__init__(minfo)
+        self.Payload = (minfo or {}).get('Payload', '')
+
+    def dump(self):
+        result = super(LargeMessage, self).dump()
+        result['Payload'] = self.Payload
+        return result
+
+
 class TestGossipCore(unittest.TestCase):
     # Helper functions for creating the test
     def _setup(self, port):
@@ -164,6 +187,7 @@ class TestGossipCoreDatagram(unittest.TestCase):
     def test_gossip_datagram_recieved(self):
         # Test that datagramReceived behaves as expected
         core = self._setup(9000)
+        core.DuplicateFilter = DuplicateFilter(error_rate=1e-6)
         peer = self._create_node(9001)
         peer2 = self._create_node(9002)
         core.add_node(peer)
@@ -187,6 +211,60 @@ class TestGossipCoreDatagram(unittest.TestCase):
         core.datagramReceived(data2, "localhost:9001")
         pakStats = core.PacketStats.get_stats(["DuplicatePackets"])
         self.assertEquals(pakStats["DuplicatePackets"], 1)
+        # Later copies of the duplicate are dropped before decoding
+        core.datagramReceived(data2, "localhost:9001")
+        pakStats = core.PacketStats.get_stats(["DuplicatePackets",
+                                               "FilteredDuplicates"])
+        self.assertEquals(pakStats["DuplicatePackets"], 2)
+        self.assertEquals(pakStats["FilteredDuplicates"], 1)
+
+    def test_gossip_datagram_filter_miss(self):
+        # Test that a message matched by the duplicate filter alone is
+        # decoded and handled rather than dropped
+        core = self._setup(9014)
+        core.DuplicateFilter = DuplicateFilter(error_rate=1e-6)
+        core.register_message_handler(Message, lambda msg, gossiper: None)
+        peer = self._create_node(9015)
+        core.add_node(peer)
+
+        msg = Message({'Payload': "new"})
+        msg.sign_from_node(peer)
+        pak = Packet()
+        pak.add_message(msg, peer, core.LocalNode, 3)
+        core.DuplicateFilter.add(hashlib.sha256(pak.Data).digest())
+        core.datagramReceived(pak.pack(), "localhost:9015")
+        self.assertEquals(core.PacketStats.FilteredDuplicates.Value, 0)
+        self.assertEquals(core.PacketStats.MessagesAcked.Value, 1)
+        self.assertIn(msg.Identifier, core.MessageHandledMap)
+
+        # the copy received next is dropped without being decoded
+        core.datagramReceived(pak.pack(), "localhost:9015")
+        self.assertEquals(core.PacketStats.FilteredDuplicates.Value, 1)
+
+    def test_gossip_datagram_refused(self):
+        # Test that a message refused for a full lane is not acked
+        core = self._setup(9012)
+        core.register_message_handler(Message, lambda msg, gossiper: None)
+        peer = self._create_node(9013)
+        core.add_node(peer)
+        lane = [l for l in core.MessageQueue.Lanes if l.Name == 'Default'][0]
+        lane.Capacity = 1
+        core.MessageQueue.appendleft(Message({'__SIGNATURE__': "queued"}))
+
+        msg = Message({'Payload': "refused"})
+        msg.sign_from_node(peer)
+        pak = Packet()
+        pak.add_message(msg, peer, core.LocalNode, 3)
+        core.datagramReceived(pak.pack(), "localhost:9013")
+        self.assertEquals(lane.Dropped.Value, 1)
+        self.assertEquals(core.PacketStats.MessagesAcked.Value, 0)
+        self.assertNotIn(msg.Identifier, core.MessageHandledMap)
+
+        # the copy sent again once there is room is admitted and acked
+        lane.Capacity = 2
+        core.datagramReceived(pak.pack(), "localhost:9013")
+        self.assertEquals(core.PacketStats.MessagesAcked.Value, 1)
+        self.assertIn(msg.Identifier, core.MessageHandledMap)
 
     def test_gossip_datagram_unknown_peer(self):
         # Test that nothing is done if the nodes are not known
@@ -218,6 +296,28 @@ class TestGossipCoreDatagram(unittest.TestCase):
         stats = core.PacketStats.get_stats(["AcksReceived"])
         self.assertEquals(stats["AcksReceived"], 1)
 
+    def test_gossip_datagram_bundle(self):
+        # Test that the acks and packets in a bundle are all handled
+        core = self._setup(9010)
+        peer = self._create_node(9011)
+        core.add_node(peer)
+        sent = Packet()
+        sent.add_message(self._create_msg(), core.LocalNode, peer, 0)
+        core.PendingAckMap[0] = sent
+
+        bundle = PacketBundle(peer.Identifier)
+        bundle.add_ack(0)
+        for index in range(2):
+            msg = Message({'__SIGNATURE__': "test{0}".format(index)})
+            pak = Packet()
+            pak.add_message(msg, peer, core.LocalNode, index)
+            bundle.add_packet(pak.pack())
+        core.datagramReceived(bundle.pack(), "localhost:9011")
+
+        stats = core.PacketStats.get_stats(["AcksReceived", "MessagesAcked"])
+        self.assertEquals(stats["AcksReceived"], 1)
+        self.assertEquals(stats["MessagesAcked"], 2)
+
 
 class TestGossipCoreUtilityAndInterface(unittest.TestCase):
 
@@ -328,7 +428,7 @@ class TestGossipCoreUtilityAndInterface(unittest.TestCase):
         self.assertEquals(stats["AcksReceived"], 0)
 
     def test_gossip_timer(self):
-        # Test timertransmit
+        # Test transmit
         now = time.time()
         core = self._setup(8816)
         node1 = self._create_node(8813)
@@ -350,7 +450,8 @@ class TestGossipCoreUtilityAndInterface(unittest.TestCase):
         now = time.time()
         # Adds messages to PendingAckMap
         self.assertEqual(core.PendingAckMap, {})
-        core._timertransmit(now)
+        for node in [node1, node2, node3]:
+            core._transmit(node, now)
         self.assertNotEqual(core.PendingAckMap, {})
         self.assertEquals(len(core.PendingAckMap), 3)
         # Test _timercleanup
@@ -359,6 +460,194 @@ class TestGossipCoreUtilityAndInterface(unittest.TestCase):
         core._timercleanup(now)
         self.assertEqual(core.PendingAckMap, {})
 
+    def test_gossip_transmit_timer(self):
+        # Test that a peer's transmit timer is armed for its next message
+        core = self._setup(9059)
+        written = []
+        core._dowrite = lambda data, peer: written.append(data)
+        peer = self._create_node(9060)
+        core.add_node(peer)
+
+        now = time.time()
+        core._scheduletransmit(peer, now)
+        self.assertNotIn(peer.Identifier, core._transmittimers)
+
+        peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+        msg = self._create_msg()
+        peer.enqueue_message(msg, now)
+        core._scheduletransmit(peer, now)
+        timer = core._transmittimers[peer.Identifier]
+        self.assertAlmostEqual(timer.getTime(), peer.MessageQ.Head[0],
+                               places=1)
+
+        # an empty token bucket holds the message until it refills
+        peer.TokenBucket.Tokens = 0
+        peer.TokenBucket.LastDrip = now + 5
+        self.assertGreater(peer.next_send_time(), now + 5)
+
+        # the timer sends the message and is not armed again
+        timer.cancel()
+        peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+        peer.TokenBucket.LastDrip = now
+        peer.MessageQ.reschedule_message(msg, now - 1)
+        core._transmittimer(peer.Identifier)
+        self.assertEquals(len(written), 1)
+        self.assertNotIn(peer.Identifier, core._transmittimers)
+
+    def test_gossip_coalesce(self):
+        # Test that packets and acks for a peer share a datagram
+        core = self._setup(9055)
+        core.CoalescePackets = True
+        written = []
+        core._dowrite = lambda data, peer: written.append(data)
+        peer = self._create_node(9056)
+        core.add_node(peer)
+
+        for seqno in [7, 8]:
+            pak = Packet()
+            pak.SequenceNumber = seqno
+            core._sendack(pak, peer)
+        self.assertEquals(written, [])
+
+        now = time.time()
+        peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+        for index in range(3):
+            msg = Message({'__SIGNATURE__': "test{0}".format(index)})
+            peer.enqueue_message(msg, now)
+        core._transmit(peer, now + 100)
+        self.assertEquals(len(written), 1)
+        self.assertEquals(len(core.PendingAckMap), 3)
+
+        bundle = PacketBundle()
+        bundle.unpack(written[0])
+        self.assertEquals(bundle.Acks, [7, 8])
+        self.assertEquals(len(bundle.Packets), 3)
+
+        # acks with no packet to join are sent on their own
+        pak.SequenceNumber = 9
+        core._sendack(pak, peer)
+        core._ackflush.cancel()
+        core._flushacks()
+        self.assertEquals(len(written), 2)
+        bundle.unpack(written[1])
+        self.assertEquals((bundle.Acks, bundle.Packets), ([9], []))
+
+    def test_gossip_fragments(self):
+        # Test that a message larger than a packet is sent in fragments
+        sender = self._setup(9057)
+        receiver = self._setup(9058)
+        sent = []
+        sender._dowrite = lambda data, peer: sent.append(data)
+        receiver._dowrite = lambda data, peer: None
+        peer = self._create_node(9058)
+        peer.Identifier = receiver.LocalNode.Identifier
+        sender.add_node(peer)
+        origin = self._create_node(9057)
+        origin.Identifier = sender.LocalNode.Identifier
+        receiver.add_node(origin)
+
+        msg = LargeMessage({'__SIGNATURE__': "test",
+                            'Payload': "x" * 100000})
+        now = time.time()
+        peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+        peer.enqueue_message(msg, now)
+        sender._transmit(peer, now + 100)
+        self.assertEquals(len(sent), 3)
+        self.assertEquals(len(sender.PendingAckMap), 3)
+
+        # the packet is handled once every fragment has arrived
+        receiver.datagramReceived(sent[2], "localhost:9057")
+        receiver.datagramReceived(sent[0], "localhost:9057")
+        stats = receiver.PacketStats
+        self.assertEquals(stats.PacketsReassembled.Value, 0)
+        receiver.datagramReceived(sent[1], "localhost:9057")
+        self.assertEquals(stats.PacketsReassembled.Value, 1)
+        self.assertEquals(stats.MessagesAcked.Value, 3)
+        self.assertIn(LargeMessage.MessageType,
+                      receiver.MessageStats.MessageType.Values)
+
+        # a fragment sent again after that is acked and ignored
+        receiver.datagramReceived(sent[1], "localhost:9057")
+        self.assertEquals(stats.PacketsReassembled.Value, 1)
+        self.assertEquals(stats.MessagesAcked.Value, 4)
+
+        # only the fragment whose ack is missing is sent again
+        for seqno in sorted(sender.PendingAckMap.keys())[:2]:
+            ack = Packet()
+            ack.SenderID = peer.Identifier
+            ack.SequenceNumber = seqno
+            sender._handleack(ack)
+        sender._timercleanup(now + 1000)
+        self.assertEquals(len(sent), 4)
+        self.assertEquals(sent[3], sent[2])
+        self.assertEquals(sender.PacketStats.FragmentsResent.Value, 1)
+        self.assertEquals(len(sender.PendingAckMap), 1)
+
+    def _fragment(self, sender, packetid, index, count):
+        fragment = PacketFragment()
+        fragment.SenderID = sender.Identifier
+        fragment.SequenceNumber = packetid * 10 + index
+        fragment.PacketID = packetid
+        fragment.Index = index
+        fragment.Count = count
+        fragment.Data = 'x'
+        return fragment.pack()
+
+    def test_gossip_fragments_rejected(self):
+        # Test that fragments that cannot be reassembled are not acked
+        receiver = self._setup(9063)
+        acks = []
+        receiver._sendack = lambda packet, peer: acks.append(packet)
+        origin = self._create_node(9064)
+        receiver.add_node(origin)
+        receiver.MaximumFragments = 4
+        stats = receiver.PacketStats
+
+        # an index out of range or a count of zero
+        receiver.datagramReceived(self._fragment(origin, 1, 2, 2),
+                                  "localhost:9064")
+        receiver.datagramReceived(self._fragment(origin, 1, 0, 0),
+                                  "localhost:9064")
+        self.assertEquals(receiver._reassembly, {})
+
+        # more fragments than allowed
+        receiver.datagramReceived(self._fragment(origin, 1, 0, 5),
+                                  "localhost:9064")
+        self.assertEquals(stats.RejectedFragments.Value, 1)
+        self.assertEquals(receiver._reassembly, {})
+
+        # a count that differs from the first fragment of the packet
+        receiver.datagramReceived(self._fragment(origin, 2, 0, 2),
+                                  "localhost:9064")
+        receiver.datagramReceived(self._fragment(origin, 2, 3, 4),
+                                  "localhost:9064")
+        self.assertEquals(stats.RejectedFragments.Value, 2)
+        self.assertEquals(len(acks), 1)
+        self.assertEquals(receiver._reassembly[(origin.Identifier, 2)][2],
+                          {0: 'x'})
+
+    def test_gossip_reassembly_buffers(self):
+        # Test that the packets reassembled for one peer are limited
+        receiver = self._setup(9061)
+        acks = []
+        receiver._sendack = lambda packet, peer: acks.append(packet)
+        origin = self._create_node(9062)
+        receiver.add_node(origin)
+        receiver.MaximumReassemblyBuffers = 2
+
+        for packetid in range(3):
+            receiver.datagramReceived(self._fragment(origin, packetid, 0, 2),
+                                      "localhost:9062")
+        self.assertEquals(len(receiver._reassembly), 2)
+        self.assertEquals(len(acks), 2)
+        self.assertEquals(receiver.PacketStats.RejectedFragments.Value, 1)
+
+        # a buffer is freed when its packet times out
+        receiver._timercleanup(time.time() + receiver.ReassemblyTimeout + 1)
+        receiver.datagramReceived(self._fragment(origin, 2, 0, 2),
+                                  "localhost:9062")
+        self.assertEquals(len(acks), 3)
+
     def test_gossip_dispatcher(self):
         # Test _dispatch will not loop if not processing messages
         core = self._setup(8883)
@@ -393,6 +682,34 @@ class TestGossipCoreUtilityAndInterface(unittest.TestCase):
         after2 = str(core.NodeMap)
         self.assertEquals(before, after2)
 
+    def test_busy_signal(self):
+        # Test that a saturated queue asks the peers to hold their traffic
+        core = self._setup(9053)
+        core.MessageQueue = MessageQueue(limits={'Block': 4})
+        peer = self._create_node(9054)
+        core.add_node(peer)
+
+        now = time.time()
+        core._busysignal(now)
+        self.assertEqual(core.DispatchStats.BusySignals.Value, 0)
+        for _ in range(3):
+            core.MessageQueue.appendleft(BlockMessage())
+        core._busysignal(now)
+        core._busysignal(now)
+        self.assertEqual(core.DispatchStats.BusySignals.Value, 1)
+        self.assertEqual(peer.MessageQ.Count, 1)
+
+        # the peer gets only system messages until the hold time is over
+        msg = busy_message.BusyMessage({'HoldTime': 60.0})
+        msg.sign_from_node(peer)
+        busy_message.busy_handler(msg, core)
+        self.assertEqual(peer.TokenBucket.Tokens, 0)
+        self.assertGreater(peer.TokenBucket.LastDrip,
+                           now + core.MaximumBusyHoldTime - 1)
+        peer.TokenBucket.drip()
+        self.assertEqual(peer.TokenBucket.Tokens, 0)
+        self.assertFalse(peer.TokenBucket.consume(1))
+
     # Locally defined interface methods
     def test_gossip_shutdown(self):
         # Test that shutdown will empty the queue
@@ -506,3 +823,79 @@ class TestGossipCoreUtilityAndInterface(unittest.TestCase):
         core.broadcast_message(msg)
         self.assertEquals(str(node1.MessageQ), str(node2.MessageQ))
         self.assertIn(msg.Identifier, core.MessageHandledMap)
+
+
+class TestMessageQueue(unittest.TestCase):
+    def _system_msg(self):
+        msg = Message()
+        msg.IsSystemMessage = True
+        return msg
+
+    def test_lanes_by_priority(self):
+        queue = MessageQueue()
+        block1 = BlockMessage()
+        txn = TransactionMessage()
+        system = self._system_msg()
+        for msg in [block1, txn, system]:
+            queue.appendleft(msg)
+        self.assertEqual(len(queue), 3)
+
+        (systemlane, msg) = queue.take()
+        self.assertEqual((systemlane.Name, msg), ('System', system))
+        (txnlane, msg) = queue.take()
+        self.assertEqual((txnlane.Name, msg), ('Transaction', txn))
+        (blocklane, msg) = queue.take()
+        self.assertEqual((blocklane.Name, msg), ('Block', block1))
+        queue.done(blocklane, 0.5)
+        self.assertEqual(blocklane.Handled.Value, 1)
+        self.assertEqual(blocklane.HandleTime.get_metric(), [0.5, 1])
+
+        # a newer message of a higher priority lane goes first
+        block2 = BlockMessage()
+        queue.appendleft(block2)
+        queue.appendleft(txn)
+        self.assertEqual(queue.take(), (txnlane, txn))
+        self.assertEqual(queue.take(), (blocklane, block2))
+        self.assertEqual(len(queue), 0)
+
+    def test_copy_and_pop(self):
+        queue = MessageQueue()
+        block = BlockMessage()
+        system = self._system_msg()
+        queue.appendleft(block)
+        queue.appendleft(system)
+
+        copied = copy.deepcopy(queue)
+        self.assertEqual(len(copied), 2)
+        self.assertEqual(queue.pop(), system)
+        self.assertEqual(queue.pop(), block)
+        self.assertEqual(len(copied), 2)
+
+    def test_queue_limits(self):
+        queue = MessageQueue(limits={'Transaction': 2, 'Block': 2})
+        txns = [TransactionMessage() for _ in range(3)]
+        blocks = [BlockMessage() for _ in range(3)]
+
+        # new messages are rejected from a full transaction lane
+        for txn in txns[:2]:
+            self.assertEqual(queue.admit(txn), (True, None))
+            queue.appendleft(txn)
+        self.assertTrue(queue.Saturated)
+        self.assertEqual(queue.admit(txns[2]), (False, None))
+
+        # the oldest message is shed from a full block lane
+        for block in blocks[:2]:
+            queue.admit(block)
+            queue.appendleft(block)
+        self.assertEqual(queue.admit(blocks[2]), (True, blocks[0]))
+        queue.appendleft(blocks[2])
+        self.assertEqual(len(queue), 4)
+
+        # system messages are never dropped
+        for _ in range(10):
+            self.assertEqual(queue.admit(self._system_msg()), (True, None))
+
+        lanes = dict((l.Name, l) for l in queue.Lanes)
+        self.assertEqual(lanes['Transaction'].Dropped.Value, 1)
+        self.assertEqual(lanes['Block'].Dropped.Value, 1)
+        self.assertEqual(copy.deepcopy(queue).Lanes[2].Capacity, 2)
@@ -0,0 +1,99 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import tempfile
+import time
+import unittest
+
+import gossip.signed_object as SigObj
+from gossip.node import Node
+
+from journal.journal_core import Journal
+from journal.messages.inventory_message import InventoryMessage
+from journal.messages.inventory_message import InventoryRequestMessage
+from journal.transaction import Transaction
+
+
+class TestInventoryMessage(unittest.TestCase):
+    def _journal(self, port):
+        signingkey = SigObj.generate_signing_key()
+        ident = SigObj.generate_identifier(signingkey)
+        node = Node(identifier=ident, signingkey=signingkey,
+                    address=("localhost", port))
+        journal = Journal(node, DataDirectory=tempfile.mkdtemp(),
+                          ForwardMode='announce', AnnounceBatchSize=2)
+
+        journal.sent = []
+        journal.forwarded = []
+        journal.send_message = \
+            lambda msg, peerid: journal.sent.append((msg, peerid))
+        journal.forward_message = \
+            lambda msg, exceptions=None, initialize=True: \
+            journal.forwarded.append((msg, exceptions))
+        return journal
+
+    def _transaction(self, journal):
+        minfo = {'__SIGNATURE__': 'Test', '__NONCE__': time.time(),
+                 'Dependencies': []}
+        transaction = Transaction(minfo)
+        transaction.sign_from_node(journal.LocalNode)
+        return transaction
+
+    def test_announce_in_batches(self):
+        journal = self._journal(10200)
+        txns = [self._transaction(journal) for _ in range(3)]
+        for txn in txns:
+            msg = txn.build_message()
+            msg.SenderID = 'peer1'
+            journal.propagate_message(msg, txn.Identifier)
+        self.assertEqual(journal.forwarded, [])
+
+        journal._announceinventory(time.time())
+        self.assertEqual(len(journal.forwarded), 2)
+        (msg, exceptions) = journal.forwarded[0]
+        self.assertIsInstance(msg, InventoryMessage)
+        self.assertEqual(msg.TransactionIDs,
+                         [txns[0].Identifier, txns[1].Identifier])
+        self.assertEqual(msg.BlockIDs, [])
+
+        # the peer that sent every object in the batch is skipped
+        self.assertEqual(exceptions, ['peer1'])
+
+        # nothing is announced twice
+        journal._announceinventory(time.time() + 1)
+        self.assertEqual(len(journal.forwarded), 2)
+
+    def test_request_missing_once(self):
+        journal = self._journal(10201)
+        known = self._transaction(journal)
+        journal.TransactionStore[known.Identifier] = known
+        missing = self._transaction(journal)
+
+        journal.inventory_received(
+            'peer1', [known.Identifier, missing.Identifier], [])
+        self.assertEqual(len(journal.sent), 1)
+        (msg, peerid) = journal.sent[0]
+        self.assertIsInstance(msg, InventoryRequestMessage)
+        self.assertEqual(peerid, 'peer1')
+        self.assertEqual(msg.TransactionIDs, [missing.Identifier])
+
+        # a second announcement waits for the outstanding request
+        journal.inventory_received('peer2', [missing.Identifier], [])
+        self.assertEqual(len(journal.sent), 1)
+
+        journal._inventoryrequests[missing.Identifier] = time.time() - 1
+        journal.inventory_received('peer2', [missing.Identifier], [])
+        self.assertEqual(len(journal.sent), 2)
+        self.assertEqual(journal.sent[1][1], 'peer2')
@@ -0,0 +1,88 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal.database.shelf_database import ShelfDatabase
+from journal.journal_store import JournalStore
+
+
+class TestJournalStoreCache(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._database = ShelfDatabase(
+            os.path.join(self._directory, 'test.shelf'), 'n')
+
+    def tearDown(self):
+        self._database.close()
+        shutil.rmtree(self._directory)
+
+    def test_lru_eviction(self):
+        store = JournalStore(self._database, cachesize=2)
+        store['a'] = {'value': 1}
+        store['b'] = {'value': 2}
+        self.assertEqual(store['a'], {'value': 1})
+        self.assertEqual(store.CacheHits, 1)
+
+        # 'b' is the least recently used value
+        store['c'] = {'value': 3}
+        self.assertEqual(store.CacheEvictions, 1)
+        self.assertEqual(store['a'], {'value': 1})
+        self.assertEqual(store.CacheHits, 2)
+        self.assertEqual(store['b'], {'value': 2})
+        self.assertEqual(store.CacheMisses, 1)
+        self.assertIsNone(store.get('missing'))
+        self.assertEqual(store.CacheMisses, 2)
+
+    def test_write_through(self):
+        store = JournalStore(self._database, cachesize=10)
+        store['a'] = {'value': 1}
+        store['a'] = {'value': 2}
+        self.assertEqual(self._database.get('a'), {'value': 2})
+        self.assertEqual(store['a'], {'value': 2})
+
+        store.delete('a')
+        self.assertNotIn('a', store)
+        self.assertIsNone(store.get('a'))
+
+    def test_cached_values_are_shared(self):
+        store = JournalStore(self._database, cachesize=10)
+        store['a'] = {'value': [1]}
+
+        # hits return the decoded value without decoding it again
+        value = store['a']
+        self.assertIs(store['a'], value)
+        self.assertEqual(store.CacheHits, 2)
+
+        # a caller that changes a value copies it and writes it back
+        changed = copy.deepcopy(value)
+        changed['value'].append(2)
+        self.assertEqual(store['a'], {'value': [1]})
+        store['a'] = changed
+        self.assertEqual(store['a'], {'value': [1, 2]})
+        self.assertEqual(value, {'value': [1]})
+        self.assertEqual(self._database.get('a'), {'value': [1, 2]})
+
+    def test_cache_disabled(self):
+        store = JournalStore(self._database)
+        store['a'] = {'value': 1}
+        value = store['a']
+        value['value'] = 2
+        self.assertEqual(store['a'], {'value': 1})
+        self.assertEqual(store.CacheHits, 0)
@@ -0,0 +1,493 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import base64
+import hashlib
+import time
+import unittest
+
+import gossip.signed_object as SigObj
+
+from gossip import event_handler
+from gossip.node import Node
+from journal.messages import journal_transfer
+from journal.messages.journal_transfer import BlockBatchReplyMessage
+from journal.messages.journal_transfer import BlockBatchRequestMessage
+from journal.messages.journal_transfer import BlockListReplyMessage
+from journal.messages.journal_transfer import SnapshotChunkReplyMessage
+from journal.messages.journal_transfer import SnapshotChunkRequestMessage
+from journal.messages.journal_transfer import SnapshotReplyMessage
+from journal.messages.journal_transfer import SnapshotRequestMessage
+from journal.messages.journal_transfer import TransactionBatchReplyMessage
+from journal.messages.journal_transfer import TransactionBatchRequestMessage
+from journal.messages.journal_transfer import TransferFailedMessage
+from journal.messages.journal_transfer import UncommittedListReplyMessage
+from journal.protocol.journal_transfer import JournalTransfer
+
+
+class AttrDict(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _TestObject(AttrDict):
+    """A block or transaction whose message is its own contents, padded
+    to a given size.
+    """
+
+    def __init__(self, field, size=0, **kwargs):
+        super(_TestObject, self).__init__(**kwargs)
+        self._message = {'__TYPE__': 'test', field: dict(kwargs),
+                         'Padding': 'x' * size}
+
+    def build_message(self):
+        return AttrDict(dump=lambda: self._message)
+
+
+class _ReceivedObject(AttrDict):
+    """A received block or transaction, its signature is bad when it is
+    marked as forged.
+    """
+
+    def verify_signature(self):
+        return not self.get('Forged', False)
+
+
+def _create_node(port):
+    signingkey = SigObj.generate_signing_key()
+    ident = SigObj.generate_identifier(signingkey)
+    node = Node(identifier=ident, signingkey=signingkey,
+                address=("localhost", port))
+    node.is_peer = True
+    return node
+
+
+class _TestJournal(object):
+    """The parts of a journal that the transfer uses; messages are
+    recorded rather than sent.
+    """
+
+    MaximumPacketSize = 8192 * 6 - 128
+
+    def __init__(self, peers, window=16, batchsize=100):
+        self.LocalNode = _create_node(8800)
+        self.NodeMap = dict((p.Identifier, p) for p in peers)
+        self.StatDomains = {}
+        self.onHeartbeatTimer = event_handler.EventHandler('onHeartbeat')
+        self.Initializing = False
+        self.TransferWindow = window
+        self.TransferPeerCount = len(peers)
+        self.TransferBatchSize = batchsize
+        self.TransferTimeout = 10.0
+        self.SyncMode = 'full'
+        self.SnapshotSyncDepth = 2
+        self.SnapshotSyncHistory = 2
+        self.BlockStore = {}
+        self.TransactionStore = {}
+        self.MostRecentCommittedBlockID = '0' * 16
+        self.SignatureVerifier = AttrDict(
+            submit=lambda objects, callback: callback(True))
+
+        self.Handlers = {}
+        self.Sent = []
+        self.Pending = []
+        self.Committed = []
+        self.Restored = []
+
+    def peer_list(self):
+        return self.NodeMap.values()
+
+    def register_message_handler(self, msg, handler):
+        self.Handlers[msg.MessageType] = handler
+
+    def clear_message_handler(self, msg):
+        del self.Handlers[msg.MessageType]
+
+    def send_message(self, msg, nodeid):
+        msg.sign_from_node(self.LocalNode)
+        self.Sent.append((msg, nodeid))
+
+    def unpack_message(self, mtype, minfo):
+        if 'Block' in minfo:
+            return AttrDict(TransactionBlock=_ReceivedObject(minfo['Block']))
+        return AttrDict(Transaction=_ReceivedObject(minfo['Transaction']))
+
+    def add_pending_transaction(self, txn, build_block=True):
+        self.Pending.append(txn.Identifier)
+
+    def commit_transaction_block(self, blk):
+        self.Committed.append(blk.Identifier)
+
+    def restore_snapshot(self, blockids, blocks, transactions, payload):
+        self.Restored.append((blockids, [b.Identifier for b in blocks],
+                              [t.Identifier for t in transactions], payload))
+        return True
+
+    def deliver(self, msg, peer):
+        msg.sign_from_node(peer)
+        self.Handlers[msg.MessageType](msg, self)
+
+
+class TestJournalTransfer(unittest.TestCase):
+    def setUp(self):
+        self.peers = [_create_node(8801 + i) for i in range(3)]
+        self.blocks = [
+            _TestObject('Block', Identifier='block{0}'.format(i),
+                        TransactionIDs=['txn{0}'.format(i)])
+            for i in range(6)]
+        self.txns = dict(
+            ('txn{0}'.format(i),
+             _TestObject('Transaction', Identifier='txn{0}'.format(i)))
+            for i in range(6))
+        self.done = []
+
+    def _start(self, window=16, batchsize=100, syncmode='full'):
+        journal = _TestJournal(self.peers, window, batchsize)
+        journal.SyncMode = syncmode
+        transfer = JournalTransfer(journal, lambda: self.done.append(True))
+        transfer.initiate_journal_transfer()
+        return journal, transfer
+
+    def _list_blocks(self, journal, transfer):
+        request = journal.Sent[0][0]
+        reply = BlockListReplyMessage()
+        reply.InReplyTo = request.Identifier
+        reply.BlockIDs = [b.Identifier for b in self.blocks]
+        journal.deliver(reply, transfer.Peer)
+
+        reply = BlockListReplyMessage()
+        reply.InReplyTo = journal.Sent[-1][0].Identifier
+        reply.BlockListIndex = len(self.blocks)
+        journal.deliver(reply, transfer.Peer)
+
+        reply = UncommittedListReplyMessage()
+        reply.InReplyTo = journal.Sent[-1][0].Identifier
+        journal.deliver(reply, transfer.Peer)
+
+    def _requests(self, journal):
+        return [(m, p) for (m, p) in journal.Sent
+                if m.MessageType in (BlockBatchRequestMessage.MessageType,
+                                     TransactionBatchRequestMessage
+                                     .MessageType)]
+
+    def _answer(self, journal, request, peerid, count=None, txns=True,
+                missing=()):
+        """Answer a batch request with its first count objects, naming the
+        rest as remaining.
+        """
+        if request.MessageType == BlockBatchRequestMessage.MessageType:
+            objids = request.BlockIDs
+            reply = BlockBatchReplyMessage()
+        else:
+            objids = request.TransactionIDs
+            reply = TransactionBatchReplyMessage()
+        if count is None:
+            count = len(objids)
+
+        for objid in objids[:count]:
+            if objid in missing:
+                reply.MissingIDs.append(objid)
+            elif objid in self.txns:
+                reply.TransactionMessages.append(
+                    self.txns[objid].build_message().dump())
+            else:
+                block = [b for b in self.blocks if b.Identifier == objid][0]
+                reply.TransactionBlockMessages.append(
+                    block.build_message().dump())
+                if txns:
+                    reply.TransactionMessages.extend(
+                        self.txns[t].build_message().dump()
+                        for t in block.TransactionIDs)
+        reply.RemainingIDs = objids[count:]
+        reply.InReplyTo = request.Identifier
+        journal.deliver(reply, journal.NodeMap[peerid])
+
+    def _answer_all(self, journal, start=0, **kwargs):
+        while not self.done:
+            pending = self._requests(journal)[start:]
+            self.assertTrue(len(pending) > 0)
+            start += 1
+            (request, peerid) = pending[0]
+            self._answer(journal, request, peerid, **kwargs)
+
+    def test_window_is_spread_over_peers(self):
+        (journal, transfer) = self._start(window=3, batchsize=2)
+        self._list_blocks(journal, transfer)
+
+        requests = self._requests(journal)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(len(set(p for (_, p) in requests)), 3)
+        self.assertEqual(requests[0][0].BlockIDs, ['block0', 'block1'])
+
+        # answer the requests out of order, leaving the transactions to be
+        # fetched separately
+        for (request, peerid) in reversed(requests):
+            self._answer(journal, request, peerid, txns=False)
+        requests = self._requests(journal)[3:]
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[0][0].TransactionIDs, ['txn4', 'txn5'])
+        self._answer_all(journal, 3)
+
+        self.assertEqual(journal.Committed,
+                         [b.Identifier for b in self.blocks])
+        self.assertEqual(journal.Pending,
+                         ['txn{0}'.format(i) for i in range(6)])
+        stats = journal.StatDomains['ledgertransfer']
+        self.assertEqual(stats.BlocksReceived.Value, 6)
+        self.assertEqual(stats.TransactionsReceived.Value, 6)
+        self.assertEqual(journal.Handlers, {})
+
+    def test_blocks_include_transactions(self):
+        (journal, transfer) = self._start()
+        self._list_blocks(journal, transfer)
+
+        requests = self._requests(journal)
+        self.assertEqual(len(requests), 1)
+        (request, peerid) = requests[0]
+        self._answer(journal, request, peerid)
+
+        self.assertEqual(self.done, [True])
+        self.assertEqual(len(journal.Sent), 4)
+        self.assertEqual(journal.Pending,
+                         ['txn{0}'.format(i) for i in range(6)])
+
+    def test_bad_signatures_are_not_committed(self):
+        self.blocks[3] = _TestObject('Block', Identifier='block3',
+                                     TransactionIDs=['txn3'], Forged=True)
+        self.txns['txn1'] = _TestObject('Transaction', Identifier='txn1',
+                                        Forged=True)
+        (journal, transfer) = self._start()
+        journal.SignatureVerifier = AttrDict(
+            submit=lambda objects, callback: callback(False))
+        self._list_blocks(journal, transfer)
+        self._answer_all(journal)
+
+        # the chain stops before the forged block
+        self.assertEqual(self.done, [True])
+        self.assertEqual(journal.Committed, ['block0', 'block1', 'block2'])
+        self.assertEqual(journal.Pending, ['txn0', 'txn2'])
+
+    def test_remaining_objects_are_requested_again(self):
+        (journal, transfer) = self._start()
+        self._list_blocks(journal, transfer)
+
+        (request, peerid) = self._requests(journal)[0]
+        self._answer(journal, request, peerid, count=2)
+        (request, peerid) = self._requests(journal)[1]
+        self.assertEqual(request.BlockIDs,
+                         ['block{0}'.format(i) for i in range(2, 6)])
+        self._answer_all(journal, 1)
+        self.assertEqual(journal.Committed,
+                         [b.Identifier for b in self.blocks])
+        self.assertEqual(
+            journal.StatDomains['ledgertransfer'].RequestsRetried.Value, 0)
+
+    def test_missing_objects_are_requested_elsewhere(self):
+        (journal, transfer) = self._start()
+        self._list_blocks(journal, transfer)
+
+        (request, peerid) = self._requests(journal)[0]
+        self._answer(journal, request, peerid, missing=['block3'])
+        (retry, retrypeer) = self._requests(journal)[1]
+        self.assertEqual(retry.BlockIDs, ['block3'])
+        self.assertNotEqual(retrypeer, peerid)
+        self._answer(journal, retry, retrypeer)
+        self.assertEqual(self.done, [True])
+
+    def test_slow_peer_is_retried_elsewhere(self):
+        (journal, transfer) = self._start(window=1, batchsize=1)
+        self._list_blocks(journal, transfer)
+
+        (request, peerid) = self._requests(journal)[0]
+        journal.onHeartbeatTimer.fire(time.time() + 11.0)
+
+        (retry, retrypeer) = self._requests(journal)[1]
+        self.assertEqual(retry.BlockIDs, request.BlockIDs)
+        self.assertNotEqual(retrypeer, peerid)
+
+        # the late reply from the slow peer is still accepted and the
+        # reply to the retry is ignored
+        self._answer(journal, request, peerid)
+        self._answer(journal, retry, retrypeer)
+        stats = journal.StatDomains['ledgertransfer']
+        self.assertEqual(stats.BlocksReceived.Value, 1)
+        self.assertEqual(stats.RequestsRetried.Value, 1)
+
+    def test_failed_peer_is_dropped(self):
+        (journal, transfer) = self._start(window=6, batchsize=1)
+        self._list_blocks(journal, transfer)
+
+        failed = [p for p in self.peers if p is not transfer.Peer][0]
+        count = len([r for r in self._requests(journal)
+                     if r[1] == failed.Identifier])
+        journal.deliver(TransferFailedMessage(), failed)
+
+        self.assertNotIn(failed, transfer.Peers)
+        retries = self._requests(journal)[6:]
+        self.assertEqual(len(retries), count)
+        self.assertNotIn(failed.Identifier, [p for (_, p) in retries])
+
+    def test_snapshot_sync(self):
+        (journal, transfer) = self._start(syncmode='snapshot')
+        reply = BlockListReplyMessage()
+        reply.InReplyTo = journal.Sent[0][0].Identifier
+        reply.BlockIDs = [b.Identifier for b in self.blocks]
+        journal.deliver(reply, transfer.Peer)
+        reply = BlockListReplyMessage()
+        reply.InReplyTo = journal.Sent[-1][0].Identifier
+        reply.BlockListIndex = len(self.blocks)
+        journal.deliver(reply, transfer.Peer)
+
+        # nothing is fetched until the snapshot block is known
+        request = journal.Sent[-1][0]
+        self.assertEqual(request.MessageType,
+                         SnapshotRequestMessage.MessageType)
+        self.assertEqual(request.Depth, 2)
+        self.assertEqual(self._requests(journal), [])
+
+        chunks = ['state-one', 'state-two', 'state-six']
+        hashes = [hashlib.sha256(c).hexdigest() for c in chunks]
+        reply = SnapshotReplyMessage()
+        reply.InReplyTo = request.Identifier
+        reply.BlockID = 'block3'
+        reply.BlockListIndex = 3
+        reply.ChunkSize = 9
+        reply.ChunkHashes = hashes
+        count = len(journal.Sent)
+        journal.deliver(reply, transfer.Peer)
+
+        reply = UncommittedListReplyMessage()
+        reply.InReplyTo = journal.Sent[count][0].Identifier
+        journal.deliver(reply, transfer.Peer)
+
+        (request, peerid) = self._requests(journal)[0]
+        self.assertEqual(request.BlockIDs,
+                         ['block{0}'.format(i) for i in range(2, 6)])
+        self._answer(journal, request, peerid)
+
+        # a damaged chunk is asked of another peer with the remaining ones
+        (request, peerid) = [(m, p) for (m, p) in journal.Sent
+                             if m.MessageType ==
+                             SnapshotChunkRequestMessage.MessageType][0]
+        self.assertEqual(request.ChunkHashes, hashes)
+        reply = SnapshotChunkReplyMessage()
+        reply.InReplyTo = request.Identifier
+        reply.Chunks = [base64.b64encode(chunks[0]), base64.b64encode('x')]
+        reply.RemainingIDs = hashes[2:]
+        journal.deliver(reply, journal.NodeMap[peerid])
+
+        (retry, retrypeer) = [(m, p) for (m, p) in journal.Sent
+                              if m.MessageType ==
+                              SnapshotChunkRequestMessage.MessageType][1]
+        self.assertEqual(retry.ChunkHashes, hashes[1:])
+        self.assertNotEqual(retrypeer, peerid)
+        reply = SnapshotChunkReplyMessage()
+        reply.InReplyTo = retry.Identifier
+        reply.Chunks = [base64.b64encode(c) for c in chunks[1:]]
+        journal.deliver(reply, journal.NodeMap[retrypeer])
+
+        self.assertEqual(self.done, [True])
+        self.assertEqual(journal.Restored,
+                         [(['block{0}'.format(i) for i in range(4)],
+                           ['block2', 'block3'], ['txn2', 'txn3'],
+                           ''.join(chunks))])
+        self.assertEqual(journal.Committed, ['block4', 'block5'])
+        self.assertEqual(journal.Pending, ['txn4', 'txn5'])
+        self.assertEqual(
+            journal.StatDomains['ledgertransfer'].ChunksReceived.Value, 3)
+
+
+class TestBatchRequestHandlers(unittest.TestCase):
+    def setUp(self):
+        self.peer = _create_node(8801)
+        self.journal = _TestJournal([self.peer])
+        self.journal.MaximumPacketSize = journal_transfer.BatchReserve + 2000
+
+        for i in range(4):
+            block = _TestObject('Block', size=400,
+                                Identifier='block{0}'.format(i),
+                                TransactionIDs=['txn{0}'.format(i)])
+            self.journal.BlockStore[block.Identifier] = block
+            txn = _TestObject('Transaction', size=100,
+                              Identifier='txn{0}'.format(i))
+            self.journal.TransactionStore[txn.Identifier] = txn
+
+    def _request(self, request, handler):
+        request.sign_from_node(self.peer)
+        handler(request, self.journal)
+        (reply, peerid) = self.journal.Sent[-1]
+        self.assertEqual(peerid, self.peer.Identifier)
+        self.assertEqual(reply.InReplyTo, request.Identifier)
+        return reply
+
+    def test_block_batch_fills_packet(self):
+        request = BlockBatchRequestMessage()
+        request.BlockIDs = ['block0', 'unknown', 'block1', 'block2',
+                            'block3']
+        reply = self._request(request,
+                              journal_transfer._blockbatchrequesthandler)
+
+        self.assertEqual(len(reply.TransactionBlockMessages), 3)
+        self.assertEqual(len(reply.TransactionMessages), 3)
+        self.assertEqual(reply.MissingIDs, ['unknown'])
+        self.assertEqual(reply.RemainingIDs, ['block3'])
+        self.assertTrue(len(reply) <= self.journal.MaximumPacketSize)
+
+    def test_block_batch_by_height(self):
+        self.journal.committed_block_ids_by_height = \
+            lambda height, count: ['block{0}'.format(i)
+                                   for i in range(height, height + count)]
+        request = BlockBatchRequestMessage()
+        request.BlockListIndex = 2
+        request.BlockCount = 2
+        request.IncludeTransactions = False
+        reply = self._request(request,
+                              journal_transfer._blockbatchrequesthandler)
+
+        self.assertEqual([b['Block']['Identifier']
+                          for b in reply.TransactionBlockMessages],
+                         ['block2', 'block3'])
+        self.assertEqual(reply.TransactionMessages, [])
+
+    def test_transaction_batch(self):
+        self.journal.MaximumPacketSize = journal_transfer.BatchReserve + 400
+        request = TransactionBatchRequestMessage()
+        request.TransactionIDs = ['txn{0}'.format(i) for i in range(4)] + \
+            ['unknown']
+        reply = self._request(request,
+                              journal_transfer._txnbatchrequesthandler)
+
+        self.assertEqual(len(reply.TransactionMessages), 2)
+        self.assertEqual(reply.MissingIDs, [])
+        self.assertEqual(reply.RemainingIDs, ['txn2', 'txn3', 'unknown'])
+
+    def test_snapshot_chunks(self):
+        chunks = dict((hashlib.sha256(c).hexdigest(), c)
+                      for c in ['a' * 900, 'b' * 900, 'c' * 900])
+        hashes = sorted(chunks)
+        self.journal.GlobalStoreMap = AttrDict(
+            export_snapshot=lambda blockid, size: (hashes, chunks))
+
+        request = SnapshotChunkRequestMessage()
+        request.BlockID = 'block3'
+        request.ChunkSize = 900
+        request.ChunkHashes = [hashes[0], 'unknown'] + hashes[1:]
+        reply = self._request(request,
+                              journal_transfer._snapshotchunkrequesthandler)
+
+        self.assertEqual([base64.b64decode(c) for c in reply.Chunks],
+                         [chunks[hashes[0]]])
+        self.assertEqual(reply.MissingIDs, ['unknown'])
+        self.assertEqual(reply.RemainingIDs, hashes[1:])
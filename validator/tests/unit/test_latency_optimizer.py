@@ -0,0 +1,158 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import unittest
+
+import gossip.signed_object as SigObj
+from gossip.messages import connect_message
+from gossip.messages.connect_message import DisconnectRequestMessage
+from gossip.messages.connect_message import PruneRequestMessage
+from gossip.messages.connect_message import prune_request_handler
+from gossip.messages.random_walk_message import RandomWalkMessage
+from gossip.node import Node
+from gossip.topology import latency_optimizer
+
+
+class _TestGossiper(object):
+    def __init__(self, peers):
+        self.LocalNode = _create_node()
+        self.peers = peers
+        self.sent = []
+
+    def peer_list(self, exceptions=None):
+        return [p for p in self.peers
+                if p.Identifier not in (exceptions or [])]
+
+    def peer_id_list(self):
+        return [p.Identifier for p in self.peers]
+
+    def send_message(self, msg, peerid):
+        self.sent.append((msg, peerid))
+
+
+def _create_node(rtt=None):
+    signingkey = SigObj.generate_signing_key()
+    ident = SigObj.generate_identifier(signingkey)
+    node = Node(identifier=ident, signingkey=signingkey,
+                address=("localhost", 8800))
+    if rtt is not None:
+        node.Estimator.update(rtt)
+    return node
+
+
+class TestLatencyOptimizer(unittest.TestCase):
+    def test_peer_cost(self):
+        node = _create_node()
+        self.assertIsNone(latency_optimizer.peer_cost(node))
+
+        node.Estimator.update(0.2)
+        cost = latency_optimizer.peer_cost(node)
+        self.assertGreater(cost, 0.1)
+        node.message_dropped(_message(node))
+        self.assertIsNone(latency_optimizer.peer_cost(node))
+
+    def _update(self, count, randompeers=None, pruned=None):
+        peers = [_create_node(0.01 * (i + 1)) for i in range(count)]
+        gossiper = _TestGossiper(peers)
+        if randompeers is None:
+            randompeers = set()
+        if pruned is None:
+            pruned = set()
+        latency_optimizer.update_connections(gossiper, randompeers, pruned)
+        return (gossiper, peers)
+
+    def test_probe_below_minimum(self):
+        # every missing peer is probed for at once
+        (gossiper, _) = self._update(1)
+        self.assertEqual(len(gossiper.sent),
+                         latency_optimizer.TargetConnectivity - 1)
+        for (msg, _) in gossiper.sent:
+            self.assertIsInstance(msg, RandomWalkMessage)
+
+    def test_probe_below_target(self):
+        (gossiper, _) = self._update(latency_optimizer.MinimumConnectivity)
+        self.assertEqual(len(gossiper.sent), 1)
+        self.assertIsInstance(gossiper.sent[0][0], RandomWalkMessage)
+
+        # a node at the target neither probes nor prunes
+        (gossiper, _) = self._update(latency_optimizer.TargetConnectivity)
+        self.assertEqual(gossiper.sent, [])
+
+    def test_prune_above_target(self):
+        count = latency_optimizer.TargetConnectivity + 1
+        randompeers = set()
+        (gossiper, peers) = self._update(count, randompeers)
+        self.assertEqual(len(randompeers),
+                         latency_optimizer.RandomConnectivity)
+        self.assertEqual(len(gossiper.sent), 1)
+        (msg, peerid) = gossiper.sent[0]
+        self.assertIsInstance(msg, PruneRequestMessage)
+        self.assertNotIn(peerid, randompeers)
+
+    def test_prune_costliest_once(self):
+        count = latency_optimizer.TargetConnectivity + 1
+        peers = [_create_node(0.01 * (i + 1)) for i in range(count)]
+        slowest = peers[-1]
+        gossiper = _TestGossiper(peers)
+
+        randompeers = set(p.Identifier for p in peers[:2])
+        pruned = set()
+        latency_optimizer.update_connections(gossiper, randompeers, pruned)
+        self.assertEqual(gossiper.sent[-1][1], slowest.Identifier)
+
+        # the peer is still connected a round later, so it refused and is
+        # not asked again
+        latency_optimizer.update_connections(gossiper, randompeers, pruned)
+        self.assertEqual(gossiper.sent[-1][1], peers[-2].Identifier)
+
+        # a peer that went away is forgotten
+        gossiper.peers.remove(slowest)
+        latency_optimizer.update_connections(gossiper, randompeers, pruned)
+        self.assertNotIn(slowest.Identifier, pruned)
+
+
+class TestPruneRequest(unittest.TestCase):
+    def _request(self, count):
+        requester = _create_node()
+        gossiper = _TestGossiper([_create_node() for _ in range(count)])
+        gossiper.peers.append(requester)
+        gossiper.NodeMap = dict((p.Identifier, p) for p in gossiper.peers)
+        for peer in gossiper.peers:
+            peer.is_peer = True
+
+        msg = PruneRequestMessage()
+        msg.sign_from_node(requester)
+        prune_request_handler(msg, gossiper)
+        return (gossiper, requester)
+
+    def test_refuse_with_few_peers(self):
+        (gossiper, requester) = self._request(
+            connect_message.MinimumPruneConnectivity)
+        self.assertEqual(gossiper.sent, [])
+        self.assertTrue(requester.is_peer)
+
+    def test_accept(self):
+        (gossiper, requester) = self._request(
+            connect_message.MinimumPruneConnectivity + 1)
+        (msg, peerid) = gossiper.sent[0]
+        self.assertIsInstance(msg, DisconnectRequestMessage)
+        self.assertEqual(peerid, requester.Identifier)
+        self.assertFalse(requester.is_peer)
+
+
+def _message(node):
+    msg = RandomWalkMessage()
+    msg.sign_from_node(node)
+    return msg
@@ -16,9 +16,11 @@
 import unittest
 import time
 
-from gossip.message import Packet, Message, unpack_message_data
+from gossip.message import Packet, PacketBundle, PacketFragment, Message
+from gossip.message import unpack_message_data
 from gossip.node import Node
 from gossip.common import dict2cbor
+from gossip.signed_object import generate_signing_key
 
 
 class TestPacket(unittest.TestCase):
@@ -80,6 +82,31 @@ class TestPacket(unittest.TestCase):
         self.assertEquals(pak.Message, msg)
         self.assertEquals(pak.Data, repr(msg))
 
+    def test_add_message_changed_after_signing(self):
+        # A field changed in place after signing is not sent, the packet
+        # carries the message as it was signed so that it still verifies
+        srcNode = Node(identifier="source", signingkey=generate_signing_key())
+        desNode = Node(identifier="destination", signingkey="destination")
+        msg = _TaggedMessage({'Tags': ["a"]})
+        msg.sign_from_node(srcNode)
+        msg.Tags.append("b")
+        msg.Labels['key'] = "value"
+
+        pak = Packet()
+        pak.add_message(msg, srcNode, desNode, 1)
+        received = _TaggedMessage(unpack_message_data(pak.Data))
+        self.assertEquals(received.Tags, ["a"])
+        self.assertEquals(received.Labels, {})
+        self.assertTrue(received.verify_signature(msg.OriginatorID))
+
+        # signing again picks up the changes
+        msg.sign_from_node(srcNode)
+        pak.add_message(msg, srcNode, desNode, 2)
+        received = _TaggedMessage(unpack_message_data(pak.Data))
+        self.assertEquals(received.Tags, ["a", "b"])
+        self.assertEquals(received.Labels, {'key': "value"})
+        self.assertTrue(received.verify_signature(msg.OriginatorID))
+
     def test_pack_unpack(self):
         # Test packing a paket and a packed packet can be unpacked correctly
         pak = Packet()
@@ -101,6 +128,81 @@ class TestPacket(unittest.TestCase):
         self.assertEquals(original, new)
         self.assertEquals("test the pack", pak.Data)
 
+    def test_bundle_pack_unpack(self):
+        # Test that a bundle keeps its acks and packets in order
+        bundle = PacketBundle('sender')
+        packets = []
+        for seqno in range(3):
+            pak = Packet()
+            pak.SequenceNumber = seqno
+            pak.Data = "packet {0}".format(seqno)
+            packets.append(pak.pack())
+        self.assertTrue(bundle.fits(packets[0], len(bundle) + 100))
+        self.assertFalse(bundle.fits(packets[0], len(bundle) + 10))
+        bundle.add_ack(17)
+        bundle.add_ack(18)
+        for data in packets:
+            bundle.add_packet(data)
+
+        packed = bundle.pack()
+        self.assertEquals(len(packed), len(bundle))
+        self.assertTrue(PacketBundle.is_bundle(packed))
+        self.assertFalse(PacketBundle.is_bundle(packets[0]))
+
+        newbundle = PacketBundle()
+        newbundle.unpack(packed)
+        self.assertEquals(newbundle.SenderID, 'sender')
+        self.assertEquals(newbundle.Acks, [17, 18])
+        self.assertEquals(newbundle.Packets, packets)
+        pak = Packet()
+        pak.unpack(newbundle.Packets[2])
+        self.assertEquals(pak.Data, "packet 2")
+
+        # a truncated bundle is not unpacked
+        with self.assertRaises(ValueError):
+            newbundle.unpack(packed[:-1])
+
+    def test_fragment_split(self):
+        # Test splitting a packet and packing and unpacking a fragment
+        pak = Packet()
+        pak.SequenceNumber = 12
+        pak.IsReliable = False
+        data = "x" * 250
+        fragments = PacketFragment.split(pak, data, 150)
+        self.assertEquals(len(fragments), 3)
+        self.assertEquals(''.join(f.Data for f in fragments), data)
+        for fragment in fragments:
+            self.assertLessEqual(len(fragment.pack()), 150)
+
+        fragment = fragments[2]
+        fragment.SequenceNumber = 15
+        packed = fragment.pack()
+        self.assertTrue(PacketFragment.is_fragment(packed))
+        self.assertFalse(PacketFragment.is_fragment(pak.pack()))
+
+        newfragment = PacketFragment()
+        newfragment.unpack(packed)
+        self.assertEquals([newfragment.SequenceNumber, newfragment.PacketID,
+                           newfragment.Index, newfragment.Count,
+                           newfragment.IsReliable, newfragment.Data],
+                          [15, 12, 2, 3, False, fragment.Data])
+        self.assertEquals(newfragment.create_ack('me').SequenceNumber, 15)
+
+
+class _TaggedMessage(Message):
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(_TaggedMessage, self).__init__(minfo)
+        self.Tags = list(minfo.get('Tags', []))
+        self.Labels = dict(minfo.get('Labels', {}))
+
+    def dump(self):
+        result = super(_TaggedMessage, self).dump()
+        result['Tags'] = list(self.Tags)
+        result['Labels'] = dict(self.Labels)
+        return result
+
 
 class TestMessage(unittest.TestCase):
 
@@ -141,8 +243,8 @@ class TestMessage(unittest.TestCase):
         # Test the overridden repr function
         # First case to test is when the msg has no data, creates data
         msg = Message({'__SIGNATURE__': "Test"})
-        serMsg = msg.serialize()
         self.assertIsNone(msg._data)
+        serMsg = msg.serialize()
         self.assertEquals(repr(msg), serMsg)
         self.assertEquals(msg._data, serMsg)
         # Second case is when the msg contains data
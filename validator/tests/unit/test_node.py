@@ -149,6 +149,8 @@ class TestNode(unittest.TestCase):
                          node.MessageQ.Messages)
         # No messages left, should return None
         self.assertEquals(node.get_next_message(now + 5), None)
+        # Each sent message is counted in the queue delay histogram
+        self.assertEquals(sum(node.QueueDelay.get_metric()), 3)
 
     def test_node_message_delivered(self):
         # Test behavior if message is "delivered"
@@ -175,6 +177,18 @@ class TestNode(unittest.TestCase):
         self.assertLess(oldRTO, newRTO)
         self.assertIn(msg.Identifier, node.MessageQ.Messages)
 
+    def test_node_send_rate(self):
+        # Test that drops cut the send rate reported in the peer stats
+        node = self._create_node()
+        node.initialize_stats(self._create_node())
+        rate = node.TokenBucket.DripRate
+        msg = Message()
+        msg.sign_from_node(node)
+        node.message_dropped(msg)
+        self.assertLess(node.TokenBucket.DripRate, rate)
+        self.assertEqual(node.Stats.get_stats(['SendRate'])['SendRate'],
+                         node.TokenBucket.DripRate)
+
     def test_node_ticks(self):
         # Test bump_ticks and reset_ticks
         node = self._create_node()
@@ -306,3 +306,120 @@ class TestHeterogeneousStore(unittest.TestCase):
         for c, val in zip(self.index2s, self.obj_type2_values):
             self.assertEqual(objectstore.lookup('type2:index2', c),
                              val, "Can look up any other type2:index2")
+
+
+class TestObjectStoreReadOnlyViews(unittest.TestCase):
+    def setUp(self):
+        self.store = ObjectStore(indexes=['type1:name'])
+        self.store.set('obj1', {'object-type': 'type1', 'name': 'one',
+                                'tags': ['a', 'b'], 'info': {'size': 1}})
+        self.store.set('obj2', {'object-type': 'type2', 'name': 'two',
+                                'tags': ['c']})
+        self.store.commit()
+
+    def test_readonly_get(self):
+        view = self.store.get('obj1', readonly=True)
+        self.assertEqual(view['name'], 'one')
+        self.assertEqual(view['tags'], ['a', 'b'])
+        self.assertEqual(view['info']['size'], 1)
+        with self.assertRaises(TypeError):
+            view['name'] = 'changed'
+        with self.assertRaises(TypeError):
+            view['tags'][0] = 'c'
+        self.assertRaises(KeyError, self.store.get, 'obj2', 'type1', True)
+
+        obj = view.thaw()
+        obj['info']['size'] = 2
+        self.assertEqual(self.store.get('obj1')['info']['size'], 1)
+
+    def test_readonly_iteration(self):
+        clone = self.store.clone_store()
+        clone.set('obj3', {'object-type': 'type1', 'name': 'three'})
+        clone.delete('obj2')
+
+        items = dict(clone.iteritems(readonly=True))
+        self.assertEqual(sorted(items.keys()), ['obj1', 'obj3'])
+        self.assertEqual(items['obj3'], {'object-type': 'type1',
+                                         'name': 'three'})
+
+        objects = clone.get_all_by_object_type('type1')
+        for obj in objects:
+            obj['name'] = 'changed'
+        self.assertEqual(clone.lookup('type1:name', 'one')['name'], 'one')
+        self.assertEqual(
+            len(clone.get_all_by_object_type('type1', readonly=True)), 2)
+
+    def test_set_from_view(self):
+        clone = self.store.clone_store()
+        obj = clone.get('obj2', readonly=True)
+        clone.set('obj4', obj)
+        self.assertIsInstance(clone.get('obj4'), dict)
+        self.assertIsInstance(clone.get('obj4')['tags'], list)
+        self.assertEqual(clone.get('obj4')['tags'], ['c'])
+
+
+class DeclaredIndexStore(ObjectStore):
+    Indexes = ['type1:name']
+
+    def clone_store(self, storeinfo=None, readonly=False):
+        return DeclaredIndexStore(self, storeinfo, readonly,
+                                  clone_indexes=self._indexes)
+
+
+class TestObjectStoreSharedIndexes(unittest.TestCase):
+    def test_clone_shares_indexes(self):
+        root = DeclaredIndexStore()
+        root.set('obj1', {'object-type': 'type1', 'name': 'one'})
+        root.commit()
+
+        clone = root.clone_store()
+        clone.set('obj2', {'object-type': 'type1', 'name': 'two'})
+        clone.set('obj1', {'object-type': 'type1', 'name': 'uno'})
+
+        self.assertEqual(clone.lookup('type1:name', 'two')['name'], 'two')
+        self.assertEqual(clone.lookup('type1:name', 'uno')['name'], 'uno')
+        self.assertRaises(KeyError, clone.lookup, 'type1:name', 'one')
+
+        self.assertEqual(root.lookup('type1:name', 'one')['name'], 'one')
+        self.assertRaises(KeyError, root.lookup, 'type1:name', 'two')
+        self.assertRaises(UniqueConstraintError, clone.set, 'obj3',
+                          {'object-type': 'type1', 'name': 'two'})
+
+    def test_declared_index_not_enforced(self):
+        # a declared index only enforces uniqueness once lookup uses it
+        root = DeclaredIndexStore()
+        root.set('obj1', {'object-type': 'type1', 'name': 'one'})
+        root.set('obj2', {'object-type': 'type1', 'name': 'one'})
+        root.commit()
+
+        clone = root.clone_store()
+        clone.set('obj3', {'object-type': 'type1', 'name': 'one'})
+        self.assertEqual(clone.lookup('type1:name', 'one')['name'], 'one')
+        self.assertRaises(UniqueConstraintError, clone.set, 'obj4',
+                          {'object-type': 'type1', 'name': 'one'})
+
+        # as before, a checkpoint starts over
+        clone.commit()
+        clone.clone_store().set('obj4', {'object-type': 'type1',
+                                         'name': 'one'})
+
+    def test_restored_clone_updates_indexes(self):
+        root = DeclaredIndexStore()
+        root.set('obj1', {'object-type': 'type1', 'name': 'one'})
+        root.set('obj2', {'object-type': 'type1', 'name': 'two'})
+        root.commit()
+
+        storeinfo = {'Store': {'obj3': {'object-type': 'type1',
+                                        'name': 'three'}},
+                     'DeletedKeys': ['obj1']}
+        clone = root.clone_store(storeinfo, True)
+
+        self.assertEqual(clone.lookup('type1:name', 'three')['name'],
+                         'three')
+        self.assertEqual(clone.lookup('type1:name', 'two')['name'], 'two')
+        self.assertRaises(KeyError, clone.lookup, 'type1:name', 'one')
+
+        restored = DeclaredIndexStore(storeinfo={
+            'Store': clone.compose(), 'DeletedKeys': []})
+        self.assertEqual(restored.lookup('type1:name', 'three')['name'],
+                         'three')
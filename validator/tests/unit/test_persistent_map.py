@@ -0,0 +1,80 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import random
+import unittest
+
+from journal.persistent_map import PersistentMap
+
+
+class CollidingKey(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class TestPersistentMap(unittest.TestCase):
+    def test_matches_dict(self):
+        expected = {}
+        pmap = PersistentMap()
+        rand = random.Random(7)
+        for i in xrange(5000):
+            key = 'key{0}'.format(rand.randint(0, 2000))
+            if key in expected and rand.random() < 0.3:
+                del expected[key]
+                pmap = pmap.delete(key)
+            else:
+                expected[key] = i
+                pmap = pmap.set(key, i)
+
+        self.assertEqual(len(pmap), len(expected))
+        self.assertEqual(dict(pmap.iteritems()), expected)
+        for key, value in expected.iteritems():
+            self.assertEqual(pmap[key], value)
+        self.assertNotIn('missing', pmap)
+        self.assertRaises(KeyError, pmap.delete, 'missing')
+
+    def test_versions_are_independent(self):
+        base = PersistentMap().set('a', 1).set('b', 2)
+        updated = base.set('a', 3).delete('b').set('c', 4)
+
+        self.assertEqual(dict(base.iteritems()), {'a': 1, 'b': 2})
+        self.assertEqual(dict(updated.iteritems()), {'a': 3, 'c': 4})
+        self.assertEqual(len(base), 2)
+        self.assertEqual(len(updated), 2)
+
+    def test_hash_collisions(self):
+        keys = [CollidingKey(n) for n in 'abc']
+        pmap = PersistentMap().set('x', 0)
+        for i, key in enumerate(keys):
+            pmap = pmap.set(key, i)
+        pmap = pmap.set(keys[1], 10)
+
+        self.assertEqual(len(pmap), 4)
+        self.assertEqual(pmap[CollidingKey('b')], 10)
+
+        pmap = pmap.delete(keys[0]).delete(keys[2])
+        self.assertEqual(dict(pmap.iteritems()), {'x': 0, keys[1]: 10})
+        pmap = pmap.delete(keys[1])
+        self.assertNotIn(keys[1], pmap)
+        self.assertEqual(pmap['x'], 0)
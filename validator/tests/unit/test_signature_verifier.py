@@ -0,0 +1,96 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import time
+import unittest
+
+import gossip.signed_object as SigObj
+
+from gossip.message import Message
+from gossip.signature_verifier import SignatureVerifier
+from gossip.signed_object import LruCache
+from gossip.signed_object import SignedObject
+
+
+class TestSignatureVerifier(unittest.TestCase):
+    def setUp(self):
+        self._cache = SignedObject.signature_cache
+        self.signingkey = SigObj.generate_signing_key()
+        self.address = SigObj.generate_identifier(self.signingkey)
+        self.results = []
+
+    def tearDown(self):
+        SignedObject.signature_cache = self._cache
+
+    def _received(self, count):
+        """Returns messages as they would be decoded from the wire, with
+        signers that are not in the cache.
+        """
+        messages = []
+        for i in range(count):
+            msg = Message({'Index': i})
+            msg.sign_object(self.signingkey)
+            messages.append(Message(msg.dump()))
+        SignedObject.signature_cache = LruCache()
+        return messages
+
+    def _callback(self, index):
+        return lambda valid: self.results.append((index, valid))
+
+    def test_inline_verification(self):
+        verifier = SignatureVerifier('test')
+        (good, altered) = self._received(2)
+        altered.Nonce += 1
+        bad = Message({'__SIGNATURE__': 'test'})
+
+        verifier.submit([good], self._callback(0))
+        verifier.submit([altered, bad], self._callback(1))
+        verifier.submit([Message()], self._callback(2))
+        self.assertEqual(self.results, [(0, True), (1, False), (2, False)])
+        self.assertEqual(good.OriginatorID, self.address)
+
+        # a key is recovered from an altered message, but not the signer's
+        self.assertNotEqual(altered.OriginatorID, self.address)
+
+        # the second message is decoded again, its signer is now cached
+        verifier.submit([Message(good.dump())], self._callback(3))
+        self.assertEqual(self.results[-1], (3, True))
+        stats = verifier.VerifierStats
+        self.assertEqual(stats.SignatureCacheHits.Value, 1)
+        self.assertEqual(stats.InvalidSignatures.Value, 2)
+
+    def test_pool_preserves_order(self):
+        verifier = SignatureVerifier('test', workers=2, batchsize=3)
+        try:
+            messages = self._received(5)
+            for (index, msg) in enumerate(messages):
+                verifier.submit([msg], self._callback(index))
+
+            # the first three filled a batch, the rest wait for a flush
+            self.assertEqual(verifier.Backlog, 5)
+            verifier.flush()
+
+            timeout = time.time() + 10.0
+            while verifier.Backlog and time.time() < timeout:
+                time.sleep(0.01)
+                verifier.drain()
+
+            self.assertEqual(self.results, [(i, True) for i in range(5)])
+            self.assertEqual([m.OriginatorID for m in messages],
+                             [self.address] * 5)
+            self.assertEqual(
+                verifier.VerifierStats.BatchesSent.Value, 2)
+        finally:
+            verifier.close()
@@ -13,12 +13,16 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import os
+import shutil
+import tempfile
 import unittest
 import pybitcointools
 
 import gossip.signed_object as SigObj
 
 from gossip.common import cbor2dict
+from gossip.signed_object import LruCache
 from gossip.signed_object import SignedObject
 from gossip.node import Node
 
@@ -126,3 +130,77 @@ class TestSignedObject(unittest.TestCase):
         # check that the unserilized serilized dictinary is the same
         # as before serilazation
         self.assertEquals(cbor2dict(cbor), temp.dump())
+
+    def test_serialize_cached(self):
+        # Test that the serialized forms are reused until a field changes
+        signkey = SigObj.generate_signing_key()
+        temp = _NamedObject({'Name': "test", 'Tags': ["a"]})
+        temp.sign_object(signkey)
+        cbor = temp.serialize()
+        self.assertIs(temp.serialize(), cbor)
+        self.assertIs(temp.serialize(signable=True),
+                      temp.serialize(signable=True))
+        self.assertTrue(temp.is_valid("unused"))
+
+        # assigning a public attribute discards the cached forms
+        temp.Name = "renamed"
+        self.assertEquals(cbor2dict(temp.serialize())['Name'], "renamed")
+
+        # a field changed in place is only picked up after invalidate
+        cbor = temp.serialize()
+        temp.Tags.append("b")
+        self.assertIs(temp.serialize(), cbor)
+        temp.invalidate()
+        self.assertEquals(cbor2dict(temp.serialize())['Tags'], ["a", "b"])
+
+
+class _NamedObject(SignedObject):
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(_NamedObject, self).__init__(minfo)
+        self.Name = minfo.get('Name')
+        self.Tags = list(minfo.get('Tags', []))
+
+    def dump(self):
+        result = super(_NamedObject, self).dump()
+        result['Name'] = self.Name
+        result['Tags'] = list(self.Tags)
+        return result
+
+
+class TestLruCache(unittest.TestCase):
+    def test_eviction_order(self):
+        cache = LruCache(3)
+        for key in ['a', 'b', 'c']:
+            cache[key] = key.upper()
+        self.assertEqual(cache.get('a'), 'A')
+        cache['d'] = 'D'
+
+        # b was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(len(cache), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        cache.resize(1)
+        self.assertEqual(cache.values.keys(), ['c'])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'signature.cache')
+            self.assertEqual(LruCache().load(filename), 0)
+
+            cache = LruCache(10)
+            for i in range(5):
+                cache['key{0}'.format(i)] = 'address{0}'.format(i)
+            cache.get('key0')
+            cache.save(filename)
+
+            # the most recently used entries survive a smaller cache
+            restored = LruCache(2)
+            self.assertEqual(restored.load(filename), 5)
+            self.assertEqual(restored.values.keys(), ['key4', 'key0'])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,170 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal.global_store_manager import KeyValueStore
+from journal.state_history import LMDBStateHistory
+from journal.state_history import StateHistory
+from journal.state_history import StateHistoryError
+
+
+class TestStateHistory(unittest.TestCase):
+    def _create_history(self):
+        return StateHistory()
+
+    def test_lookup_by_version(self):
+        history = self._create_history()
+        history.append(0, {'a': 1}, [])
+        history.append(3, {'a': 2, 'b': 5}, [])
+        history.append(7, {}, ['a'])
+
+        self.assertEqual(history.lookup('a', 0), 1)
+        self.assertEqual(history.lookup('a', 2), 1)
+        self.assertEqual(history.lookup('a', 3), 2)
+        self.assertEqual(history.lookup('a', 6), 2)
+        self.assertRaises(KeyError, history.lookup, 'a', 7)
+        self.assertRaises(KeyError, history.lookup, 'b', 2)
+        self.assertEqual(history.lookup('b', 100), 5)
+        self.assertRaises(KeyError, history.lookup, 'c', 100)
+
+        self.assertEqual(history.keys(0), set(['a']))
+        self.assertEqual(history.keys(3), set(['a', 'b']))
+        self.assertEqual(history.keys(7), set(['b']))
+
+        self.assertTrue(history.contains('a', 4))
+        self.assertFalse(history.contains('a', 8))
+
+    def test_versions_must_increase(self):
+        history = self._create_history()
+        history.append(1, {'a': 1}, [])
+        self.assertRaises(StateHistoryError, history.append, 1, {}, [])
+        self.assertEqual(history.LatestVersion, 1)
+
+
+class TestLMDBStateHistory(TestStateHistory):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._environment = LMDBStateHistory.open_environment(
+            os.path.join(self._directory, 'history.lmdb'))
+
+    def tearDown(self):
+        self._environment.close()
+        shutil.rmtree(self._directory)
+
+    def _create_history(self):
+        return LMDBStateHistory(self._environment, 'test')
+
+    def test_keys_with_common_prefix(self):
+        history = self._create_history()
+        history.append(0, {'a': 1, 'ab': 2}, [])
+        history.append(1, {}, ['ab'])
+        self.assertEqual(history.lookup('a', 1), 1)
+        self.assertRaises(KeyError, history.lookup, 'ab', 1)
+        self.assertEqual(history.keys(0), set(['a', 'ab']))
+        self.assertEqual(history.keys(1), set(['a']))
+
+    def test_keys_from_index(self):
+        history = self._create_history()
+        history.append(0, {'a': 1, 'b': 2}, [])
+        history.append(1, {'c': 3}, ['a'])
+
+        # the index answers without reading the records
+        database = self._environment.open_db('test')
+        with self._environment.begin(write=True) as txn:
+            txn.drop(database, delete=False)
+
+        keys = history.keys(1)
+        self.assertEqual(keys, set(['b', 'c']))
+        keys.add('d')
+        self.assertEqual(history.keys(1), set(['b', 'c']))
+        self.assertEqual(history.keys(0), set(['a', 'b']))
+        self.assertTrue(history.contains('a', 0))
+        self.assertFalse(history.contains('a', 1))
+
+
+class TestKeyValueStoreHistory(unittest.TestCase):
+    def _build_chain(self, root, count):
+        stores = [root]
+        for i in xrange(count):
+            store = stores[-1].clone_store()
+            store.set('key{0}'.format(i), {'value': i})
+            if i > 0:
+                store.set('key{0}'.format(i - 1), {'value': -i})
+            if i > 1:
+                store.delete('key{0}'.format(i - 2))
+            store.commit()
+            stores.append(store)
+        return stores
+
+    def test_flatten_into_history(self):
+        root = KeyValueStore()
+        root.set('base', 'value')
+        root.commit()
+        root.attach_history(StateHistory())
+
+        stores = self._build_chain(root, 20)
+        expected = [s.compose() for s in stores]
+
+        stores[10].flatten()
+        self.assertIsNone(stores[10].PrevStore)
+        self.assertEqual(root.History.LatestVersion, 10)
+
+        for store, compose in zip(stores, expected):
+            self.assertEqual(store.compose(), compose)
+            self.assertEqual(set(store.keys()), set(compose.keys()))
+            for key, value in compose.iteritems():
+                self.assertEqual(store[key], value)
+                self.assertIn(key, store)
+
+        stores[15].flatten()
+        self.assertEqual(root.History.LatestVersion, 15)
+        self.assertEqual(stores[20].compose(), expected[20])
+        self.assertEqual(stores[15].dump()['Store'], expected[15])
+        self.assertNotIn('key12', stores[15])
+        self.assertRaises(KeyError, stores[15].get, 'key12')
+
+    def test_flatten_fork_falls_back_to_compose(self):
+        root = KeyValueStore()
+        root.commit()
+        root.attach_history(StateHistory())
+
+        stores = self._build_chain(root, 10)
+        fork = stores[5].clone_store()
+        fork.set('fork', True)
+        fork.commit()
+
+        stores[8].flatten()
+        expected = fork.compose()
+        fork.flatten()
+
+        self.assertEqual(root.History.LatestVersion, 8)
+        self.assertIsNone(fork.PrevStore)
+        self.assertEqual(fork.compose(), expected)
+        self.assertTrue(fork['fork'])
+
+    def test_get_returns_copy(self):
+        root = KeyValueStore()
+        root.commit()
+        root.attach_history(StateHistory())
+        stores = self._build_chain(root, 3)
+        stores[3].flatten()
+
+        value = stores[3].get('key2')
+        value['value'] = 'changed'
+        self.assertEqual(stores[3].get('key2'), {'value': 2})
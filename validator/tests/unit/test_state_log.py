@@ -0,0 +1,215 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import anydbm
+import os
+import shutil
+import tempfile
+import unittest
+import whichdb
+
+from journal.global_store_manager import GlobalStoreManager
+from journal.global_store_manager import KeyValueStore
+from journal.state_log import StateLog
+
+
+class TestStateLog(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, 'state.log')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_append_and_reopen(self):
+        log = StateLog(self._filename, 'n')
+        log.append('a', '0', 'first')
+        log.append('b', 'a', 'second')
+        self.assertEqual(log.read('a'), 'first')
+        log.close()
+
+        log = StateLog(self._filename, 'c')
+        self.assertEqual(sorted(log.keys()), ['a', 'b'])
+        self.assertEqual(log.previous_block_id('b'), 'a')
+        self.assertEqual(log.read('b'), 'second')
+        log.append('c', 'b', 'third')
+        self.assertEqual(log.read('c'), 'third')
+        log.close()
+
+        log = StateLog(self._filename, 'n')
+        self.assertEqual(len(log), 0)
+        log.close()
+
+    def test_damaged_tail_is_truncated(self):
+        log = StateLog(self._filename, 'n')
+        log.append('a', '0', 'first')
+        log.append('b', 'a', 'second')
+        log.close()
+
+        size = os.path.getsize(self._filename)
+        with open(self._filename, 'r+b') as fp:
+            fp.truncate(size - 3)
+
+        log = StateLog(self._filename, 'c')
+        self.assertEqual(log.keys(), ['a'])
+        log.append('c', 'a', 'third')
+        log.close()
+
+        log = StateLog(self._filename, 'c')
+        self.assertEqual(sorted(log.keys()), ['a', 'c'])
+        self.assertEqual(log.read('c'), 'third')
+        log.close()
+
+    def test_compact(self):
+        log = StateLog(self._filename, 'n')
+        log.append('a', '0', 'first')
+        log.append('b', 'a', 'second')
+        log.append('c', 'b', 'third')
+        log.compact(['c', 'b'])
+        self.assertNotIn('a', log)
+        self.assertEqual(log.read('b'), 'second')
+        self.assertEqual(log.read('c'), 'third')
+        log.close()
+
+        log = StateLog(self._filename, 'c')
+        self.assertEqual(sorted(log.keys()), ['b', 'c'])
+        log.close()
+
+
+class TestGlobalStoreManagerPersistence(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, 'test_state.dbm')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _open(self, flag, snapshotinterval=0):
+        manager = GlobalStoreManager(self._filename, flag,
+                                     snapshotinterval=snapshotinterval)
+        manager.add_transaction_store('/Test', KeyValueStore())
+        return manager
+
+    def _commit_chain(self, manager, previd, count, start=0):
+        blockids = []
+        for i in xrange(start, start + count):
+            blockstore = manager.get_block_store(previd).clone_block()
+            tstore = blockstore.get_transaction_store('/Test')
+            tstore.set('key{0}'.format(i), i)
+            if i > 0:
+                tstore.delete('key{0}'.format(i - 1))
+            blockid = 'block{0:04d}'.format(i)
+            manager.commit_block_store(blockid, blockstore)
+            blockids.append(blockid)
+            previd = blockid
+        return blockids
+
+    def test_restore_from_log(self):
+        manager = self._open('n')
+        blockids = self._commit_chain(manager, manager.RootBlockID, 5)
+        manager.close()
+
+        manager = self._open('c')
+        self.assertEqual(len(manager.persistmap_keys()), 6)
+        tstore = manager.get_block_store(blockids[-1]).get_transaction_store(
+            '/Test')
+        self.assertEqual(tstore.compose(), {'key4': 4})
+        manager.close()
+
+    def test_restore_from_legacy_database(self):
+        # the state as an earlier version stored it, one record for each
+        # block keyed by block id in a dbm file
+        manager = self._open('n')
+        blockids = self._commit_chain(manager, manager.RootBlockID, 5)
+        records = dict((b, manager._statelog.read(b)) for b in blockids)
+        manager.close()
+        os.remove(os.path.splitext(self._filename)[0] + '.log')
+
+        legacy = anydbm.open(self._filename, 'n')
+        for blockid in reversed(blockids):
+            legacy[blockid] = records[blockid]
+        legacy.close()
+
+        manager = self._open('c')
+        self.assertEqual(len(manager.persistmap_keys()), 6)
+        tstore = manager.get_block_store(blockids[-1]).get_transaction_store(
+            '/Test')
+        self.assertEqual(tstore.compose(), {'key4': 4})
+        blockids += self._commit_chain(manager, blockids[-1], 1, 5)
+        manager.close()
+
+        # the log now holds the state, the import is not repeated
+        manager = self._open('c')
+        self.assertEqual(len(manager.persistmap_keys()), 7)
+        tstore = manager.get_block_store(blockids[-1]).get_transaction_store(
+            '/Test')
+        self.assertEqual(tstore.compose(), {'key5': 5})
+        manager.close()
+
+        manager = self._open('n')
+        self.assertEqual(len(manager.persistmap_keys()), 1)
+        self.assertFalse(whichdb.whichdb(self._filename))
+        manager.close()
+
+    def test_restore_from_snapshot(self):
+        manager = self._open('n', snapshotinterval=5)
+        blockids = self._commit_chain(manager, manager.RootBlockID, 10)
+        manager.flatten_block_store(blockids[6])
+
+        # the snapshot replaces the blocks up to and including block 6
+        self.assertEqual(len(manager.persistmap_keys()), 5)
+        self.assertNotIn(blockids[6], manager._statelog)
+
+        blockids += self._commit_chain(manager, blockids[-1], 2, 10)
+        manager.close()
+
+        manager = self._open('c', snapshotinterval=5)
+        self.assertIn(blockids[6], manager.persistmap_keys())
+        tstore = manager.get_block_store(blockids[-1]).get_transaction_store(
+            '/Test')
+        self.assertEqual(tstore.compose(), {'key11': 11})
+        tstore = manager.get_block_store(blockids[6]).get_transaction_store(
+            '/Test')
+        self.assertEqual(tstore.compose(), {'key6': 6})
+        self.assertRaises(KeyError, manager.get_block_store, blockids[2])
+        manager.close()
+
+    def test_export_and_install_snapshot(self):
+        manager = self._open('n')
+        blockids = self._commit_chain(manager, manager.RootBlockID, 6)
+
+        (hashes, chunks) = manager.export_snapshot(blockids[4], 16)
+        self.assertTrue(len(hashes) > 1)
+        self.assertEqual(manager.export_snapshot(blockids[4], 16)[0], hashes)
+        payload = ''.join(chunks[h] for h in hashes)
+        manager.close()
+
+        filename = os.path.join(self._directory, 'installed.dbm')
+        installed = GlobalStoreManager(filename, 'n')
+        installed.add_transaction_store('/Test', KeyValueStore())
+        installed.install_snapshot(blockids[4], blockids[3], payload)
+        self.assertFalse(installed.has_block_store(blockids[3]))
+
+        # the installed state exports to the same chunks
+        self.assertEqual(installed.export_snapshot(blockids[4], 16)[0],
+                         hashes)
+        installed.close()
+
+        installed = GlobalStoreManager(filename, 'c')
+        installed.add_transaction_store('/Test', KeyValueStore())
+        tstore = installed.get_block_store(
+            blockids[4]).get_transaction_store('/Test')
+        self.assertEqual(tstore.compose(), {'key4': 4})
+        installed.close()
@@ -0,0 +1,150 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import time
+import unittest
+
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+import gossip.signed_object as SigObj
+
+from gossip.gossip_core import Gossip
+from gossip.message import Message, Packet
+from gossip.node import Node
+from gossip.stream_transport import StreamTransport
+from gossip.stream_transport import _ListenFactory
+from gossip.stream_transport import _PeerFactory
+
+
+class BlockMessage(Message):
+    DispatchLane = 'Block'
+
+
+def _create_node(port):
+    signingkey = SigObj.generate_signing_key()
+    ident = SigObj.generate_identifier(signingkey)
+    node = Node(identifier=ident, signingkey=signingkey,
+                address=("localhost", port))
+    node.is_peer = True
+    return node
+
+
+def _open(stream, peerid):
+    """Returns an outgoing connection to a peer over a string transport.
+    """
+    protocol = _PeerFactory(stream, peerid).buildProtocol(None)
+    protocol.makeConnection(StringTransport())
+    return protocol
+
+
+class TestStreamTransport(unittest.TestCase):
+    def test_send_and_receive(self):
+        received = []
+        stream = StreamTransport('test', 9070, received.append)
+        try:
+            peer = _create_node(9071)
+            self.assertFalse(stream.send('data', peer))
+
+            outgoing = _open(stream, peer.Identifier)
+            self.assertTrue(stream.is_connected(peer.Identifier))
+            self.assertTrue(stream.send('first', peer))
+            self.assertTrue(stream.send('second', peer))
+
+            # the frames arrive whole however the bytes are split up
+            incoming = _ListenFactory(stream).buildProtocol(None)
+            incoming.makeConnection(StringTransport())
+            data = outgoing.transport.value()
+            incoming.dataReceived(data[:7])
+            incoming.dataReceived(data[7:])
+            self.assertEqual(received, ['first', 'second'])
+
+            outgoing.connectionLost(Failure(Exception('closed')))
+            self.assertFalse(stream.is_connected(peer.Identifier))
+        finally:
+            stream.close()
+
+    def test_connect_failure(self):
+        stream = StreamTransport('test', 9072, lambda data: None)
+        try:
+            peer = _create_node(9073)
+            stream.connect(peer)
+            stream.failed(peer.Identifier, Failure(Exception('refused')))
+            self.assertEqual(stream.StreamStats.ConnectFailures.Value, 1)
+
+            # no new attempt until the retry interval has passed
+            stream.connect(peer)
+            self.assertNotIn(peer.Identifier, stream._pending)
+        finally:
+            stream.close()
+
+    def test_gossip_bulk_lanes(self):
+        signingkey = SigObj.generate_signing_key()
+        ident = SigObj.generate_identifier(signingkey)
+        core = Gossip(Node(identifier=ident, signingkey=signingkey,
+                           address=("localhost", 9074)),
+                      StreamTransport=True)
+        try:
+            written = []
+            core._dowrite = lambda data, peer: written.append(data)
+            peer = _create_node(9075)
+            core.add_node(peer)
+            outgoing = _open(core.StreamTransport, peer.Identifier)
+
+            now = time.time()
+            peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+            peer.enqueue_message(BlockMessage({'__SIGNATURE__': "block"}),
+                                 now)
+            peer.enqueue_message(Message({'__SIGNATURE__': "other"}), now)
+            core._transmit(peer, now + 100)
+
+            # blocks go over the stream without waiting for an ack
+            self.assertEqual(len(written), 1)
+            self.assertEqual(len(core.PendingAckMap), 1)
+            packet = Packet()
+            packet.unpack(outgoing.transport.value()[4:])
+            self.assertFalse(packet.IsReliable)
+        finally:
+            core.StreamTransport.close()
+
+    def test_gossip_stream_fallback(self):
+        signingkey = SigObj.generate_signing_key()
+        ident = SigObj.generate_identifier(signingkey)
+        core = Gossip(Node(identifier=ident, signingkey=signingkey,
+                           address=("localhost", 9076)),
+                      StreamTransport=True)
+        try:
+            written = []
+            core._dowrite = lambda data, peer: written.append(data)
+            peer = _create_node(9077)
+            core.add_node(peer)
+
+            # a failed stream send falls back to a datagram that is acked
+            core.StreamTransport.is_connected = lambda peerid: True
+            core.StreamTransport.send = lambda data, peer: False
+
+            now = time.time()
+            peer.TokenBucket.Tokens = peer.TokenBucket.Capacity
+            peer.enqueue_message(BlockMessage({'__SIGNATURE__': "block"}),
+                                 now)
+            core._transmit(peer, now + 100)
+
+            self.assertEqual(len(written), 1)
+            self.assertEqual(len(core.PendingAckMap), 1)
+            packet = Packet()
+            packet.unpack(written[0])
+            self.assertTrue(packet.IsReliable)
+        finally:
+            core.StreamTransport.close()
@@ -0,0 +1,57 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import unittest
+
+from gossip.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expire_in_bucket_order(self):
+        wheel = TimerWheel(1.0)
+        wheel['c'] = 102.5
+        wheel['a'] = 100.2
+        wheel['b'] = 100.7
+        self.assertEqual(len(wheel), 3)
+        self.assertIn('a', wheel)
+        self.assertEqual(wheel.next_expiration(), 101.0)
+
+        # keys never expire before their time
+        self.assertEqual(wheel.expire(100.9), [])
+        self.assertEqual(wheel.expire(101.0), ['a', 'b'])
+        self.assertNotIn('a', wheel)
+        self.assertEqual(wheel.next_expiration(), 103.0)
+        self.assertEqual(wheel.expire(1000.0), ['c'])
+        self.assertEqual(len(wheel), 0)
+        self.assertIsNone(wheel.next_expiration())
+
+    def test_pop_and_replace(self):
+        wheel = TimerWheel(0.5)
+        wheel['a'] = 10.0
+        wheel['b'] = 10.0
+        self.assertEqual(wheel.pop('a'), 10.0)
+        self.assertIsNone(wheel.pop('a'))
+
+        # a key moved to a later bucket is not expired from the earlier one
+        wheel['b'] = 20.0
+        self.assertEqual(wheel.get('b'), 20.0)
+        self.assertEqual(wheel.expire(15.0), [])
+        self.assertEqual(wheel.expire(20.0), ['b'])
+
+        # a key removed and added again to its bucket expires once
+        wheel['c'] = 30.0
+        wheel.pop('c')
+        wheel['c'] = 30.0
+        self.assertEqual(wheel.expire(30.0), ['c'])
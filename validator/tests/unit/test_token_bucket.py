@@ -0,0 +1,56 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import unittest
+
+from gossip.token_bucket import AdaptiveTokenBucket
+
+
+class TestAdaptiveTokenBucket(unittest.TestCase):
+    def test_grow_only_when_limited(self):
+        bucket = AdaptiveTokenBucket(10000, 20000, 100000)
+        bucket.delivered(1000, 0.1)
+        self.assertEqual(bucket.DripRate, 10000)
+
+        # a failed consume marks the bucket as limiting the traffic
+        self.assertFalse(bucket.consume(5000))
+        bucket.delivered(1000, 0.1)
+        self.assertEqual(bucket.DripRate, 20000)
+        self.assertEqual(bucket.Capacity, 40000)
+
+        # the rate never passes the maximum
+        for _ in range(100):
+            bucket.delivered(1000, 0.1)
+        self.assertEqual(bucket.DripRate, 100000)
+
+    def test_decrease_once_per_round_trip(self):
+        bucket = AdaptiveTokenBucket(64000, 128000)
+        bucket.dropped(1.0, now=100.0)
+        self.assertEqual(bucket.DripRate, 32000)
+        self.assertEqual(bucket.Threshold, 32000)
+
+        # losses from the same burst are counted once
+        bucket.dropped(1.0, now=100.5)
+        self.assertEqual(bucket.DripRate, 32000)
+
+        bucket.dropped(1.0, now=101.0)
+        self.assertEqual(bucket.DripRate, 16000)
+
+        # above the threshold the rate grows by IncreaseRate per round trip
+        bucket.Threshold = 16000
+        bucket.consume(bucket.Capacity + 1)
+        bucket.delivered(16000 * 0.5, 0.5)
+        self.assertEqual(bucket.DripRate,
+                         16000 + AdaptiveTokenBucket.IncreaseRate)
@@ -180,52 +180,44 @@ class TestRoundTripEstimator(unittest.TestCase):
         self.assertIn(msg2.Identifier, tQ.Messages)
         self.assertIn(msg.Identifier, tQ.Messages)
 
-    def test_tranmission_queue_trimheap(self):
-        # Test _trimheap, remove messages that are no longer valid
+    def test_tranmission_queue_reschedule_message(self):
+        # Test that rescheduling moves a queued message and enqueues a
+        # message that is not queued
         tQ = TransmissionQueue()
         now = time.time()
-        node = self._create_node()
         msg = self._create_msg()
-        # Test the _trimheap doesn't break on empty heap
-        tQ._trimheap()
-        self.assertEquals(tQ._heap, [])
-        tQ.enqueue_message(msg, now)
-        tQ._trimheap()
-        # Should not have changed anything
-        self.assertEquals(tQ._heap, [(now, msg.Identifier)])
-        # Change time to send in times, but not in heap, this makes it invalid
-        tQ._times[msg.Identifier] = 0.0
-        tQ._trimheap()
-        self.assertEquals(tQ._heap, [])
-
-    def test_tranmission_queue_buildheap(self):
-        # Test buildheap, cleans up the heap when a large number of
-        # messages have been dequeued
+        msg2 = self._create_msg()
+        tQ.reschedule_message(msg, now)
+        tQ.enqueue_message(msg2, now + 1)
+        self.assertEquals(tQ.Head, (now, msg))
+        tQ.reschedule_message(msg, now + 2)
+        self.assertEquals(tQ.Head, (now + 1, msg2))
+        self.assertEquals(tQ._times[msg.Identifier], now + 2)
+        self.assertEquals(len(tQ._heap), 2)
+
+    def test_tranmission_queue_heap_order(self):
+        # Test that the heap and position map stay consistent while
+        # messages are removed from the middle of the queue
         tQ = TransmissionQueue()
         now = time.time()
-        node = self._create_node()
-        # Add 10 messages to the queue
-        for i in range(10):
-            msg = self._create_msg()
-            tQ.enqueue_message(msg, now)
-        before = str(tQ._heap)
-        # Should not change the heap, no messages have been dequeued
-        tQ._buildheap()
-        after = str(tQ._heap)
-        self.assertEquals(before, after)
-
-        before = str(tQ._heap)
-        for i in range(7):
-            # Remove 7 messages from queue
-            # not using dequeue_message so that buildheap() won't be called
-            msgId = tQ._messages.keys().pop()
-            tQ._messages.pop(msgId, None)
-            tQ._times.pop(msgId, None)
-        # The heap has not changed, even though 7 messages have been "dequeued"
-        after = str(tQ._heap)
-        self.assertEquals(before, after)
-        # The heap is cleaned up and left with only the 3 messages.
-        tQ._buildheap()
-        after = str(tQ._heap)
-        self.assertNotEquals(before, after)
-        self.assertEquals(len(tQ._heap), 3)
+        msgs = [self._create_msg() for i in range(20)]
+        for i, msg in enumerate(msgs):
+            tQ.enqueue_message(msg, now + (i * 7) % 20)
+        for msg in msgs[::3]:
+            self.assertIsNotNone(tQ.dequeue_message(msg))
+        self.assertIsNone(tQ.dequeue_message(msgs[0]))
+        self.assertEquals(len(tQ._heap), tQ.Count)
+
+        for pos, (timetosend, messageid) in enumerate(tQ._heap):
+            self.assertEquals(tQ._positions[messageid], pos)
+            if pos > 0:
+                self.assertLessEqual(tQ._heap[(pos - 1) // 2][0],
+                                     timetosend)
+
+        times = []
+        while tQ.Head is not None:
+            (timetosend, msg) = tQ.Head
+            times.append(timetosend)
+            tQ.dequeue_message(msg)
+        self.assertEquals(times, sorted(times))
+        self.assertEquals(tQ._positions, {})
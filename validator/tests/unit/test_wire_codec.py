@@ -0,0 +1,110 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import unittest
+
+import gossip.signed_object as SigObj
+
+from gossip import wire_codec
+from gossip.common import dict2cbor
+from gossip.message import Message, unpack_message_data
+from gossip.wire_codec import WireCodec, is_compact
+
+
+class ItemObject(SigObj.SignedObject):
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(ItemObject, self).__init__(minfo)
+        self.Values = minfo.get('Values', [])
+
+    def dump(self):
+        result = super(ItemObject, self).dump()
+        result['TransactionType'] = '/Test/Item'
+        result['Values'] = self.Values
+        return result
+
+
+class ItemMessage(Message):
+    MessageType = "/test.ItemMessage/Item"
+
+    def __init__(self, minfo=None):
+        if minfo is None:
+            minfo = {}
+        super(ItemMessage, self).__init__(minfo)
+        self.Items = [ItemObject(i) for i in minfo.get('Items', [{}])]
+
+    def dump(self):
+        result = super(ItemMessage, self).dump()
+        result['Items'] = [i.dump() for i in self.Items]
+        return result
+
+
+class TestWireCodec(unittest.TestCase):
+    def _message(self):
+        signingkey = SigObj.generate_signing_key()
+        item = ItemObject({'Values': ['a', 'b', {'Name': 'c'}]})
+        item.sign_object(signingkey)
+        msg = ItemMessage({'Items': [item.dump(), item.dump()]})
+        msg.sign_object(signingkey)
+        return msg
+
+    def test_round_trip(self):
+        codec = WireCodec()
+        codec.register_type(ItemMessage)
+        self.assertEqual(len(codec), 2)
+
+        msg = self._message()
+        info = msg.dump()
+        data = codec.encode(info)
+        self.assertTrue(is_compact(data))
+        self.assertFalse(is_compact(dict2cbor(info)))
+        self.assertLess(len(data), len(dict2cbor(info)))
+        self.assertNotIn(ItemMessage.MessageType, data)
+
+        decoded = codec.decode(data)
+        self.assertEqual(decoded, info)
+        self.assertEqual(type(decoded['Items'][0]['Values'][0]), str)
+
+        # the signatures still verify against the canonical encoding
+        received = ItemMessage(decoded)
+        self.assertEqual(received.OriginatorID, msg.OriginatorID)
+        self.assertEqual(received.Items[1].OriginatorID,
+                         msg.Items[1].OriginatorID)
+
+    def test_extra_fields(self):
+        codec = WireCodec()
+        codec.register_type(ItemMessage)
+        info = self._message().dump()
+        info['Extra'] = 5
+        del info['__NONCE__']
+        self.assertEqual(codec.decode(codec.encode(info)), info)
+
+    def test_unknown_schema(self):
+        codec = WireCodec()
+        codec.register_type(ItemMessage)
+        data = codec.encode(self._message().dump())
+
+        with self.assertRaises(ValueError):
+            WireCodec().decode(data)
+        with self.assertRaises(ValueError):
+            WireCodec().encode(self._message().dump())
+
+    def test_message_compact(self):
+        # messages registered with a gossip node use the shared codec
+        wire_codec.register_type(ItemMessage)
+        msg = self._message()
+        self.assertEqual(unpack_message_data(msg.compact()), msg.dump())
+        self.assertEqual(unpack_message_data(repr(msg)), msg.dump())
@@ -29,6 +29,7 @@ from sawtooth.endpoint_client import EndpointClient
 from gossip import node, signed_object, token_bucket
 from gossip.messages import connect_message, shutdown_message
 from gossip.topology import random_walk, barabasi_albert
+from gossip.topology import latency_optimizer
 from journal.protocol import journal_transfer
 from ledger.transaction import endpoint_registry
 
@@ -201,6 +202,10 @@ class Validator(object):
             token_bucket.TokenBucket.DefaultDripRate = self.Config[
                 'NetworkFlowRate']
 
+        if 'NetworkMaximumFlowRate' in self.Config:
+            token_bucket.AdaptiveTokenBucket.DefaultMaximumRate = \
+                self.Config['NetworkMaximumFlowRate']
+
         if 'NetworkBurstRate' in self.Config:
             token_bucket.TokenBucket.DefaultDripRate = self.Config[
                 'NetworkBurstRate']
@@ -434,6 +439,19 @@ class Validator(object):
         logger.info("ledger connections using RandomWalk topology")
         random_walk.start_topology_update(self.Ledger, callback)
 
+    def start_topology_maintenance(self):
+        """
+        Keep rewiring the peers toward low latency neighbors for as long
+        as the validator runs.
+        """
+        if 'TargetConnectivity' in self.Config:
+            latency_optimizer.TargetConnectivity = self.Config[
+                'TargetConnectivity']
+        if 'MaintenanceInterval' in self.Config:
+            latency_optimizer.UpdateInterval = self.Config[
+                'MaintenanceInterval']
+        latency_optimizer.start_topology_maintenance(self.Ledger)
+
     def start_journal_transfer(self):
         self.status = 'transferring ledger'
         if not journal_transfer.start_journal_transfer(self.Ledger,
@@ -446,6 +464,9 @@ class Validator(object):
         self.status = 'started'
         self.register_endpoint(self.Ledger.LocalNode, self.EndpointDomain)
 
+        if self.Config.get('TopologyMaintenance', False):
+            self.start_topology_maintenance()
+
     def register_endpoint(self, node, domain='/'):
         txn = endpoint_registry.EndpointRegistryTransaction.register_node(
             node, domain, httpport=self._endpoint_http_port)